@@ -4,6 +4,10 @@ import matplotlib.pyplot as plt
 from scipy.interpolate import interpn
 from os import system
 from sys import exit
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Effect of Number of Piezoceramics on Algorithm Performance',
+                'In-vitro processing to get n_10 estimation results')) # scan_cube.py is kept once, with the n_10 code
+from scan_cube import open_cube, convert_to_cube
 
 
 def importData(filename):
@@ -15,6 +19,12 @@ def importData(filename):
 	volt = volt - np.mean(volt)
 	return time,volt
 
+def importCubeData(cube, y_index, x_index):
+	# same as importData, from the packed scan
+	time, volt = cube.waveform(y_index, x_index)
+	volt = volt - np.mean(volt)
+	return time,volt
+
 def calcPressure(volt):
 	volt_pkpk = np.max(volt)-np.min(volt)
 	sensitivity = 447*1E-9 # [V/Pa]	(447 mV/MPa) 
@@ -27,8 +37,14 @@ def Main():
 	fileprefix = 'data\\20230510_freq_sweep_of_transducer3f'
 	pressureArr = np.zeros(101)
 	f = np.linspace(1,3,101)
+	cubefile = None # fileprefix + '.cube' packs the raw files (1 x 101) on the first run and reads the cube afterwards
+	if cubefile:
+		cube = open_cube(cubefile, lambda: convert_to_cube([f'{fileprefix}{i:03}.txt' for i in range(101)], cubefile, f, [0.0]))
 	for i in range(101):
-		_, volt = importData(f'{fileprefix}{i:03}.txt')
+		if cubefile:
+			_, volt = importCubeData(cube, 0, i)
+		else:
+			_, volt = importData(f'{fileprefix}{i:03}.txt')
 		pressure = calcPressure(volt)
 		pressureArr[i] = pressure 
 
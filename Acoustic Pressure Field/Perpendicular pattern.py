@@ -4,6 +4,10 @@ import matplotlib.pyplot as plt
 from scipy.interpolate import interpn
 from os import system
 from sys import exit
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Effect of Number of Piezoceramics on Algorithm Performance',
+                'In-vitro processing to get n_10 estimation results')) # scan_cube.py is kept once, with the n_10 code
+from scan_cube import open_cube, convert_umsmap_scan
 
 
 def importData(filename):
@@ -15,6 +19,12 @@ def importData(filename):
 	volt = volt - np.mean(volt)
 	return time,volt
 
+def importCubeData(cube, y_index, x_index):
+	# same as importData, from the packed scan
+	time, volt = cube.waveform(y_index, x_index)
+	volt = volt - np.mean(volt)
+	return time,volt
+
 def importMapData(filename):
 	print(f'$$$ Importing {filename}')
 	data = np.genfromtxt(filename, delimiter=None, skip_header=4)
@@ -38,8 +48,13 @@ def calcPressure(volt):
 def Main():
 	fileprefix = 'data\\'
 	mapfile = fileprefix + 'tx_with_ml_2d_scan_at_focus3_UMSmap.txt'
-
-	x,y,data = importMapData(mapfile)
+	cubefile = None # fileprefix + 'tx_with_ml_2d_scan_at_focus3.cube' packs the map and raw files on the first run and reads the cube afterwards
+	if cubefile:
+		cube = open_cube(cubefile, lambda: convert_umsmap_scan(mapfile, fileprefix + 'tx_with_ml_2d_scan_at_focus3', cubefile))
+		x,y = np.meshgrid(cube.x, cube.y)
+		data = cube.map_values.copy() # same as importMapData(mapfile)
+	else:
+		x,y,data = importMapData(mapfile)
 	data = data/np.max(data)
 
 	plt.figure(figsize=(10,7))
@@ -82,8 +97,11 @@ def Main():
 	pressureMap = np.transpose(pressureMap)
 	for i in range(20):
 		for j in range(20):		
-			fullfilename = f'{fileprefix}Y{i:03}X{j:03}.txt'
-			_, volt = importData(fullfilename)
+			if cubefile:
+				_, volt = importCubeData(cube, i, j)
+			else:
+				fullfilename = f'{fileprefix}Y{i:03}X{j:03}.txt'
+				_, volt = importData(fullfilename)
 			pressure = calcPressure(volt)
 			pressureMap[i,j] = pressure 
 
@@ -1,8 +1,13 @@
 import numpy as np 
 import matplotlib.pyplot as plt
 import signal_processing as sp
+from scan_loader import load_scan
+from scan_cube import open_cube, convert_umsmap_scan
+from waveform_store import WaveformStore
+from peak_grid import PeakGrid
+from subset_study import study_subsets
+from result_cache import ResultCache, cache_key, file_fingerprint
 import os, json
-import random
 
 class Data():
 
@@ -20,12 +25,27 @@ class Data():
         self.x_index_range_for_fitting = settings["general"]["x_index_range_for_fitting"]
         self.y_index_range_for_fitting = settings["general"]["y_index_range_for_fitting"]
         self.fitting_alg = settings["general"]["fitting_alg"]
+        self.loader_workers = settings["general"].get("loader_workers") # processes reading the scan files, all cores if null
+        self.ellipsoid_orientation = settings["general"].get("ellipsoid_orientation", "aligned") # aligned or free
+        self.gated_processing = settings["general"].get("gated_processing", False) # filter and envelope only around the limits
+        self.gate_margin_us = settings["general"].get("gate_margin_us", 10) # kept on both sides of a gate for the filter transients
+        self.gated_validation_positions = settings["general"].get("gated_validation_positions", 5) # also processed in full to check the peaks
+        self.gated_tolerance_us = settings["general"].get("gated_tolerance_us", 0.1)
+        self.waveform_dtype = settings["general"].get("waveform_dtype", "float64") # of the stored waveforms, float32 halves the memory
+        self.peak_interpolation = settings["general"].get("peak_interpolation") # parabolic or centroid, null for whole samples
+        self.roi_polygon = settings["general"].get("roi_polygon") # [[x, y], ...] mm, fits only the positions inside, null for all
+        self.subset_study = settings.get("subset_study") # k-of-n study settings, see run_subset_study
+        cache_folder = settings["general"].get("cache_folder") # results kept between runs, null to always recompute
+        self.cache = ResultCache(cache_folder, settings["general"].get("cache_max_MB", 1024)*2**20) if cache_folder else None
+        self.cache_waveforms = settings["general"].get("cache_waveforms", False) # also keep the filtered and enveloped waveforms
+        self.waveforms = None
         
         
         self.PA_map_output_name = settings[shape]["map_file"] # UMSmap filename
         self.PA_raw_output_prefix_name = settings[shape]["raw_file"] # Raw signal filename, excluding Y000X000.txt part
         self.anterior_limits = settings[shape]["anterior_limits"]
         self.posterior_limits = settings[shape]["posterior_limits"]
+        self.cube_file = settings[shape].get("cube_file") # packed scan created from the raw files on the first run, null to read the raw files
         
         self.object_shape = shape
         self.get_scan_parameters()
@@ -49,6 +69,12 @@ class Data():
 
 
     def get_scan_parameters(self):
+        if self.cube_file:
+            self.cube = open_cube(self.cube_file, self.convert_to_cube)
+            self.x, self.y = self.cube.x, self.cube.y
+            self.x_count, self.y_count = self.cube.x_count, self.cube.y_count
+            return
+        self.cube = None
         data = np.genfromtxt(self.PA_map_output_name, delimiter=None, skip_header=4)
         self.x = np.asarray(data[0,1:])
         self.y = np.asarray(data[1:,0])
@@ -59,11 +85,29 @@ class Data():
 
 
 
+    def convert_to_cube(self):
+        """Packs the UMSmap and raw files of the scan into self.cube_file."""
+        convert_umsmap_scan(self.PA_map_output_name, self.PA_raw_output_prefix_name, self.cube_file,
+                            reader=lambda filenames: load_scan(filenames, self.loader_workers, progress=None))
+
+
+
+
+
     def get_sampling_rate(self):
-        center_file = f"{self.PA_raw_output_prefix_name}Y000X000.txt"
-        data = np.genfromtxt(center_file, delimiter=None, skip_header=81)
-        time_s = np.asarray(data[:,0]); volt_V = np.asarray(data[:,1])
-        self.sampling_rate = (time_s.size-1) / (time_s[-1]-time_s[0])
+        if self.cube is not None:
+            self.sampling_rate = self.cube.sampling_rate
+        else:
+            center_file = f"{self.PA_raw_output_prefix_name}Y000X000.txt"
+            key = cache_key(file_fingerprint(center_file))
+            cached = self.cache.load("sampling_rate", key) if self.cache else None
+            if cached is None:
+                data = np.genfromtxt(center_file, delimiter=None, skip_header=81)
+                time_s = np.asarray(data[:,0]); volt_V = np.asarray(data[:,1])
+                self.sampling_rate = (time_s.size-1) / (time_s[-1]-time_s[0])
+                if self.cache: self.cache.save("sampling_rate", key, sampling_rate=self.sampling_rate)
+            else:
+                self.sampling_rate = float(cached["sampling_rate"])
         
         if not self.are_limits_set_correctly:
             print("Print a raw waveform to set the anterior and posterior limits.")
@@ -76,47 +120,25 @@ class Data():
 
     def process(self):
         
-        self.filtered_waveforms_us_mV = {}
-        self.enveloped_waveforms_us_mV = {}
-        self.peak_times_us = {}
-        self.peak_voltages_mV = {}
-        self.anterior_coordinates = np.empty((self.x_count*self.y_count,3))
-        self.posterior_coordinates = self.anterior_coordinates.copy()
-        
-        
-        for x_index in range(self.x_count):
-            for y_index in range(self.y_count):
-                full_filename = f"{self.PA_raw_output_prefix_name}Y{y_index:0>3}X{x_index:0>3}.txt"
-                data = np.genfromtxt(full_filename, delimiter=None, skip_header=81)
-                time_s = np.asarray(data[:,0])
-                volt_V = np.asarray(data[:,1])
-                volt_V -= np.mean(volt_V)
-
-                filtered_volt_V = sp.apply_bandpass_filter(volt_V, self.bandpass_cutoffs, self.bandpass_order, self.sampling_rate)
-                amplified_volt_V = sp.amplify_signal(filtered_volt_V, gain=3)
-                enveloped_volt_V = sp.get_envelope(amplified_volt_V)
-                                
-                # if x_index == 2 and y_index == 2:
-                #     self.plot_processed_data_plots_and_exit(time_s, volt_V, filtered_volt_V, amplified_volt_V, enveloped_volt_V)
-                
-                peak_times, peak_voltages = sp.detect_echo_peaks(time_s, enveloped_volt_V, self.anterior_limits, self.posterior_limits)
-                self.filtered_waveforms_us_mV[f"x{x_index}_y{y_index}"] = (time_s*1e6, filtered_volt_V*1e3)
-                self.enveloped_waveforms_us_mV[f"x{x_index}_y{y_index}"] = (time_s*1e6, enveloped_volt_V*1e3)
-                self.peak_times_us[f"x{x_index}_y{y_index}"] = peak_times*1e6
-                self.peak_voltages_mV[f"x{x_index}_y{y_index}"] = peak_voltages*1e3
-                self.anterior_coordinates[x_index*self.y_count+y_index,:] = np.array([self.x[x_index], self.y[y_index],sp.tof_to_distance_mm(peak_times[0]*1e6)])
-                self.posterior_coordinates[x_index*self.y_count+y_index,:] = np.array([self.x[x_index], self.y[y_index],sp.tof_to_distance_mm(peak_times[1]*1e6)])
-
+        # only the stages whose inputs changed are recomputed, fitting is always done
+        waveform_key = self.waveform_key()
+        peak_key = cache_key(waveform_key, self.anterior_limits, self.posterior_limits, self.peak_interpolation)
+        cached = self.cache.load("peaks", peak_key) if self.cache else None
+        if cached is None:
+            peak_times_us, peak_voltages_mV = self.detect_peaks(self.get_waveforms(waveform_key))
+            if self.cache: self.cache.save("peaks", peak_key, peak_times_us=peak_times_us, peak_voltages_mV=peak_voltages_mV)
+        else:
+            print("Peak times loaded from the cache.")
+            peak_times_us, peak_voltages_mV = cached["peak_times_us"], cached["peak_voltages_mV"]
+        
+        # (ny, nx, 2) peak times and the coordinates of every position, selections only index them
+        self.peaks = PeakGrid(self.x, self.y, peak_times_us, peak_voltages_mV)
+        self.peak_times_us, self.peak_voltages_mV = self.peaks.peak_times_us, self.peaks.peak_voltages_mV
+        self.anterior_coordinates, self.posterior_coordinates = self.peaks.all()
             
         self.filter_the_selected_measurements()
         
-        # # effect of number of coordinates on the volume estimation accuracy
-        # sample_count = 16
-        # num_of_coords = self.selected_anterior_coordinates.shape[0]
-        # selected_indexes = random.sample(range(num_of_coords), sample_count)
-        # self.selected_anterior_coordinates = self.selected_anterior_coordinates[list(selected_indexes)]
-        # self.selected_posterior_coordinates = self.selected_posterior_coordinates[list(selected_indexes)]
-        # print(selected_indexes)
+        # the effect of the number of coordinates on the volume estimation accuracy is in run_subset_study
         
         self.selected_coordinates = np.concatenate((self.selected_anterior_coordinates, self.selected_posterior_coordinates), axis=0)
         
@@ -127,7 +149,8 @@ class Data():
             self.visualize_selected_coordinates_sphere()
             print(f"Volume: {self.calculated_volume:.2f} mL\n{self.radius:.2f} mm radius and center at {self.center}")
         elif self.fitting_alg.lower() == "ellipsoid":
-            self.calculated_volume, self.params, self.center = sp.calculate_the_ellipsoid_volume(self.selected_coordinates)
+            oriented = self.ellipsoid_orientation.lower() == "free"
+            self.calculated_volume, self.params, self.center, self.rotation = sp.calculate_the_ellipsoid_volume(self.selected_coordinates, oriented=oriented)
             self.visualize_selected_coordinates_ellipsoid()
             print(f"Volume: {self.calculated_volume:.2f} mL\n{self.params} mm semi-axis lengths\nCenter at {self.center} mm")
  
@@ -136,17 +159,126 @@ class Data():
  
  
  
-    def filter_the_selected_measurements(self):
-        selected_length = np.abs(self.x_index_range_for_fitting[1] - self.x_index_range_for_fitting[0]) * np.abs(self.y_index_range_for_fitting[1] - self.y_index_range_for_fitting[0])
-        counter = 0
-        self.selected_anterior_coordinates = np.empty(( selected_length, 3))
-        self.selected_posterior_coordinates = self.selected_anterior_coordinates.copy()
+    def waveform_key(self) -> str:
+        """Cache key of the processed waveforms: size and modification time of the scan files
+        and every setting the filtering and enveloping depend on."""
+        if self.cube is not None:
+            sources = [file_fingerprint(self.cube_file)]
+        else:
+            sources = [file_fingerprint(filename) for filename in self.raw_filenames()]
+        dsp = [self.bandpass_cutoffs, self.bandpass_order, 3, self.sampling_rate, self.waveform_dtype, self.gated_processing]
+        if self.gated_processing: # the gates follow the limits
+            dsp += [self.anterior_limits, self.posterior_limits, self.gate_margin_us, self.gated_validation_positions, self.gated_tolerance_us]
+        return cache_key(sources, dsp)
+ 
+ 
+ 
+ 
+ 
+    def raw_filenames(self) -> list:
+        """Raw waveform files of the scan, y outer and x inner."""
+        return [f"{self.PA_raw_output_prefix_name}Y{y_index:0>3}X{x_index:0>3}.txt" for y_index in range(self.y_count) for x_index in range(self.x_count)]
+ 
+ 
+ 
+ 
+ 
+    def get_waveforms(self, waveform_key:str = None) -> WaveformStore:
+        """Filtered and enveloped waveforms of the scan, processed on the first call (or read
+        from the cache when cache_waveforms is set). process() needs them only on a cache miss."""
+        if self.waveforms is not None:
+            return self.waveforms
+        waveform_key = waveform_key or self.waveform_key()
+        cached = self.cache.load("waveforms", waveform_key) if self.cache and self.cache_waveforms else None
+        if cached is not None:
+            print("Processed waveforms loaded from the cache.")
+            self.waveforms = WaveformStore(cached["time_us"]*1e-6, self.y_count, self.x_count, cached["filtered_mV"].dtype)
+            self.waveforms.time_us, self.waveforms.filtered_mV, self.waveforms.enveloped_mV = cached["time_us"], cached["filtered_mV"], cached["enveloped_mV"]
+            return self.waveforms
+        
+        if self.cube is not None:
+            time_s = self.cube.time
+            volts_V = self.cube.volt.reshape(self.y_count*self.x_count, -1) # y outer and x inner, memory mapped, no parsing
+        else:
+            times_s, volts_V = zip(*load_scan(self.raw_filenames(), self.loader_workers)) # read in parallel, in this order
+            time_s, volts_V = times_s[0], np.array(volts_V)
+        
+        # the whole scan is filtered, amplified and enveloped as one stack, straight into the store
+        self.waveforms = WaveformStore(time_s, self.y_count, self.x_count, self.waveform_dtype)
+        if self.gated_processing:
+            self.process_gates(time_s, volts_V, self.waveforms.stacks())
+        else:
+            sp.process_waveforms(volts_V, self.bandpass_cutoffs, self.bandpass_order, self.sampling_rate, gain=3, out=self.waveforms.stacks())
+        self.waveforms.to_millivolts()
+        if self.cache and self.cache_waveforms:
+            self.cache.save("waveforms", waveform_key, time_us=self.waveforms.time_us,
+                            filtered_mV=self.waveforms.filtered_mV, enveloped_mV=self.waveforms.enveloped_mV)
+        return self.waveforms
+ 
+ 
+ 
+ 
+ 
+    def detect_peaks(self, waveforms:WaveformStore):
+        """(ny, nx, 2) anterior and posterior peak times [us] and voltages [mV] of the envelopes,
+        every position in one call, refined between the samples by peak_interpolation."""
+        peak_times, peak_voltages_mV = sp.detect_echo_peak_stack(waveforms.time_us*1e-6, waveforms.enveloped_mV, self.anterior_limits,
+                                                                 self.posterior_limits, self.peak_interpolation)
+        return peak_times*1e6, peak_voltages_mV # the envelope is in mV
+ 
+ 
+ 
+ 
+ 
+    def run_subset_study(self) -> list:
+        """Spherical fits of many k-position subsets of the selected positions for every k of the
+        subset_study settings, each position gives its anterior and posterior coordinates.
+        Returns one row per k with the shape, mean, std and SEM of the volumes."""
+        rows = study_subsets(self.selected_anterior_coordinates, self.selected_posterior_coordinates, self.subset_study["k"],
+                             self.subset_study.get("subsets_per_k", 1000), self.subset_study.get("workers"),
+                             seed=self.subset_study.get("seed", 0))
+        return [dict(row, shape=self.object_shape) for row in rows]
+ 
+ 
+ 
+ 
+ 
+    def process_gates(self, time_s, volts_V, out):
+        """Filters and envelopes only the anterior and posterior gates into out=(filtered, enveloped),
+        NaN elsewhere. The peak times of a few positions are checked against the full-record
+        processing, the whole scan is processed in full if any is off by more than gated_tolerance_us."""
+        gates = (self.anterior_limits, self.posterior_limits)
+        indexes, filtered, enveloped = sp.process_gated_waveforms(time_s, volts_V, gates, self.bandpass_cutoffs, self.bandpass_order,
+                                                                  self.sampling_rate, gain=3, margin_s=self.gate_margin_us*1e-6)
+        filtered_volts_V, enveloped_volts_V = out
+        filtered_volts_V.fill(np.nan)
+        enveloped_volts_V.fill(np.nan)
+        for (start, stop), filtered_gate, enveloped_gate in zip(indexes, filtered, enveloped):
+            filtered_volts_V[:, start:stop] = filtered_gate
+            enveloped_volts_V[:, start:stop] = enveloped_gate
         
-        for x_index in range(self.x_index_range_for_fitting[0], self.x_index_range_for_fitting[1]):
-            for y_index in range(self.y_index_range_for_fitting[0], self.y_index_range_for_fitting[1]):
-                self.selected_anterior_coordinates[counter,:] = np.array([self.x[x_index], self.y[y_index], sp.tof_to_distance_mm(self.peak_times_us[f"x{x_index}_y{y_index}"][0])])
-                self.selected_posterior_coordinates[counter,:] = np.array([self.x[x_index], self.y[y_index], sp.tof_to_distance_mm(self.peak_times_us[f"x{x_index}_y{y_index}"][1])])
-                counter += 1
+        checked = np.unique(np.linspace(0, volts_V.shape[0]-1, min(self.gated_validation_positions, volts_V.shape[0])).astype(int))
+        _, full_enveloped_V = sp.process_waveforms(volts_V[checked], self.bandpass_cutoffs, self.bandpass_order, self.sampling_rate, gain=3)
+        full_peak_times, _ = sp.detect_echo_peak_stack(time_s, full_enveloped_V, self.anterior_limits, self.posterior_limits, self.peak_interpolation)
+        gated_peak_times, _ = sp.detect_echo_peak_stack(time_s, enveloped_volts_V[checked], self.anterior_limits, self.posterior_limits, self.peak_interpolation)
+        worst_us = np.max(np.abs(full_peak_times-gated_peak_times))*1e6
+        if worst_us > self.gated_tolerance_us:
+            print(f"Gated peak times are up to {worst_us:.3f} us off the full record, processing the full records instead.")
+            print("A larger <gate_margin_us> may help.\n")
+            return sp.process_waveforms(volts_V, self.bandpass_cutoffs, self.bandpass_order, self.sampling_rate, gain=3, out=out)
+        print(f"Gated processing: peak times within {worst_us:.3f} us of the full record at {checked.size} positions.")
+        return out
+ 
+ 
+ 
+ 
+ 
+    def filter_the_selected_measurements(self, mask:np.array = None, polygon = None):
+        """Selects the coordinates inside the index ranges for fitting and, if given, inside the
+        (ny, nx) mask and the polygon ([[x, y], ...] mm, roi_polygon of the settings by default)."""
+        polygon = self.roi_polygon if polygon is None else polygon
+        self.selected_anterior_coordinates, self.selected_posterior_coordinates = self.peaks.select(
+            self.x_index_range_for_fitting, self.y_index_range_for_fitting, mask, polygon)
  
  
  
@@ -193,9 +325,11 @@ class Data():
         ax.scatter3D(self.selected_posterior_coordinates[:,0], self.selected_posterior_coordinates[:,1], self.selected_posterior_coordinates[:,2], marker="o", color="blue", label="Posterior")
         u = np.linspace(0, 2 * np.pi, 100)
         v = np.linspace(0, np.pi, 100)
-        x = self.params[0] * np.outer(np.cos(u), np.sin(v)) + self.center[0]
-        y = self.params[1] * np.outer(np.sin(u), np.sin(v)) + self.center[1]
-        z = self.params[2] * np.outer(np.ones(np.size(u)), np.cos(v)) + self.center[2]
+        x = self.params[0] * np.outer(np.cos(u), np.sin(v))
+        y = self.params[1] * np.outer(np.sin(u), np.sin(v))
+        z = self.params[2] * np.outer(np.ones(np.size(u)), np.cos(v))
+        # rotate the axes into place (identity for the axis-aligned fit)
+        x, y, z = np.einsum('ij,jkl->ikl', self.rotation, np.array([x, y, z])) + np.reshape(self.center, (3,1,1))
         ax.plot_surface(x, y, z, color='pink', alpha=0.4, label="Fitted ellipsoid")
         
         limits = np.array([ ax.get_xlim3d(),
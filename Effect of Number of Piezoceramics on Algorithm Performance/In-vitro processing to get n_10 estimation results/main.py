@@ -1,6 +1,7 @@
 from os import system
 from sys import exit
 from data_class import Data
+from subset_study import write_study_table
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import numpy as np 
@@ -23,10 +24,10 @@ def plot_every_waveform_1by1(data, shape):
             fig.set_size_inches(10,7)
             ax.set_title(f"{shape} - {x_index+1}x{y_index+1}")
             ax.set_xlabel("Time, us"); ax.set_ylabel("Voltage, mV")
-            ax.plot(data.filtered_waveforms_us_mV[f"x{x_index}_y{y_index}"][0],
-                    data.filtered_waveforms_us_mV[f"x{x_index}_y{y_index}"][1], color="black", lw=1.5)
-            ax.scatter(data.peak_times_us[f"x{x_index}_y{y_index}"],
-                       data.peak_voltages_mV[f"x{x_index}_y{y_index}"], 100, color="red")
+            time_us, filtered_mV, _ = data.get_waveforms().waveform(x_index, y_index) # views, processed once if the peaks came from the cache
+            ax.plot(time_us, filtered_mV, color="black", lw=1.5)
+            ax.scatter(data.peak_times_us[y_index, x_index],
+                       data.peak_voltages_mV[y_index, x_index], 100, color="red")
             data.show_plots()
 
 
@@ -36,12 +37,18 @@ def main():
     system("cls")
     settings_json = "settings.json"
     shape_list = ( "spherical", "ellipsoid", "conical" )
+    study_rows = []
     
     for shape in shape_list:
         data = Data(settings_json, shape)
         print("\n\n>>>>>>>",data)
         data.process()
+        if data.subset_study and data.subset_study.get("enabled"):
+            study_rows += data.run_subset_study()
         
+    if study_rows:
+        write_study_table(data.subset_study["table"], study_rows)
+        print(f"Subset study written to <<{data.subset_study['table']}>>.")
 
     
     data.show_plots()
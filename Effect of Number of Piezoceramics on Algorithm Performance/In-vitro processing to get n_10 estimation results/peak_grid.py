@@ -0,0 +1,61 @@
+import numpy as np
+from signal_processing import tof_to_distance_mm
+
+
+
+def points_in_polygon(x:np.array, y:np.array, vertices) -> np.array:
+    """Even-odd test of every (x, y) point against a polygon of (x, y) vertices, vectorized over the points."""
+    vertices = np.asarray(vertices, dtype=float)
+    x0, y0 = vertices[:,0], vertices[:,1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    x, y = np.asarray(x)[...,None], np.asarray(y)[...,None]
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return np.count_nonzero(crosses & (x < x_cross), axis=-1) % 2 == 1
+
+
+
+
+class PeakGrid():
+    """Anterior and posterior echo times of a scan as a (ny, nx, 2) array, with the x, y and
+    depth grids of the same shape. The coordinates of every position are computed once,
+    a selection only indexes them. Selections keep the old x outer, y inner order."""
+
+    def __init__(self, x:np.array, y:np.array, peak_times_us:np.array, peak_voltages_mV:np.array = None):
+        self.x, self.y = np.asarray(x), np.asarray(y)
+        self.peak_times_us = np.asarray(peak_times_us) # (ny, nx, 2)
+        self.peak_voltages_mV = peak_voltages_mV
+        self.x_grid, self.y_grid = np.meshgrid(self.x, self.y) # (ny, nx)
+        self.depths_mm = tof_to_distance_mm(self.peak_times_us) # (ny, nx, 2)
+        # (2, nx, ny, 3): anterior/posterior, x, y, (x, y, depth) so that flattening gives x outer order
+        coordinates = np.empty((2, self.x.size, self.y.size, 3))
+        coordinates[..., 0] = self.x_grid.T
+        coordinates[..., 1] = self.y_grid.T
+        coordinates[..., 2] = np.moveaxis(self.depths_mm, 2, 0).transpose(0, 2, 1)
+        self.coordinates = coordinates
+
+
+    def all(self):
+        """(anterior, posterior) coordinates of every position, each (nx*ny, 3)."""
+        return self.coordinates[0].reshape(-1, 3), self.coordinates[1].reshape(-1, 3)
+
+
+    def select(self, x_index_range=None, y_index_range=None, mask:np.array = None, polygon=None):
+        """(anterior, posterior) coordinates, each (k, 3), of the positions inside every given condition:
+        x_index_range, y_index_range: [start, stop) indexes
+        mask: (ny, nx) boolean array
+        polygon: (x, y) vertices in mm of the region of interest"""
+        if mask is None and polygon is None: # a plain index range is a slice
+            selected = self.coordinates[:, slice(*(x_index_range or (None,))), slice(*(y_index_range or (None,)))]
+            return selected[0].reshape(-1, 3), selected[1].reshape(-1, 3)
+        selected = np.ones((self.y.size, self.x.size), dtype=bool) if mask is None else np.array(mask, dtype=bool)
+        if x_index_range is not None:
+            selected[:, :x_index_range[0]] = False
+            selected[:, x_index_range[1]:] = False
+        if y_index_range is not None:
+            selected[:y_index_range[0]] = False
+            selected[y_index_range[1]:] = False
+        if polygon is not None:
+            selected &= points_in_polygon(self.x_grid, self.y_grid, polygon)
+        return self.coordinates[0][selected.T], self.coordinates[1][selected.T]
@@ -0,0 +1,67 @@
+import numpy as np
+import os, json, hashlib
+
+
+
+def file_fingerprint(filename:str) -> list:
+    """[name, size, modification time] of a file, changes whenever the file is rewritten."""
+    status = os.stat(filename)
+    return [os.path.basename(filename), status.st_size, status.st_mtime_ns]
+
+
+
+
+def cache_key(*parts) -> str:
+    """Hex digest of the json-able parts (fingerprints, settings, other keys)."""
+    text = json.dumps(parts, sort_keys=True, default=lambda value: np.asarray(value).tolist())
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+
+
+class ResultCache():
+    """Folder of .npz entries named by the key of their inputs, so a changed input is a miss
+    and never a stale hit. Entries are written next to their final name and renamed when
+    complete. Reading an entry marks it as used, the least recently used entries are
+    removed once the folder holds more than max_bytes."""
+
+    def __init__(self, folder:str, max_bytes:int = 1 << 30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.folder): os.makedirs(self.folder)
+
+
+    def path(self, stage:str, key:str) -> str:
+        return os.path.join(self.folder, f"{stage}_{key}.npz")
+
+
+    def load(self, stage:str, key:str) -> dict:
+        """Arrays of the entry, None if it is not cached."""
+        path = self.path(stage, key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError): # missing, or a broken entry that is recomputed
+            return None
+        os.utime(path)
+        return arrays
+
+
+    def save(self, stage:str, key:str, **arrays):
+        path = self.path(stage, key)
+        with open(path + ".tmp", "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(path + ".tmp", path)
+        self.evict(keep=path)
+
+
+    def evict(self, keep:str = None):
+        """Removes the least recently used entries until the folder fits in max_bytes."""
+        entries = [os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith(".npz")]
+        entries = sorted((os.stat(entry).st_mtime_ns, os.path.getsize(entry), entry) for entry in entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes: break
+            if entry != keep:
+                os.remove(entry)
+                total -= size
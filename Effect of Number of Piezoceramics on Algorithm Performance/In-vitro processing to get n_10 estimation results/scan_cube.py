@@ -0,0 +1,154 @@
+import numpy as np
+import os, sys, json
+from scan_loader import read_waveform
+
+
+
+MAGIC = b"UMSCUBE1"
+ALIGNMENT = 4096 # the waveforms start on a page boundary
+
+
+
+
+def read_header_lines(filename:str, count:int = 81) -> list:
+    """First count lines of a text file, without line endings."""
+    with open(filename, "r", errors="replace") as file:
+        return [file.readline().rstrip("\r\n") for _ in range(count)]
+
+
+
+
+def convert_to_cube(filenames:list, cube_file:str, x, y, map_values=None, map_header:list = (),
+                    skip_header:int = 81, dtype:str = "<f8", reader=None, progress=print):
+    """Packs the raw waveform files of a scan into one cube file.
+    filenames: len(y)*len(x) files, y outer and x inner (Y000X000, Y000X001, ...)
+    x, y: scan axes in mm; map_values: optional (ny,nx) UMSmap values
+    reader: optional reader(filenames) yielding (time_s, volt_V) in that order,
+    e.g. scan_loader.load_scan, the files are read one by one otherwise.
+    All files must share the first file's time axis. The cube is written next to
+    its final name and renamed when complete."""
+    x, y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+    if len(filenames) != x.size*y.size:
+        raise ValueError(f"{len(filenames)} files for a {y.size}x{x.size} scan")
+    if reader is None:
+        waveforms = (read_waveform(filename, skip_header) for filename in filenames)
+    else:
+        waveforms = iter(reader(filenames))
+    time_s, volt_V = next(waveforms)
+
+    arrays = {"x": x, "y": y, "time": np.asarray(time_s, dtype=float)}
+    if map_values is not None:
+        arrays["map"] = np.asarray(map_values, dtype=float).reshape(y.size, x.size)
+    offset, layout = 0, {}
+    for name, array in arrays.items():
+        layout[name] = [offset, list(array.shape), "<f8"]
+        offset += array.size*8
+    volt_shape = (y.size, x.size, arrays["time"].size)
+    meta = {"arrays": layout, "volt": list(volt_shape), "dtype": np.dtype(dtype).str,
+            "header": read_header_lines(filenames[0], skip_header), "map_header": list(map_header),
+            "source": os.path.commonprefix(list(filenames))}
+    meta_bytes = json.dumps(meta).encode("utf8")
+    data_start = -(-(len(MAGIC) + 8 + len(meta_bytes)) // 8) * 8
+    volt_start = -(-(data_start + offset) // ALIGNMENT) * ALIGNMENT
+    meta_bytes = meta_bytes.ljust(data_start - len(MAGIC) - 8)
+
+    temporary_file = cube_file + ".tmp"
+    with open(temporary_file, "wb") as file:
+        file.write(MAGIC + len(meta_bytes).to_bytes(8, "little") + meta_bytes)
+        for array in arrays.values():
+            file.write(array.astype("<f8").tobytes())
+        file.truncate(volt_start + int(np.prod(volt_shape))*np.dtype(dtype).itemsize)
+    volt = np.memmap(temporary_file, dtype=dtype, mode="r+", offset=volt_start, shape=volt_shape)
+
+    sample_period = (arrays["time"][-1]-arrays["time"][0]) / max(arrays["time"].size-1, 1)
+    for index, filename in enumerate(filenames):
+        if index:
+            time_s, volt_V = next(waveforms)
+            if time_s.size != arrays["time"].size or not np.allclose(time_s, arrays["time"], rtol=0, atol=1e-3*abs(sample_period)):
+                del volt
+                os.remove(temporary_file)
+                raise ValueError(f"{filename}: time axis differs from {filenames[0]}")
+        volt[index // x.size, index % x.size] = volt_V
+        if progress and (index+1) % 100 == 0:
+            progress(f"__ {index+1}/{len(filenames)} files packed.")
+    volt.flush()
+    del volt
+    os.replace(temporary_file, cube_file)
+    return ScanCube(cube_file)
+
+
+
+
+def convert_umsmap_scan(map_file:str, raw_prefix:str, cube_file:str, **kwargs):
+    """2D scan: the UMSmap file gives the axes and the map, the raw files are
+    {raw_prefix}Y000X000.txt ... Returns the opened cube."""
+    data = np.genfromtxt(map_file, delimiter=None, skip_header=4)
+    x, y = data[0,1:], data[1:,0]
+    filenames = [f"{raw_prefix}Y{y_index:0>3}X{x_index:0>3}.txt" for y_index in range(y.size) for x_index in range(x.size)]
+    return convert_to_cube(filenames, cube_file, x, y, data[1:,1:], read_header_lines(map_file, 4), **kwargs)
+
+
+
+
+def convert_profile_scan(profile_file:str, raw_prefix:str, axis_letter:str, cube_file:str, **kwargs):
+    """1D scan: the first column of the UMSProfile file is the scanned axis, the raw
+    files are {raw_prefix}{axis_letter}000.txt ... The cube is 1 x n."""
+    data = np.genfromtxt(profile_file, delimiter=None, skip_header=81)
+    x = np.asarray(data[:,0])
+    filenames = [f"{raw_prefix}{axis_letter}{index:0>3}.txt" for index in range(x.size)]
+    return convert_to_cube(filenames, cube_file, x, [0.0], **kwargs)
+
+
+
+
+class ScanCube():
+    """Read-only scan cube. x, y, time and map_values are loaded, volt is a
+    (ny, nx, nsamples) memory map, so only the waveforms used are read from disk
+    and a second run is served from the page cache."""
+
+    def __init__(self, cube_file:str):
+        self.cube_file = cube_file
+        with open(cube_file, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{cube_file} is not a scan cube file.")
+            length = int.from_bytes(file.read(8), "little")
+            meta = json.loads(file.read(length))
+        data_start = len(MAGIC) + 8 + length
+        arrays = {name: np.fromfile(cube_file, dtype=dtype, count=int(np.prod(shape)), offset=data_start+offset).reshape(shape)
+                  for name, (offset, shape, dtype) in meta["arrays"].items()}
+        self.x, self.y, self.time = arrays["x"], arrays["y"], arrays["time"]
+        self.map_values = arrays.get("map")
+        self.header, self.map_header, self.source = meta["header"], meta["map_header"], meta["source"]
+        volt_start = -(-(data_start + sum(array.nbytes for array in arrays.values())) // ALIGNMENT) * ALIGNMENT
+        self.volt = np.memmap(cube_file, dtype=meta["dtype"], mode="r", offset=volt_start, shape=tuple(meta["volt"]))
+        self.y_count, self.x_count, self.sample_count = self.volt.shape
+        self.sampling_rate = (self.time.size-1) / (self.time[-1]-self.time[0])
+
+
+    def __str__(self):
+        return f"<<{self.cube_file}>>\n({self.x_count}x{self.y_count}) scan, {self.sample_count} samples per waveform."
+
+
+    def waveform(self, y_index:int, x_index:int):
+        """(time_s, volt_V) of one position, volt_V is a read-only view."""
+        return self.time, self.volt[y_index, x_index]
+
+
+
+
+def open_cube(cube_file:str, convert=None) -> ScanCube:
+    """Opens the cube, creating it first with convert() if the file is not there."""
+    if not os.path.isfile(cube_file) and convert is not None:
+        print(f"Packing the raw files into <<{cube_file}>> (one time).")
+        convert()
+    return ScanCube(cube_file)
+
+
+
+
+if __name__ == "__main__":
+    # python scan_cube.py <UMSmap file> <raw file prefix> <cube file>
+    if len(sys.argv) != 4:
+        print("usage: python scan_cube.py <UMSmap file> <raw file prefix> <cube file>")
+        sys.exit(1)
+    print(convert_umsmap_scan(*sys.argv[1:]))
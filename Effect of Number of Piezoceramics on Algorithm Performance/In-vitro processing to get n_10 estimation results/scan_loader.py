@@ -0,0 +1,43 @@
+import numpy as np
+import os, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+
+def read_waveform(filename:str, skip_header:int = 81):
+    """Reads one raw waveform file, returns (time_s, volt_V)."""
+    try:
+        data = np.loadtxt(filename, skiprows=skip_header) # much faster, but needs complete rows
+    except ValueError:
+        data = np.genfromtxt(filename, delimiter=None, skip_header=skip_header)
+    return np.asarray(data[:,0]), np.asarray(data[:,1])
+
+
+
+
+def read_chunk(filenames:list, skip_header:int = 81) -> list:
+    """Reads the given files in a worker process."""
+    return [read_waveform(filename, skip_header) for filename in filenames]
+
+
+
+
+def load_scan(filenames:list, workers:int = None, chunk_size:int = 16, skip_header:int = 81, progress=print):
+    """Yields (time_s, volt_V) of every file, in the order of filenames.
+    The files are read chunk_size at a time on a pool of worker processes. At most
+    2*workers chunks are read ahead, so memory stays bounded however large the scan is.
+    progress(message) is called after every chunk, None to stay silent."""
+    workers = workers or os.cpu_count() or 1
+    chunks = [filenames[i:i+chunk_size] for i in range(0, len(filenames), chunk_size)]
+    start, loaded = time.perf_counter(), 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending, submitted = deque(), 0
+        while pending or submitted < len(chunks):
+            while submitted < len(chunks) and len(pending) < 2*workers:
+                pending.append(pool.submit(read_chunk, chunks[submitted], skip_header))
+                submitted += 1
+            waveforms = pending.popleft().result()
+            loaded += len(waveforms)
+            if progress: progress(f"Loaded {loaded}/{len(filenames)} files ({time.perf_counter()-start:.1f} s)")
+            yield from waveforms
@@ -1,5 +1,8 @@
 import numpy as np 
-from scipy.signal import butter, filtfilt, hilbert
+from itertools import combinations
+from math import comb
+from functools import lru_cache
+from scipy.signal import butter, sosfiltfilt, hilbert
 from scipy.optimize import minimize
 
 
@@ -23,7 +26,83 @@ def Sphere_func(parameters : np.array, coordinates: np.array) -> float:
     return np.sum( (np.sqrt((x-x0)**2 + (y-y0)**2 + (z-z0)**2) - r)**2) 
 
 
-def calculate_the_ellipsoid_volume(coordinates: np.array) -> float:
+def Ellipsoid_fit_algebraic(coordinates: np.array, oriented: bool = False, refine_steps: int = 5):
+    """Direct least-squares ellipsoid fit, returns (center, semi-axes, rotation).
+    The quadric a x^2 + b y^2 + c z^2 + 2f yz + 2g xz + 2h xy + 2p x + 2q y + 2r z + d = 0
+    is fitted by plain least squares (unit coefficient vector), which is exact for any ellipsoid.
+    If that quadric is not an ellipsoid, it is fitted again with the constraint 4J - I^2 = 1
+    (I = a+b+c, J = ab+bc+ca-f^2-g^2-h^2) as one generalized eigenproblem; the constraint only
+    admits ellipsoids, but none with a short axis under half the long one. With oriented=False the cross
+    terms are left out and the axes stay parallel to x, y and z. Then a few Gauss-Newton
+    steps on the radial distances refine the center and the semi-axes.
+    The columns of rotation are the directions of the semi-axes."""
+    coordinates = np.asarray(coordinates, dtype=float)
+    mean = np.mean(coordinates, axis=0)
+    scale = np.max(np.std(coordinates, axis=0))
+    x, y, z = np.transpose((coordinates - mean) / scale) # conditioning
+    quadratic = [x*x, y*y, z*z] + ([2*y*z, 2*x*z, 2*x*y] if oriented else [])
+    D = np.column_stack(quadratic + [2*x, 2*y, 2*z, np.ones(x.size)])
+    S = D.T @ D
+    n = len(quadratic)
+    S11, S12, S22 = S[:n,:n], S[:n,n:], S[n:,n:]
+    C1 = np.zeros((n, n))
+    C1[:3,:3] = 1 # 4J - I^2 with k = 4
+    np.fill_diagonal(C1[:3,:3], -1)
+    C1[3:,3:] = -4*np.eye(n-3)
+    reduced = S11 - S12 @ np.linalg.solve(S22, S12.T)
+    eigenvalues, eigenvectors = np.linalg.eig(np.linalg.solve(C1, reduced))
+    constrained = np.real(eigenvectors[:, np.argmax(np.real(eigenvalues))])
+    for v1 in (np.linalg.eigh(reduced)[1][:,0], constrained):
+        v2 = -np.linalg.solve(S22, S12.T @ v1)
+        a, b, c = v1[:3]
+        f, g, h = v1[3:] if oriented else (0, 0, 0)
+        A = np.array([[a, h, g], [h, b, f], [g, f, c]])
+        center = -np.linalg.solve(A, v2[:3])
+        k = -(v2[3] + v2[:3] @ center)
+        eigenvalues, rotation = np.linalg.eigh(A / k)
+        if np.all(eigenvalues > 0):
+            break
+    if np.any(eigenvalues <= 0): # not an ellipsoid, fall back to the sphere
+        x0, y0, z0, r = Sphere_fit_algebraic(coordinates, [(-np.inf, np.inf)]*3 + [(0, np.inf)])
+        return np.array([x0, y0, z0]), np.full(3, r), np.eye(3)
+    center = center*scale + mean
+    axes = scale / np.sqrt(eigenvalues)
+    if not oriented: # eigh sorts the eigenvalues, put the axes back in x, y, z order
+        order = np.argmax(np.abs(rotation), axis=0)
+        axes[order], rotation = axes.copy(), np.eye(3)
+
+    parameters = np.concatenate((center, axes))
+    def residuals(parameters):
+        # distance along the ray from the center to the surface
+        local = (coordinates - parameters[:3]) @ rotation
+        distance = np.maximum(np.linalg.norm(local, axis=1), 1e-12)
+        rho = np.linalg.norm(local / parameters[3:], axis=1)
+        return distance - distance/np.maximum(rho, 1e-12)
+    for _ in range(refine_steps):
+        current = residuals(parameters)
+        jacobian = np.empty((current.size, 6))
+        for i in range(6): # forward differences
+            delta = 1e-6 * max(1, abs(parameters[i]))
+            shifted = parameters.copy(); shifted[i] += delta
+            jacobian[:,i] = (residuals(shifted) - current) / delta
+        step = np.linalg.lstsq(jacobian, -current, rcond=None)[0]
+        if np.sum(residuals(parameters + step)**2) >= np.sum(current**2):
+            break
+        parameters = parameters + step
+        if np.max(np.abs(step)) < 1e-6:
+            break
+    return parameters[:3], np.abs(parameters[3:]), rotation
+
+
+
+def calculate_the_ellipsoid_volume(coordinates: np.array, method: str = "algebraic", oriented: bool = False) -> float:
+    """Used to calculate the ellipsoid volume, given a coordinates array in (x,y,z) system.
+    method: "algebraic" (direct least squares, see Ellipsoid_fit_algebraic) or "minimize" (scipy,
+    axis-aligned only). Returns volume, semi-axes, center and rotation (columns are the axes)."""
+    if method == "algebraic":
+        center, (a0, b0, c0), rotation = Ellipsoid_fit_algebraic(coordinates, oriented)
+        x0, y0, z0 = center
+        return 4/3 * np.pi * a0*b0*c0/1000, (a0,b0,c0), (x0,y0,z0), rotation
     x, y, z = np.transpose(coordinates)
     x_init_range = np.max(x)-np.min(x)
     y_init_range = np.max(y)-np.min(y)
@@ -31,43 +110,320 @@ def calculate_the_ellipsoid_volume(coordinates: np.array) -> float:
     initial_guess = np.array([np.mean(x), np.mean(y), np.mean(z), x_init_range, y_init_range, z_init_range])
     best_fit_sphere = minimize(Ellipsoid_func, initial_guess, coordinates, bounds=[(-30,30), (-30,30), (10,200), (z_init_range/2, z_init_range), (z_init_range/2, z_init_range), (0,z_init_range/2)])
     x0, y0, z0, a0, b0, c0 = best_fit_sphere.x
-    return 4/3 * np.pi * a0*b0*c0/1000, (a0,b0,c0), (x0,y0,z0)
+    return 4/3 * np.pi * a0*b0*c0/1000, (a0,b0,c0), (x0,y0,z0), np.eye(3)
     
     
     
     
     
-def calculate_the_sphere_volume(coordinates: np.array) -> float:
-    """Used to calculate the volume, given a coordinates array in (x,y,z) system."""
+def Sphere_fit_minimize(coordinates: np.array, bounds: list) -> np.array:
+    """The scipy fit of Sphere_func, from the mean of the coordinates with r = 50."""
     x, y, z = np.transpose(coordinates)
     initial_guess = np.array([np.mean(x), np.mean(y), np.mean(z), 50]) # np.std(x) as r
+    return minimize(Sphere_func, initial_guess, coordinates, bounds=bounds).x
+
+
+
+
+def Sphere_fit_algebraic(coordinates: np.array, bounds: list, refine_steps: int = 10, max_condition: float = 1e6) -> np.array:
+    """Closed-form sphere fit, returns (x0, y0, z0, r).
+    |p|^2 = 2*p.c + (r^2 - |c|^2) is linear in (x0, y0, z0, r^2 - |c|^2), so one linear
+    least squares gives the sphere, then a few Gauss-Newton steps on the Sphere_func residuals
+    (analytic Jacobian) refine it. If the [2p, 1] design matrix is rank deficient or its
+    condition number is above max_condition (coplanar sets, e.g. two transducer columns), if
+    the steps do not converge or if the result is on or outside a bound, the closed form does
+    not hold and Sphere_fit_minimize's result is returned instead."""
+    coordinates = np.asarray(coordinates, dtype=float)
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    mean = np.mean(coordinates, axis=0) # centered, so the condition number does not depend on the position
+    A = np.column_stack((2*(coordinates - mean), np.ones(coordinates.shape[0])))
+    singular_values = np.linalg.svd(A, compute_uv=False)
+    if singular_values.size == 4 and singular_values[-1]*max_condition > singular_values[0]:
+        solution = np.linalg.lstsq(A, np.sum((coordinates - mean)**2, axis=1), rcond=None)[0]
+        center = solution[:3] + mean
+        # for a fixed center the best radius is the mean distance
+        parameters = np.append(center, np.mean(np.linalg.norm(coordinates - center, axis=1)))
+        for _ in range(refine_steps):
+            diff = coordinates - parameters[:3]
+            dist = np.maximum(np.sqrt(np.sum(diff**2, axis=1)), 1e-12)
+            residuals = dist - parameters[3]
+            jacobian = np.empty((dist.size, 4))
+            jacobian[:,:3] = -diff/dist[:,None]
+            jacobian[:,3] = -1
+            step = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+            parameters = parameters + step
+            if np.max(np.abs(step)) < 1e-6:
+                if np.all((parameters > lower) & (parameters < upper)):
+                    return parameters
+                break
+    return Sphere_fit_minimize(coordinates, bounds)
+
+
+
+
+def Sphere_fit_ransac(coordinates: np.array, bounds: list, hypotheses: int = 100, threshold: float = 2.0, seed: int = 0):
+    """Robust sphere fit, returns (parameters, inliers). Spheres through 4 points
+    are solved for a batch of hypotheses (all 4-point subsets if there are no
+    more than `hypotheses`, otherwise that many random ones) and scored
+    together: the sum of squared distances to the surface, capped at
+    threshold [mm]. The best one's inliers are refitted with
+    Sphere_fit_algebraic. inliers marks the coordinates that were kept.
+    With 4 coordinates or less, or without a consensus of 4, all of them are
+    fitted. Every fit goes through Sphere_fit_algebraic's checks, so the
+    coplanar sets of a few transducers get the minimize result."""
+    coordinates = np.asarray(coordinates, dtype=float)
+    n = coordinates.shape[0]
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    if n <= 4:
+        return Sphere_fit_algebraic(coordinates, bounds), np.ones(n, dtype=bool)
+    if comb(n, 4) <= hypotheses:
+        samples = np.array(list(combinations(range(n), 4)))
+    else:
+        samples = np.argsort(np.random.default_rng(seed).random((hypotheses, n)), axis=1)[:,:4]
+
+    # |p|^2 = 2*p.c + (r^2 - |c|^2) through the 4 points of every sample
+    points = coordinates[samples]
+    A = np.concatenate((2*points, np.ones((samples.shape[0], 4, 1))), axis=2)
+    valid = np.abs(np.linalg.det(A)) > 1e-9 * np.max(np.abs(points))**3 # coplanar samples have no sphere
+    solution = np.linalg.solve(A[valid], np.sum(points[valid]**2, axis=2)[...,None])[...,0]
+    center = solution[:,:3]
+    r = np.sqrt(np.maximum(solution[:,3] + np.sum(center**2, axis=1), 0))
+    parameters = np.column_stack((center, r))
+    inside = np.all((parameters >= lower) & (parameters <= upper), axis=1)
+    if not np.any(inside):
+        return Sphere_fit_algebraic(coordinates, bounds), np.ones(n, dtype=bool)
+    parameters = parameters[inside]
+
+    residuals = np.abs(np.linalg.norm(coordinates[None,:,:] - parameters[:,None,:3], axis=2) - parameters[:,3:])
+    cost = np.sum(np.minimum(residuals, threshold)**2, axis=1)
+    inliers = residuals[np.argmin(cost)] < threshold
+    for _ in range(2): # refit on the inliers, then take the inliers of the refit
+        if np.count_nonzero(inliers) < 4:
+            return Sphere_fit_algebraic(coordinates, bounds), np.ones(n, dtype=bool)
+        fitted = Sphere_fit_algebraic(coordinates[inliers], bounds)
+        inliers = np.abs(np.linalg.norm(coordinates - fitted[:3], axis=1) - fitted[3]) < threshold
+    return fitted, inliers
+
+
+
+
+def calculate_the_sphere_volume(coordinates: np.array, method: str = "algebraic", info: dict = None, hypotheses: int = 100) -> float:
+    """Used to calculate the volume, given a coordinates array in (x,y,z) system.
+    method: "algebraic" (closed-form + Gauss-Newton, minimize for the sets it cannot fit), "ransac" (robust, at most `hypotheses`
+    4-point spheres scored) or "minimize" (scipy).
+    info: if given, for "ransac" info['rejected'] is set to the indexes of the rejected coordinates."""
     r_limit = (1e6*(3/4)/np.pi)**(1/3)
-    best_fit_sphere = minimize(Sphere_func, initial_guess, coordinates, bounds=[(-15,15), (-15,15), (10,170), (5, r_limit)])
-    x0, y0, z0, r = best_fit_sphere.x
+    bounds = [(-15,15), (-15,15), (10,170), (5, r_limit)]
+    if method == "algebraic":
+        x0, y0, z0, r = Sphere_fit_algebraic(coordinates, bounds)
+    elif method == "ransac":
+        (x0, y0, z0, r), inliers = Sphere_fit_ransac(coordinates, bounds, hypotheses)
+        if info is not None:
+            info['rejected'] = np.flatnonzero(~inliers)
+    else:
+        x0, y0, z0, r = Sphere_fit_minimize(coordinates, bounds)
     return 4/3 * np.pi * r**3 / 1000, r, (np.round(x0,2),np.round(y0,2),np.round(z0,2))
 
 
 
-def amplify_signal(voltage, gain=5):
-    max_amp = np.max(voltage)
-    amplified = voltage**gain
-    amplified = (amplified - np.min(amplified)) / (np.max(amplified)-np.min(amplified))
-    return max_amp*(amplified- np.mean(amplified))
+def Sphere_fit_batch(coordinate_sets, bounds: list, mask: np.array = None, refine_steps: int = 10, tolerance: float = 1e-6,
+                     max_condition: float = 1e6):
+    """Sphere_fit_algebraic for many coordinate sets at once, vectorized over
+    the sets. coordinate_sets: (B,N,3) array padded to the longest set with
+    mask (B,N) marking the real rows, or a list of (n_i,3) arrays.
+    Returns parameters (B,4) as (x0, y0, z0, r) and converged (B,): the
+    vectorized Gauss-Newton steps fell below tolerance inside the bounds.
+    The sets that did not (rank deficient or ill-conditioned, not converged
+    or on a bound) are fitted again one at a time with Sphere_fit_algebraic,
+    so every row is the per-set result."""
+    if mask is None and not isinstance(coordinate_sets, np.ndarray):
+        sizes = [len(c) for c in coordinate_sets]
+        mask = np.arange(max(sizes))[None,:] < np.array(sizes)[:,None]
+        padded = np.zeros(mask.shape + (3,))
+        padded[mask] = np.concatenate([np.asarray(c, dtype=float).reshape(-1, 3) for c in coordinate_sets])
+        coordinate_sets = padded
+    coordinates = np.asarray(coordinate_sets, dtype=float)
+    weights = np.ones(coordinates.shape[:2]) if mask is None else np.asarray(mask, dtype=float)
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    count = np.maximum(weights.sum(axis=1), 1)
+
+    def solve(normal, rhs, solvable):
+        # batched 4x4 solves, the sets that are not solvable get the identity instead
+        normal = np.where(solvable[:,None,None], normal, np.eye(4))
+        return np.linalg.solve(normal, rhs[...,None])[...,0]
+
+    # closed-form solution on the normal equations, around each set's mean;
+    # the padded rows are zero and change neither the solution nor the singular values
+    mean = np.sum(coordinates*weights[...,None], axis=1) / count[:,None]
+    centered = (coordinates - mean[:,None,:]) * weights[...,None]
+    A = np.concatenate((2*centered, weights[...,None]), axis=2)
+    b = np.sum(centered**2, axis=2)
+    singular_values = np.linalg.svd(A, compute_uv=False)
+    if singular_values.shape[1] == 4: # the same test as Sphere_fit_algebraic's
+        solvable = singular_values[:,-1]*max_condition > singular_values[:,0]
+    else:
+        solvable = np.zeros(A.shape[0], dtype=bool)
+    At = A.transpose(0,2,1)
+    solution = solve(At @ A, (At @ b[...,None])[...,0], solvable)
+    center = solution[:,:3] + mean
+    # for a fixed center the best radius is the mean distance
+    r = np.sum(np.linalg.norm(coordinates - center[:,None,:], axis=2)*weights, axis=1) / count
+    parameters = np.column_stack((center, r))
+
+    converged = np.zeros(parameters.shape[0], dtype=bool)
+    for _ in range(refine_steps):
+        diff = coordinates - parameters[:,None,:3]
+        dist = np.maximum(np.linalg.norm(diff, axis=2), 1e-12)
+        residuals = (dist - parameters[:,None,3]) * weights
+        jacobian = np.concatenate((-diff/dist[...,None], -np.ones(dist.shape + (1,))), axis=2) * weights[...,None]
+        Jt = jacobian.transpose(0,2,1)
+        normal = Jt @ jacobian
+        eigenvalues = np.linalg.eigvalsh(normal)
+        solvable &= eigenvalues[:,0]*max_condition**2 > eigenvalues[:,-1]
+        step = solve(normal, -(Jt @ residuals[...,None])[...,0], solvable)
+        step[converged | ~solvable] = 0
+        parameters = parameters + step
+        converged |= solvable & (np.max(np.abs(step), axis=1) < tolerance)
+        if np.all(converged | ~solvable):
+            break
+
+    # the others are fitted one at a time, falling back to minimize where needed
+    converged &= solvable & np.all((parameters > lower) & (parameters < upper), axis=1)
+    for index in np.flatnonzero(~converged):
+        parameters[index] = Sphere_fit_algebraic(coordinates[index][weights[index] > 0], bounds)
+    return parameters, converged
+
+
+
+
+def calculate_the_sphere_volumes(coordinate_sets, mask: np.array = None) -> tuple:
+    """calculate_the_sphere_volume for many coordinate sets at once, see Sphere_fit_batch.
+    Returns volumes [mL], radii [mm], centers (B,3) [mm] and converged flags."""
+    r_limit = (1e6*(3/4)/np.pi)**(1/3)
+    bounds = [(-15,15), (-15,15), (10,170), (5, r_limit)]
+    parameters, converged = Sphere_fit_batch(coordinate_sets, bounds, mask)
+    r = parameters[:,3]
+    return 4/3 * np.pi * r**3 / 1000, r, parameters[:,:3], converged
+
+
+
+def raise_to_gain(voltage, gain):
+    """voltage**gain, as repeated products for small integer gains (much faster than pow for whole stacks)."""
+    if float(gain).is_integer() and 1 <= gain <= 8:
+        amplified = np.array(voltage, dtype=float)
+        for _ in range(int(gain)-1):
+            amplified *= voltage
+        return amplified
+    return voltage**gain
+
+
+
+
+def amplify_signal(voltage, gain=5, axis=-1):
+    max_amp = np.max(voltage, axis=axis, keepdims=True)
+    amplified = raise_to_gain(voltage, gain)
+    amplified_min = np.min(amplified, axis=axis, keepdims=True)
+    amplified = (amplified - amplified_min) / (np.max(amplified, axis=axis, keepdims=True)-amplified_min)
+    return max_amp*(amplified- np.mean(amplified, axis=axis, keepdims=True))
+
+
+
 
+@lru_cache(maxsize=32)
+def design_bandpass_filter(order, cutoffs, sampling_rate):
+	"""Butterworth band-pass as second-order sections, designed once per (order, cutoffs, sampling_rate)."""
+	return butter(order, cutoffs, btype='bandpass', analog=False, output='sos', fs=sampling_rate)
 
 
 
-def apply_bandpass_filter(voltage, cutoffs, order, sampling_rate):
-	"""Applies a band-pass filter to the inputted array."""
-	b,a = butter(order, [cutoffs[0], cutoffs[1]], btype='bandpass', analog=False, output='ba', fs=sampling_rate)
-	return filtfilt(b, a, voltage) 
 
+def apply_bandpass_filter(voltage, cutoffs, order, sampling_rate, axis=-1):
+	"""Applies a band-pass filter to the inputted array (along axis for a stack of waveforms)."""
+	sos = design_bandpass_filter(int(order), (float(cutoffs[0]), float(cutoffs[1])), float(sampling_rate))
+	return sosfiltfilt(sos, voltage, axis=axis, padlen=3*(2*int(order)+1)) # same edge padding as filtfilt(b, a)
 
 
 
-def get_envelope(voltage):
+
+def get_envelope(voltage, axis=-1):
 	"""Takes the 1-sided envelope of the inputted signal using Hilbert transform."""
-	return np.abs(hilbert(voltage))
+	return np.abs(hilbert(voltage, axis=axis))
+
+
+
+
+def process_waveforms(voltages:np.array, cutoffs, order, sampling_rate, gain=3, block_bytes:int = 1<<21, out=None):
+    """Mean removal, band-pass, amplification and envelope of a (waveforms, samples) stack,
+    the same steps as Data.process used to run one waveform at a time.
+    The stack is processed block_bytes worth of waveforms at a time, so the filter and
+    FFT work sets stay in cache. Returns the filtered and enveloped stacks, written into
+    out=(filtered, enveloped) if given (e.g. float32 arrays, always computed in float64)."""
+    voltages = np.asarray(voltages)
+    filtered, enveloped = out if out is not None else (np.empty(voltages.shape), np.empty(voltages.shape))
+    rows = max(1, block_bytes // (8*voltages.shape[-1]))
+    for start in range(0, voltages.shape[0], rows):
+        block = voltages[start:start+rows]
+        block = block - np.mean(block, axis=-1, keepdims=True)
+        block = apply_bandpass_filter(block, cutoffs, order, sampling_rate)
+        filtered[start:start+rows] = block
+        enveloped[start:start+rows] = get_envelope(amplify_signal(block, gain=gain))
+    return filtered, enveloped
+
+
+
+
+def nearest_indexes(time:np.array, values) -> np.array:
+    """Index of the sample nearest to each value, the earlier one on a tie (as argmin(abs(time-value))),
+    found by binary search on the increasing time axis."""
+    time, values = np.asarray(time), np.asarray(values, dtype=float)
+    after = np.clip(np.searchsorted(time, values), 1, time.size-1)
+    return np.where(values - time[after-1] <= time[after] - values, after-1, after)
+
+
+
+
+def gate_indexes(time:np.array, limits) -> tuple:
+    """(start, stop) sample indexes of a gate, picked the same way as in detect_echo_peaks."""
+    start, stop = nearest_indexes(time, limits[:2])
+    return int(start), int(stop)
+
+
+
+
+def process_gated_waveforms(time:np.array, voltages:np.array, gates, cutoffs, order, sampling_rate, gain=3,
+                            margin_s:float = 10e-6, block_bytes:int = 1<<21):
+    """process_waveforms restricted to the gates. Each gate plus margin_s on both sides (room
+    for the filter and Hilbert transients) is filtered and enveloped on its own and the
+    margins are dropped, so the FFTs are only as long as the gates. The amplification is
+    scaled by the statistics of the gates instead of the whole record, which moves the
+    envelope voltages but not the peak times.
+    Returns the (start, stop) indexes of the gates and, per gate, the filtered and
+    enveloped (waveforms, stop-start) stacks."""
+    voltages = np.asarray(voltages)
+    margin = int(np.ceil(margin_s*sampling_rate))
+    indexes = [gate_indexes(time, limits) for limits in gates]
+    segments = [(max(start-margin, 0), min(stop+margin, voltages.shape[-1])) for start, stop in indexes]
+    filtered = [np.empty((voltages.shape[0], stop-start)) for start, stop in indexes]
+    enveloped = [np.empty((voltages.shape[0], stop-start)) for start, stop in indexes]
+    rows = max(1, block_bytes // (8*sum(high-low for low, high in segments)))
+    for first in range(0, voltages.shape[0], rows):
+        block = slice(first, first+rows)
+        means = np.mean(voltages[block], axis=-1, keepdims=True) # mean of the whole record, as in process_waveforms
+        padded = [apply_bandpass_filter(voltages[block, low:high] - means, cutoffs, order, sampling_rate) for low, high in segments]
+        cores = [segment[:, start-low:stop-low] for segment, (start, stop), (low, high) in zip(padded, indexes, segments)]
+        powered = [raise_to_gain(segment, gain) for segment in padded]
+        powered_cores = [segment[:, start-low:stop-low] for segment, (start, stop), (low, high) in zip(powered, indexes, segments)]
+        # amplify_signal's max_amp*(normalized - mean(normalized)) is max_amp/range*(v**gain - mean(v**gain))
+        max_amp = np.max([np.max(core, axis=-1) for core in cores], axis=0)[:,None]
+        powered_min = np.min([np.min(core, axis=-1) for core in powered_cores], axis=0)[:,None]
+        powered_max = np.max([np.max(core, axis=-1) for core in powered_cores], axis=0)[:,None]
+        # the record outside the gates is taken to add nothing to the sum of v**gain
+        powered_mean = (np.sum([np.sum(core, axis=-1) for core in powered_cores], axis=0) / voltages.shape[-1])[:,None]
+        for gate, (segment, (start, stop), (low, high)) in enumerate(zip(powered, indexes, segments)):
+            envelope = get_envelope(max_amp/(powered_max-powered_min) * (segment - powered_mean))
+            filtered[gate][block] = cores[gate]
+            enveloped[gate][block] = envelope[:, start-low:stop-low]
+    return indexes, filtered, enveloped
 
 
 
@@ -86,3 +442,45 @@ def detect_echo_peaks(time:np.array, voltage:np.array, anterior_limits, posterio
 
 
 
+def detect_echo_peak_stack(time:np.array, envelopes:np.array, anterior_limits, posterior_limits, interpolation:str = "parabolic"):
+    """detect_echo_peaks for a (..., samples) stack of envelopes in one call. The gates are the
+    same samples and the maximum of each gate is the same sample (the first one on a tie).
+    interpolation refines the maximum between the samples with its two neighbours:
+    parabolic: vertex of the parabola through the three samples (time and voltage)
+    centroid: mean time of the three samples weighted by their voltage above the lower neighbour (time only)
+    None: the sample itself. Peaks on the first or last sample of a gate are not refined.
+    Returns the (..., 2) anterior and posterior peak times and voltages."""
+    time = np.asarray(time, dtype=float)
+    envelopes = np.asarray(envelopes)
+    peak_times = np.empty(envelopes.shape[:-1] + (2,))
+    peak_voltages = np.empty(envelopes.shape[:-1] + (2,))
+    for gate, limits in enumerate((anterior_limits, posterior_limits)):
+        start, stop = gate_indexes(time, limits)
+        section = envelopes[..., start:stop]
+        index = np.argmax(section, axis=-1)[..., None]
+        peak = np.take_along_axis(section, index, axis=-1)[..., 0].astype(float)
+        offset = np.zeros(peak.shape)
+        if interpolation and section.shape[-1] >= 3:
+            inner = np.clip(index, 1, section.shape[-1]-2)
+            before, center, after = (np.take_along_axis(section, inner+shift, axis=-1)[..., 0].astype(float) for shift in (-1, 0, 1))
+            refined = (inner == index)[..., 0]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if interpolation == "parabolic":
+                    curvature = before - 2*center + after
+                    refined &= curvature < 0 # a flat top keeps the sample
+                    offset = np.where(refined, 0.5*(before-after)/curvature, 0)
+                    peak = np.where(refined, center - 0.25*(before-after)*offset, peak)
+                elif interpolation == "centroid":
+                    total = before + center + after - 3*np.minimum(before, after)
+                    refined &= total > 0
+                    offset = np.where(refined, (after-before)/total, 0)
+                else:
+                    raise ValueError(f"Unknown peak interpolation <{interpolation}>, use parabolic, centroid or None.")
+        # fractional sample index to time, uniform sampling or not
+        peak_times[..., gate] = np.interp(start + index[..., 0] + offset, np.arange(time.size), time)
+        peak_voltages[..., gate] = peak
+    return peak_times, peak_voltages
+
+
+
+
@@ -0,0 +1,67 @@
+import numpy as np
+import os, csv, time
+from math import comb
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+import signal_processing as sp
+
+
+
+TABLE_COLUMNS = ("shape", "k", "subsets", "exhaustive", "mean_mL", "std_mL", "sem_mL", "converged")
+
+
+
+
+def subset_indexes(n:int, k:int, count:int, rng) -> tuple:
+    """(count', k) position indexes: every k-element subset of n when there are at most count
+    of them, otherwise count random subsets (each without repeated positions).
+    Returns the indexes and whether the subsets are exhaustive."""
+    if not 0 < k <= n:
+        raise ValueError(f"Cannot take {k}-element subsets of {n} positions.")
+    if comb(n, k) <= count:
+        return np.array(list(combinations(range(n), k)), dtype=int).reshape(-1, k), True
+    return np.argpartition(rng.random((count, n)), k-1, axis=1)[:, :k], False
+
+
+
+
+def fit_subsets(anterior:np.array, posterior:np.array, indexes:np.array) -> tuple:
+    """Sphere volumes [mL] and converged flags of the subsets, each subset uses the anterior and
+    posterior coordinates of its k positions (2k coordinates, as k elements on the device)."""
+    coordinate_sets = np.concatenate((anterior[indexes], posterior[indexes]), axis=1)
+    volumes, _, _, converged = sp.calculate_the_sphere_volumes(coordinate_sets)
+    return volumes, converged
+
+
+
+
+def study_subsets(anterior:np.array, posterior:np.array, ks, subsets_per_k:int = 1000, workers:int = None,
+                  batch_size:int = 2000, seed:int = 0, progress=print) -> list:
+    """k-of-n study: for every k, fits subsets_per_k random (or all, if fewer) k-position subsets
+    of the n positions. The subsets are drawn up front from seed and fitted batch_size at a time
+    on a pool of worker processes. Returns one dict per k with the mean, std and SEM of the volumes."""
+    anterior, posterior = np.asarray(anterior, dtype=float), np.asarray(posterior, dtype=float)
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    drawn = [(k,) + subset_indexes(anterior.shape[0], k, subsets_per_k, rng) for k in ks]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = [[pool.submit(fit_subsets, anterior, posterior, indexes[first:first+batch_size])
+                    for first in range(0, indexes.shape[0], batch_size)] for _, indexes, _ in drawn]
+        rows = []
+        for (k, indexes, exhaustive), batches in zip(drawn, futures):
+            volumes, converged = (np.concatenate(parts) for parts in zip(*(future.result() for future in batches)))
+            std = np.std(volumes, ddof=1) if volumes.size > 1 else 0.0
+            rows.append({"k": k, "subsets": volumes.size, "exhaustive": exhaustive, "mean_mL": np.mean(volumes),
+                         "std_mL": std, "sem_mL": std/np.sqrt(volumes.size), "converged": np.count_nonzero(converged)})
+            if progress: progress(f"k = {k}: {volumes.size} subsets, {rows[-1]['mean_mL']:.2f} +/- {std:.2f} mL ({time.perf_counter()-start:.1f} s)")
+    return rows
+
+
+
+
+def write_study_table(table:str, rows:list):
+    """Writes the study rows (with their shape) to a csv table, read by the plotting main.py."""
+    with open(table, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=TABLE_COLUMNS)
+        writer.writeheader()
+        writer.writerows({column: row[column] for column in TABLE_COLUMNS} for row in rows)
@@ -0,0 +1,54 @@
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+from peak_grid import PeakGrid, points_in_polygon
+from signal_processing import tof_to_distance_mm
+
+
+@pytest.fixture
+def grid():
+    # 3 x positions by 2 y positions, the echo times encode the position: 10*x index + y index (+ 100 posterior)
+    x, y = np.array([0., 1.5, 3.]), np.array([10., 11.5])
+    y_index, x_index = np.meshgrid(np.arange(y.size), np.arange(x.size), indexing="ij")
+    peak_times_us = np.stack((20 + 10*x_index + y_index, 120 + 10*x_index + y_index), axis=2)
+    return PeakGrid(x, y, peak_times_us)
+
+
+def positions(coordinates, grid):
+    # (x index, y index) of every coordinate row, in order
+    return [(int(np.flatnonzero(grid.x == x)[0]), int(np.flatnonzero(grid.y == y)[0])) for x, y, _ in coordinates]
+
+
+def test_all_positions_are_listed_x_outer_y_inner(grid):
+    anterior, posterior = grid.all()
+    assert positions(anterior, grid) == [(i, j) for i in range(3) for j in range(2)]
+    assert positions(posterior, grid) == positions(anterior, grid)
+    assert np.allclose(anterior[:,2], tof_to_distance_mm(np.array([20 + 10*i + j for i, j in positions(anterior, grid)])))
+    assert np.allclose(posterior[:,2] - anterior[:,2], tof_to_distance_mm(100))
+
+
+def test_an_index_range_is_the_same_selection_as_its_mask(grid):
+    sliced = grid.select([1, 3], [1, 2])
+    assert positions(sliced[0], grid) == [(1, 1), (2, 1)]
+    mask = np.zeros((2, 3), dtype=bool)
+    mask[1, 1:3] = True # (ny, nx)
+    for selected in (grid.select(mask=mask), grid.select([1, 3], [1, 2], mask=np.ones((2, 3), dtype=bool))):
+        for part, expected in zip(selected, sliced):
+            np.testing.assert_array_equal(part, expected)
+
+
+def test_polygon_selects_the_positions_inside(grid):
+    # an L-shaped region: the whole x = 0 column and the y = 10 row
+    polygon = [(-1, 9), (4, 9), (4, 10.5), (0.5, 10.5), (0.5, 12), (-1, 12)]
+    anterior, posterior = grid.select(polygon=polygon)
+    assert positions(anterior, grid) == [(0, 0), (0, 1), (1, 0), (2, 0)]
+    assert positions(posterior, grid) == positions(anterior, grid)
+    assert positions(grid.select([1, 3], polygon=polygon)[0], grid) == [(1, 0), (2, 0)]
+
+
+def test_points_in_polygon_even_odd():
+    square_with_hole = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0), (1, 1), (1, 3), (3, 3), (3, 1), (1, 1)]
+    inside = points_in_polygon(np.array([0.5, 2, 3.5, 5]), np.array([2, 2, 2, 2]), square_with_hole)
+    assert inside.tolist() == [True, False, True, False]
@@ -0,0 +1,57 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from result_cache import ResultCache, cache_key, file_fingerprint
+
+
+def peak_key(scan_file, anterior_limits=(20, 40), posterior_limits=(100, 130), interpolation=None):
+    # the key of the peak stage in Data.process
+    return cache_key(cache_key([file_fingerprint(scan_file)], [[1.25e6, 3.25e6], 3]), anterior_limits, posterior_limits, interpolation)
+
+
+def test_a_saved_entry_is_a_hit_and_anything_else_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    peak_times_us = np.arange(12.).reshape(2, 3, 2)
+    assert cache.load("peaks", "key") is None
+    cache.save("peaks", "key", peak_times_us=peak_times_us)
+    np.testing.assert_array_equal(cache.load("peaks", "key")["peak_times_us"], peak_times_us)
+    assert cache.load("waveforms", "key") is None # same key, other stage
+    assert ResultCache(str(tmp_path / "cache")).load("peaks", "key") is not None # kept between runs
+    assert not [name for name in os.listdir(tmp_path / "cache") if name.endswith(".tmp")]
+
+
+def test_a_broken_entry_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    with open(cache.path("peaks", "key"), "wb") as file:
+        file.write(b"not an npz")
+    assert cache.load("peaks", "key") is None
+
+
+def test_the_key_changes_with_the_settings_and_the_scan_files(tmp_path):
+    scan_file = str(tmp_path / "scanY000X000.txt")
+    with open(scan_file, "w") as file:
+        file.write("0 0.5\n")
+    key = peak_key(scan_file)
+    assert peak_key(scan_file) == key and peak_key(scan_file, (20, 40), (100, 130)) == key
+    assert peak_key(scan_file, anterior_limits=(20, 41)) != key
+    assert peak_key(scan_file, interpolation="parabolic") != key
+    assert cache_key(np.array([1.0, 2.0])) == cache_key([1.0, 2.0])
+    with open(scan_file, "w") as file:
+        file.write("0 0.5\n1 0.25\n") # the scan is rewritten
+    assert peak_key(scan_file) != key
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 40)
+    for index, key in enumerate(("a", "b", "c")):
+        cache.save("peaks", key, values=np.zeros(1000))
+        os.utime(cache.path("peaks", key), ns=(index+1, index+1)) # a used first, c last
+    size = os.path.getsize(cache.path("peaks", "a"))
+    cache.max_bytes = 3*size + size//2
+    assert cache.load("peaks", "a") is not None # a is now the most recently used
+    cache.save("peaks", "d", values=np.ones(1000))
+    assert [key for key in "abcd" if os.path.isfile(cache.path("peaks", key))] == ["a", "c", "d"]
+    cache.max_bytes = size//2 # the entry just saved is kept even above the limit
+    cache.save("peaks", "e", values=np.ones(1000))
+    assert os.listdir(tmp_path) == [os.path.basename(cache.path("peaks", "e"))]
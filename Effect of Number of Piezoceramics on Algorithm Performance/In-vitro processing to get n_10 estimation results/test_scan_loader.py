@@ -0,0 +1,56 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from scan_loader import load_scan, read_waveform
+from waveform_store import WaveformStore
+
+
+def write_scan(folder, x_count=4, y_count=3, samples=50):
+    # raw files of a scan, y outer and x inner as Data.raw_filenames lists them: 81 header lines,
+    # then time [s] and voltage [V] columns, the voltage encodes the position
+    time_s = np.arange(samples) * 4e-8
+    filenames = []
+    for y_index in range(y_count):
+        for x_index in range(x_count):
+            filename = os.path.join(folder, f"scanY{y_index:0>3}X{x_index:0>3}.txt")
+            volt_V = np.sin(time_s*1e7 + x_index) * (y_index + 1)
+            np.savetxt(filename, np.column_stack((time_s, volt_V)), header="\n".join(["header"]*81), comments="")
+            filenames.append(filename)
+    return filenames
+
+
+def test_parallel_loading_matches_the_serial_reads(tmp_path):
+    filenames = write_scan(str(tmp_path))
+    messages = []
+    loaded = list(load_scan(filenames, workers=2, chunk_size=5, progress=messages.append)) # chunks of 5, 5 and 2
+    serial = [read_waveform(filename) for filename in filenames]
+    assert len(loaded) == len(serial)
+    for (time_s, volt_V), (serial_time_s, serial_volt_V) in zip(loaded, serial):
+        np.testing.assert_array_equal(time_s, serial_time_s)
+        np.testing.assert_array_equal(volt_V, serial_volt_V)
+    assert [message.split(" (")[0] for message in messages] == ["Loaded 5/12 files", "Loaded 10/12 files", "Loaded 12/12 files"]
+
+
+def test_the_loaded_scan_fills_the_store_in_position_order(tmp_path):
+    filenames = write_scan(str(tmp_path))
+    times_s, volts_V = zip(*load_scan(filenames, workers=3, chunk_size=1, progress=None))
+    store = WaveformStore(times_s[0], 3, 4)
+    filtered, enveloped = store.stacks()
+    filtered[:], enveloped[:] = np.array(volts_V), np.abs(volts_V)
+    for y_index in range(3):
+        for x_index in range(4):
+            _, volt_V = read_waveform(filenames[4*y_index + x_index])
+            time_us, filtered_V, enveloped_V = store.waveform(x_index, y_index)
+            np.testing.assert_array_equal(filtered_V, volt_V)
+            np.testing.assert_array_equal(enveloped_V, np.abs(volt_V))
+    np.testing.assert_allclose(store.time_us, times_s[0]*1e6)
+
+
+def test_unreadable_values_are_read_as_nan(tmp_path):
+    filename = str(tmp_path / "scanY000X000.txt")
+    with open(filename, "w") as file:
+        file.write("header\n"*81 + "0 0.5\n4e-08 0.25\n8e-08 ---\n")
+    time_s, volt_V = read_waveform(filename)
+    np.testing.assert_array_equal(time_s, [0, 4e-8, 8e-8])
+    assert volt_V[:2].tolist() == [0.5, 0.25] and np.isnan(volt_V[2])
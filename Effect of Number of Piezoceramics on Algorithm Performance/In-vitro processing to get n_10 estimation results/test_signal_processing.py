@@ -0,0 +1,149 @@
+import importlib.util, os
+import numpy as np
+import pytest
+
+
+def load(name):
+    # the folders share module names, so the module next to this file is loaded by path
+    spec = importlib.util.spec_from_file_location(f"n10_{name}", os.path.join(os.path.dirname(__file__), f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+sp = load("signal_processing")
+
+SAMPLE_US = 0.04 # the peaks are found on whole samples of the 25 MHz records
+
+
+def scan(center, r, x=np.arange(-9.5, 10), y=np.arange(-9.5, 10), shifted={}):
+    # anterior and posterior coordinates of the scan positions above a sphere, x outer and y inner as
+    # PeakGrid.all() lists them, depths from whole-sample peak times. shifted: {(position, 0 or 1): us}
+    x_grid, y_grid = np.meshgrid(x, y, indexing="ij")
+    xy = np.column_stack((x_grid.ravel(), y_grid.ravel()))
+    depth = r**2 - np.sum((xy - center[:2])**2, axis=1)
+    xy, half = xy[depth > 0], np.sqrt(depth[depth > 0])
+    walls = []
+    for wall, z in enumerate((center[2]-half, center[2]+half)):
+        time_us = 2*z / 1.48 + np.array([shifted.get((position, wall), 0) for position in range(z.size)])
+        walls.append(np.column_stack((xy, sp.tof_to_distance_mm(np.round(time_us/SAMPLE_US)*SAMPLE_US))))
+    return walls
+
+
+def random_scan(rng):
+    r = rng.uniform(25, 45)
+    return scan(np.array([*rng.uniform(-3, 3, 2), r + rng.uniform(10, 30)]), r)
+
+
+def subsets(anterior, posterior, k, count, rng):
+    # (count, 2k, 3) coordinates of k random positions each, as subset_study.fit_subsets takes them
+    indexes = np.argsort(rng.random((count, anterior.shape[0])), axis=1)[:, :k]
+    return np.concatenate((anterior[indexes], posterior[indexes]), axis=1)
+
+
+@pytest.mark.parametrize("k", [2, 3, 4, 6, 10])
+def test_algebraic_matches_minimize(k):
+    rng = np.random.default_rng(k)
+    for _ in range(5):
+        for coordinates in subsets(*random_scan(rng), k, 10, rng):
+            volume = sp.calculate_the_sphere_volume(coordinates)[0]
+            assert volume == pytest.approx(sp.calculate_the_sphere_volume(coordinates, "minimize")[0], rel=1e-4)
+
+
+def test_one_scan_line_falls_back_to_minimize():
+    anterior, posterior = scan(np.array([1, 2, 60]), 35, y=[0.5]) # coplanar walls
+    coordinates = np.concatenate((anterior, posterior))
+    volume = sp.calculate_the_sphere_volume(coordinates)[0]
+    assert volume == pytest.approx(sp.calculate_the_sphere_volume(coordinates, "minimize")[0])
+
+
+def test_a_center_outside_the_bounds_falls_back_to_minimize():
+    # the scan covers the side of the sphere, its center x = 25 is outside the (-15, 15) bound
+    coordinates = np.concatenate(scan(np.array([25, 0, 60]), 40))
+    volume, r, center = sp.calculate_the_sphere_volume(coordinates)
+    assert volume == pytest.approx(sp.calculate_the_sphere_volume(coordinates, "minimize")[0])
+    assert center[0] == pytest.approx(15)
+
+
+def test_batch_matches_per_set_fit():
+    rng = np.random.default_rng(1)
+    anterior, posterior = random_scan(rng)
+    sets = [coordinates for k in (2, 3, 5, 10) for coordinates in subsets(anterior, posterior, k, 20, rng)]
+    sets.append(np.concatenate(scan(np.array([25, 0, 60]), 40))) # center outside the bounds
+    volumes, radii, centers, converged = sp.calculate_the_sphere_volumes(sets) # ragged list, padded and masked inside
+    for coordinates, volume in zip(sets, volumes):
+        assert volume == pytest.approx(sp.calculate_the_sphere_volume(coordinates)[0], rel=1e-9)
+    assert not np.any(converged[:20]) and not converged[-1] # the walls of two positions are coplanar
+    assert np.all(converged[40:-1]) # 5 and 10 positions
+    stacked = subsets(anterior, posterior, 6, 50, rng) # one k, an array as fit_subsets passes it
+    np.testing.assert_allclose(sp.calculate_the_sphere_volumes(stacked)[0], [sp.calculate_the_sphere_volume(c)[0] for c in stacked], rtol=1e-9)
+
+
+def test_batch_ignores_the_padded_rows():
+    rng = np.random.default_rng(2)
+    anterior, posterior = random_scan(rng)
+    sets = [coordinates for k in (4, 7, 10) for coordinates in subsets(anterior, posterior, k, 5, rng)]
+    padded = np.full((len(sets), 23, 3), 1e3) # garbage in the padding
+    mask = np.zeros((len(sets), 23), dtype=bool)
+    for index, coordinates in enumerate(sets):
+        padded[index, :coordinates.shape[0]] = coordinates
+        mask[index, :coordinates.shape[0]] = True
+    np.testing.assert_allclose(sp.calculate_the_sphere_volumes(padded, mask)[0], sp.calculate_the_sphere_volumes(sets)[0], rtol=1e-9)
+
+
+def test_ransac_rejects_a_reverberation():
+    center, r = np.array([1, -1, 60]), 40
+    anterior, posterior = scan(center, r, shifted={(57, 1): 10}) # a late posterior peak at one position
+    coordinates = np.concatenate((anterior, posterior))
+    info = {}
+    volume = sp.calculate_the_sphere_volume(coordinates, "ransac", info=info)[0]
+    assert info["rejected"].tolist() == [anterior.shape[0] + 57]
+    truth = 4/3*np.pi*r**3/1000
+    assert abs(volume - truth) < abs(sp.calculate_the_sphere_volume(coordinates)[0] - truth)
+
+
+def test_ransac_small_and_coplanar_sets_get_the_minimize_result():
+    anterior, posterior = scan(np.array([1, 2, 60]), 35, y=[0.5])
+    line = np.concatenate((anterior, posterior)) # coplanar
+    two = np.concatenate((anterior[[3, 9]], posterior[[3, 9]]))
+    two[0,2] += 5 # an outlier the 3 others cannot outvote
+    for coordinates in (line, two):
+        volume = sp.calculate_the_sphere_volume(coordinates, "ransac")[0]
+        assert volume == pytest.approx(sp.calculate_the_sphere_volume(coordinates, "minimize")[0], rel=1e-4)
+
+
+def ellipsoid(rng, center, axes, rotation, n=200, noise=0.0):
+    # points on the ellipsoid surface, rotation columns are the directions of the axes
+    directions = rng.normal(size=(n, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:,None]
+    return (directions*axes) @ np.transpose(rotation) + center + rng.normal(0, noise, (n, 3))
+
+
+def rotation_matrix(yaw, pitch, roll):
+    cz, sz, cy, sy, cx, sx = np.cos(yaw), np.sin(yaw), np.cos(pitch), np.sin(pitch), np.cos(roll), np.sin(roll)
+    return np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]) @ np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]) \
+           @ np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+
+
+@pytest.mark.parametrize("noise", [0.0, 0.05])
+def test_oriented_ellipsoid_fit_recovers_the_axes_and_rotation(noise):
+    rng = np.random.default_rng(4)
+    center, axes, rotation = np.array([3., -2., 70.]), np.array([40., 25., 15.]), rotation_matrix(0.5, 0.3, -0.4)
+    fitted_center, fitted_axes, fitted_rotation = sp.Ellipsoid_fit_algebraic(ellipsoid(rng, center, axes, rotation, noise=noise), oriented=True)
+    tolerance = 1e-6 if noise == 0 else 0.05
+    np.testing.assert_allclose(fitted_center, center, atol=tolerance)
+    order = np.argsort(-fitted_axes) # the fitted axes come in no fixed order
+    np.testing.assert_allclose(fitted_axes[order], axes, atol=tolerance)
+    alignment = np.abs(np.sum(fitted_rotation[:,order] * rotation, axis=0)) # |cos| of the angle between matching axes
+    np.testing.assert_allclose(alignment, 1, atol=tolerance/10)
+    volume = sp.calculate_the_ellipsoid_volume(ellipsoid(rng, center, axes, rotation), oriented=True)[0]
+    assert volume == pytest.approx(4/3*np.pi*40*25*15/1000)
+
+
+def test_axis_aligned_ellipsoid_fit_keeps_the_axes_in_xyz_order():
+    rng = np.random.default_rng(5)
+    center, axes = np.array([-4., 6., 55.]), np.array([15., 40., 25.])
+    fitted_center, fitted_axes, rotation = sp.Ellipsoid_fit_algebraic(ellipsoid(rng, center, axes, np.eye(3)))
+    np.testing.assert_allclose(fitted_center, center, atol=1e-6)
+    np.testing.assert_allclose(fitted_axes, axes, atol=1e-6)
+    np.testing.assert_array_equal(rotation, np.eye(3))
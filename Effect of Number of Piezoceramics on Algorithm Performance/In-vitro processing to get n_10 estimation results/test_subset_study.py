@@ -0,0 +1,56 @@
+import os, sys, csv
+from math import comb
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+from subset_study import subset_indexes, fit_subsets, study_subsets, write_study_table, TABLE_COLUMNS
+
+
+def walls(rng, n=12, center=(2, -1, 80), r=40):
+    # anterior and posterior wall coordinates of a sphere at n scan positions, with noise
+    xy = rng.uniform(-12, 12, (n, 2))
+    half = np.sqrt(r**2 - np.sum((xy - center[:2])**2, axis=1))
+    anterior = np.column_stack((xy, center[2] - half + rng.normal(0, 0.3, n)))
+    posterior = np.column_stack((xy, center[2] + half + rng.normal(0, 0.3, n)))
+    return anterior, posterior
+
+
+def test_few_subsets_are_all_taken():
+    indexes, exhaustive = subset_indexes(5, 3, 10, np.random.default_rng(0))
+    assert exhaustive and indexes.shape == (comb(5, 3), 3)
+    assert len({tuple(row) for row in indexes}) == comb(5, 3)
+
+
+def test_many_subsets_are_drawn_without_repeated_positions():
+    indexes, exhaustive = subset_indexes(12, 4, 300, np.random.default_rng(0))
+    assert not exhaustive and indexes.shape == (300, 4)
+    assert all(len(set(row)) == 4 for row in indexes) and indexes.min() >= 0 and indexes.max() < 12
+    with pytest.raises(ValueError):
+        subset_indexes(12, 13, 10, np.random.default_rng(0))
+
+
+def test_table_rows_summarize_the_subset_volumes():
+    anterior, posterior = walls(np.random.default_rng(1))
+    rows = study_subsets(anterior, posterior, [4, 11, 12], subsets_per_k=50, workers=2, batch_size=16, seed=3, progress=None)
+    assert [(row["k"], row["subsets"], row["exhaustive"]) for row in rows] == [(4, 50, False), (11, 12, True), (12, 1, True)]
+    rng = np.random.default_rng(3) # the same draws, fitted here in one batch
+    for row in rows:
+        volumes, converged = fit_subsets(anterior, posterior, subset_indexes(12, row["k"], 50, rng)[0])
+        assert row["mean_mL"] == pytest.approx(np.mean(volumes))
+        assert row["std_mL"] == pytest.approx(np.std(volumes, ddof=1) if volumes.size > 1 else 0)
+        assert row["sem_mL"] == pytest.approx(row["std_mL"]/np.sqrt(volumes.size))
+        assert row["converged"] == np.count_nonzero(converged)
+    assert rows[-1]["mean_mL"] == pytest.approx(4/3*np.pi*40**3/1000, rel=0.05)
+
+
+def test_table_is_written_with_the_shape_of_every_row(tmp_path):
+    anterior, posterior = walls(np.random.default_rng(2))
+    rows = [dict(row, shape="spherical") for row in study_subsets(anterior, posterior, [5, 6], 20, workers=1, progress=None)]
+    table = str(tmp_path / "n_10 estimation results.csv")
+    write_study_table(table, rows)
+    with open(table, newline="") as file:
+        read = list(csv.DictReader(file))
+    assert tuple(read[0]) == TABLE_COLUMNS
+    assert [(line["shape"], int(line["k"]), int(line["subsets"])) for line in read] == [("spherical", 5, 20), ("spherical", 6, 20)]
+    assert [float(line["mean_mL"]) for line in read] == pytest.approx([row["mean_mL"] for row in rows])
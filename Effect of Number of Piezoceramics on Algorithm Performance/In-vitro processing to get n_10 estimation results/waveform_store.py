@@ -0,0 +1,36 @@
+import numpy as np
+
+
+
+class WaveformStore():
+    """Filtered and enveloped waveforms of a whole scan.
+    One time axis [us] is shared by every position and the waveforms [mV] are kept in
+    (ny, nx, nsamples) arrays, float64 or float32 (half the memory, ~7 significant digits)."""
+
+    def __init__(self, time_s:np.array, y_count:int, x_count:int, dtype="float64"):
+        self.time_us = np.asarray(time_s, dtype=float)*1e6 # float64 either way, the peak times are read from it
+        self.dtype = np.dtype(dtype)
+        self.filtered_mV = np.empty((y_count, x_count, self.time_us.size), self.dtype)
+        self.enveloped_mV = np.empty((y_count, x_count, self.time_us.size), self.dtype)
+
+
+    def stacks(self):
+        """(ny*nx, nsamples) views of the filtered and enveloped arrays, y outer and x inner,
+        to be filled by sp.process_waveforms and then scaled to mV with to_millivolts()."""
+        return self.filtered_mV.reshape(-1, self.time_us.size), self.enveloped_mV.reshape(-1, self.time_us.size)
+
+
+    def to_millivolts(self):
+        """Scales the stored volts to millivolts, in place."""
+        self.filtered_mV *= 1e3
+        self.enveloped_mV *= 1e3
+
+
+    def waveform(self, x_index:int, y_index:int):
+        """(time_us, filtered_mV, enveloped_mV) of one position, the waveforms are views."""
+        return self.time_us, self.filtered_mV[y_index, x_index], self.enveloped_mV[y_index, x_index]
+
+
+    @property
+    def nbytes(self) -> int:
+        return self.time_us.nbytes + self.filtered_mV.nbytes + self.enveloped_mV.nbytes
@@ -4,21 +4,36 @@ import matplotlib.pyplot as plt
 import os 
 
 
+STUDY_TABLE = "n_10 estimation results.csv" # written by the subset study of the n_10 processing code
+ERROR_COLUMN = "sem_mL" # or "std_mL"
+
+
+def read_study_table(table, shape):
+    """k, mean and error of one flask shape from the subset study table."""
+    df = pd.read_csv(table)
+    df = df[df["shape"] == shape].sort_values("k")
+    return df["k"].to_numpy(), df["mean_mL"].to_numpy(), df[ERROR_COLUMN].to_numpy()
+
+
 def main():
     os.system("cls")
     
-    excel_filename = "n_10 estimation results.xlsx"
-    
-    df = pd.read_excel(excel_filename)
+    if os.path.isfile(STUDY_TABLE):
+        x_axis, sphere_means, sphere_errors = read_study_table(STUDY_TABLE, "spherical")
+        _, ellipse_means, ellipse_errors = read_study_table(STUDY_TABLE, "ellipsoid")
+    else:
+        excel_filename = "n_10 estimation results.xlsx"
+        
+        df = pd.read_excel(excel_filename)
 
-    # all values in mL
-    sphere_means = np.asarray([df.iloc[22, 1], df.iloc[22, 5], df.iloc[22, 9], df.iloc[22, 13], df.iloc[51, 1], df.iloc[51, 5], df.iloc[51, 9]])
-    sphere_errors = np.asarray([df.iloc[24, 1], df.iloc[24, 5], df.iloc[24, 9], df.iloc[24, 13], df.iloc[53, 1], df.iloc[53, 5], df.iloc[53, 9]])
-    
-    ellipse_means = [df.iloc[22, 2], df.iloc[22, 6], df.iloc[22, 10], df.iloc[22, 14], df.iloc[51, 2], df.iloc[51, 6], df.iloc[51, 10]]
-    ellipse_errors = [df.iloc[24, 2], df.iloc[24, 6], df.iloc[24, 10], df.iloc[24, 14], df.iloc[53, 2], df.iloc[53, 6], df.iloc[53, 10]]
-    
-    x_axis = [4,5,6,7,8,9,10]
+        # all values in mL
+        sphere_means = np.asarray([df.iloc[22, 1], df.iloc[22, 5], df.iloc[22, 9], df.iloc[22, 13], df.iloc[51, 1], df.iloc[51, 5], df.iloc[51, 9]])
+        sphere_errors = np.asarray([df.iloc[24, 1], df.iloc[24, 5], df.iloc[24, 9], df.iloc[24, 13], df.iloc[53, 1], df.iloc[53, 5], df.iloc[53, 9]])
+        
+        ellipse_means = [df.iloc[22, 2], df.iloc[22, 6], df.iloc[22, 10], df.iloc[22, 14], df.iloc[51, 2], df.iloc[51, 6], df.iloc[51, 10]]
+        ellipse_errors = [df.iloc[24, 2], df.iloc[24, 6], df.iloc[24, 10], df.iloc[24, 14], df.iloc[53, 2], df.iloc[53, 6], df.iloc[53, 10]]
+        
+        x_axis = [4,5,6,7,8,9,10]
     
     plt.figure()
     # plt.title("Effect of number of coordinates on spherical fitting algorithm performance\n(spherical-shaped round-bottom flask)")
@@ -16,125 +16,330 @@ def Sphere_func(parameters : np.array, coordinates: np.array) -> float:
     return np.sum((np.sqrt((x-x0)**2 + (y-y0)**2 + (z-z0)**2) - r)**2) 
 
 ##############################################################################
-def calculate_the_volume(coordinates: np.array) -> float:
-    # input coordinates: columns are x, y and z. Returns the volume
+def Sphere_fit_minimize(coordinates: np.array, bounds: list, info: dict = None) -> np.array:
+    # The scipy fit of Sphere_func, from the mean of the coordinates with
+    # r = 50. info: if given, info['iterations'] is set to the optimizer
+    # iterations
     x, y, z = np.transpose(coordinates)
     initial_guess = np.array([np.mean(x), np.mean(y), np.mean(z), 50]) # np.std(x) as r
+    best_fit_sphere = minimize(Sphere_func, initial_guess, coordinates, bounds=bounds)
+    if info is not None:
+        info['iterations'] = best_fit_sphere.nit
+    return best_fit_sphere.x
+
+##############################################################################
+def Sphere_fit_algebraic(coordinates: np.array, bounds: list, refine_steps: int = 10, info: dict = None,
+                         max_condition: float = 1e6) -> np.array:
+    # Closed-form sphere fit. |p|^2 = 2*p.c + (r^2 - |c|^2) is linear in
+    # (x0, y0, z0, r^2 - |c|^2), so one linear least squares gives the sphere,
+    # then a few Gauss-Newton steps on Sphere_func's residuals (analytic
+    # Jacobian) refine it. The closed form needs coordinates that pin a sphere
+    # down and an optimum inside the bounds: if the [2p, 1] design matrix is
+    # rank deficient or its condition number is above max_condition (coplanar
+    # sets, e.g. two transducer columns), if the steps do not converge or if
+    # the result is on or outside a bound, Sphere_fit_minimize's result is
+    # returned instead.
+    # info: if given, info['iterations'] is set to the Gauss-Newton steps taken
+    # (the optimizer iterations after a fallback) and info['fallback'] to
+    # whether Sphere_fit_minimize was used
+    coordinates = np.asarray(coordinates, dtype=float)
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    mean = np.mean(coordinates, axis=0) # centered, so the condition number does not depend on the position
+    A = np.column_stack((2*(coordinates - mean), np.ones(coordinates.shape[0])))
+    singular_values = np.linalg.svd(A, compute_uv=False)
+    if singular_values.size == 4 and singular_values[-1]*max_condition > singular_values[0]:
+        solution = np.linalg.lstsq(A, np.sum((coordinates - mean)**2, axis=1), rcond=None)[0]
+        center = solution[:3] + mean
+        # for a fixed center the best radius is the mean distance
+        parameters = np.append(center, np.mean(np.linalg.norm(coordinates - center, axis=1)))
+
+        for iterations in range(1, refine_steps+1):
+            diff = coordinates - parameters[:3]
+            dist = np.maximum(np.sqrt(np.sum(diff**2, axis=1)), 1e-12)
+            residuals = dist - parameters[3]
+            jacobian = np.empty((dist.size, 4))
+            jacobian[:,:3] = -diff/dist[:,None]
+            jacobian[:,3] = -1
+            step = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+            parameters = parameters + step
+            if np.max(np.abs(step)) < 1e-6:
+                if np.all((parameters > lower) & (parameters < upper)):
+                    if info is not None:
+                        info['iterations'], info['fallback'] = iterations, False
+                    return parameters
+                break
+    if info is not None:
+        info['fallback'] = True
+    return Sphere_fit_minimize(coordinates, bounds, info)
+
+##############################################################################
+def Sphere_fit_batch(coordinate_sets, bounds: list, mask: np.array = None, refine_steps: int = 10, tolerance: float = 1e-6,
+                     max_condition: float = 1e6):
+    # Sphere_fit_algebraic for many coordinate sets at once, vectorized over
+    # the sets. coordinate_sets: (B,N,3) array padded to the longest set with
+    # mask (B,N) marking the real rows, or a list of (n_i,3) arrays.
+    # Returns parameters (B,4) as (x0, y0, z0, r) and converged (B,): the
+    # vectorized Gauss-Newton steps fell below tolerance inside the bounds.
+    # The sets that did not (rank deficient or ill-conditioned, not converged
+    # or on a bound) are fitted again one at a time with Sphere_fit_algebraic,
+    # so every row is the per-set result.
+    if len(coordinate_sets) == 0:
+        return np.empty((0, 4)), np.empty(0, dtype=bool)
+    if mask is None and not isinstance(coordinate_sets, np.ndarray):
+        sizes = [len(c) for c in coordinate_sets]
+        mask = np.arange(max(sizes))[None,:] < np.array(sizes)[:,None]
+        padded = np.zeros(mask.shape + (3,))
+        padded[mask] = np.concatenate([np.asarray(c, dtype=float).reshape(-1, 3) for c in coordinate_sets])
+        coordinate_sets = padded
+    coordinates = np.asarray(coordinate_sets, dtype=float)
+    weights = np.ones(coordinates.shape[:2]) if mask is None else np.asarray(mask, dtype=float)
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    count = np.maximum(weights.sum(axis=1), 1)
+
+    def solve(normal, rhs, solvable):
+        # batched 4x4 solves, the sets that are not solvable get the identity instead
+        normal = np.where(solvable[:,None,None], normal, np.eye(4))
+        return np.linalg.solve(normal, rhs[...,None])[...,0]
+
+    # closed-form solution on the normal equations, around each set's mean;
+    # the padded rows are zero and change neither the solution nor the singular values
+    mean = np.sum(coordinates*weights[...,None], axis=1) / count[:,None]
+    centered = (coordinates - mean[:,None,:]) * weights[...,None]
+    A = np.concatenate((2*centered, weights[...,None]), axis=2)
+    b = np.sum(centered**2, axis=2)
+    singular_values = np.linalg.svd(A, compute_uv=False)
+    if singular_values.shape[1] == 4: # the same test as Sphere_fit_algebraic's
+        solvable = singular_values[:,-1]*max_condition > singular_values[:,0]
+    else:
+        solvable = np.zeros(A.shape[0], dtype=bool)
+    At = A.transpose(0,2,1)
+    solution = solve(At @ A, (At @ b[...,None])[...,0], solvable)
+    center = solution[:,:3] + mean
+    # for a fixed center the best radius is the mean distance
+    r = np.sum(np.linalg.norm(coordinates - center[:,None,:], axis=2)*weights, axis=1) / count
+    parameters = np.column_stack((center, r))
+
+    converged = np.zeros(parameters.shape[0], dtype=bool)
+    for _ in range(refine_steps):
+        diff = coordinates - parameters[:,None,:3]
+        dist = np.maximum(np.linalg.norm(diff, axis=2), 1e-12)
+        residuals = (dist - parameters[:,None,3]) * weights
+        jacobian = np.concatenate((-diff/dist[...,None], -np.ones(dist.shape + (1,))), axis=2) * weights[...,None]
+        Jt = jacobian.transpose(0,2,1)
+        normal = Jt @ jacobian
+        eigenvalues = np.linalg.eigvalsh(normal)
+        solvable &= eigenvalues[:,0]*max_condition**2 > eigenvalues[:,-1]
+        step = solve(normal, -(Jt @ residuals[...,None])[...,0], solvable)
+        step[converged | ~solvable] = 0
+        parameters = parameters + step
+        converged |= solvable & (np.max(np.abs(step), axis=1) < tolerance)
+        if np.all(converged | ~solvable):
+            break
+
+    # the others are fitted one at a time, falling back to minimize where needed
+    converged &= solvable & np.all((parameters > lower) & (parameters < upper), axis=1)
+    for index in np.flatnonzero(~converged):
+        parameters[index] = Sphere_fit_algebraic(coordinates[index][weights[index] > 0], bounds)
+    return parameters, converged
+
+##############################################################################
+def calculate_the_volume(coordinates: np.array, method: str = "algebraic", info: dict = None) -> float:
+    # input coordinates: columns are x, y and z. Returns the volume
+    # method: "algebraic" (closed-form + Gauss-Newton, minimize for the sets it
+    # cannot fit, see Sphere_fit_algebraic) or "minimize" (scipy)
+    # info: if given, info['iterations'] is set to the optimizer iterations
     r_limit = (1e6*(3/4)/np.pi)**(1/3)
-    best_fit_sphere = minimize(Sphere_func, initial_guess, coordinates, bounds=[(-20,20), (-20,20), (5,170), (5, r_limit)])
-    x0, y0, z0, r = best_fit_sphere.x
+    bounds = [(-20,20), (-20,20), (5,170), (5, r_limit)]
+    if method == "algebraic":
+        x0, y0, z0, r = Sphere_fit_algebraic(coordinates, bounds, info=info)
+    else:
+        x0, y0, z0, r = Sphere_fit_minimize(coordinates, bounds, info)
     return 4/3 * np.pi * r**3 / 1000, r, (np.round(x0,2),np.round(y0,2),np.round(z0,2))
 
 ##############################################################################
-def noise_free(masked_data: np.array) -> np.array:
-    CLOCK_PERIOD = 0.7 # normally it is 0.5 microseconds, set to 0.7 to be safe
-    #   Input array is the timestamp array containing the timestamps within the
-    #   upper and lower bounds. But, to be counted as a legitimate echo timestamp,
-    #   there needs to be at least two timestamps within a time interval, equal to
-    #   the clock period. If a timestamp is alone then that timestamp will be disregarded.
-
-    #   mask1: element True, if following element is within CLOCK_PERIOD
-    mask1 = np.append(np.abs(masked_data[:-1]-masked_data[1:]) < CLOCK_PERIOD, False)
-    #   mask2: element True, if previous element is within CLOCK_PERIOD
-    mask2 = np.insert(np.abs(masked_data[1:]-masked_data[:-1]) < CLOCK_PERIOD, 0, False)
-    combined_mask = mask1 | mask2
-
-    #combined_mask = np.zeros(masked_data.size)
-    #for j in range(masked_data.size):
-    #    differences = np.abs(masked_data - masked_data[j])
-    #    combined_mask[j] = np.any((differences > 0.3) & (differences < 0.7))
-    
-    return masked_data[combined_mask]
-    #return masked_data
+def calculate_the_volumes(coordinate_sets, mask: np.array = None) -> tuple:
+    # calculate_the_volume for many coordinate sets at once, see Sphere_fit_batch.
+    # Returns volumes [mL], radii [mm], centers (B,3) [mm] and converged flags.
+    r_limit = (1e6*(3/4)/np.pi)**(1/3)
+    bounds = [(-20,20), (-20,20), (5,170), (5, r_limit)]
+    parameters, converged = Sphere_fit_batch(coordinate_sets, bounds, mask)
+    r = parameters[:,3]
+    return 4/3 * np.pi * r**3 / 1000, r, parameters[:,:3], converged
 
 ##############################################################################
-def evaluate_data(data: dict, ants, posts, strats) -> dict:
-    # # lower and upper bounds for wall locations [us]
-    ant_lim_low = ants[0]
-    ant_lim_high = ants[1]
-    post_lim_low = posts[0]
-    post_lim_high = posts[1]
+class TransducerLayout:
+    # Positions [mm] of the transducers in the array plane, keyed by piezo
+    # number. group() sorts the records once by transducer, so the grouping
+    # cost does not grow with the number of elements.
 
+    def __init__(self, positions: dict):
+        self.numbers = np.array(sorted(positions), dtype=int)
+        self.xy = np.array([positions[n] for n in self.numbers], dtype=float)
 
-    refined_data = {'1':np.empty(0) , '2':np.empty(0) , '3':np.empty(0) , '4':np.empty(0)}
-    
-    data_is_enough = False
-    counter = 0
-    for key in data.keys():
-        ant_mask = (data[key]>ant_lim_low) & (data[key]<ant_lim_high)
-        post_mask = (data[key]>post_lim_low) & (data[key]<post_lim_high)
-        anteriors = data[key] [ant_mask] # within bounds
-        posteriors = data[key] [post_mask] # within bounds
-
-        # print(f'Transducer {key} - anteriors: {anteriors}')
-        # print(f'Transducer {key} - posteriors: {posteriors}\n\n')
-        
-        # ANTERIOR STRATEGY
-        if anteriors.size > 0:
-            noise_free_anteriors = noise_free(anteriors) # eliminate noise peaks
-            if noise_free_anteriors.size > 0:
-                counter += 1
-                if strats[0]=="min":
-                    refined_data[key] = np.append(refined_data[key],np.min(noise_free_anteriors))
-                elif strats[0]=="mean":
-                    refined_data[key] = np.append(refined_data[key],np.mean(noise_free_anteriors))
-                elif strats[0]=="max":
-                    refined_data[key] = np.append(refined_data[key],np.max(noise_free_anteriors))
-
-        # POSTERIOR STRATEGY
-        if posteriors.size > 0:
-            noise_free_posteriors = noise_free(posteriors)
-            if noise_free_posteriors.size > 0:
-                counter += 1
-                if strats[1]=="min":
-                    refined_data[key] = np.append(refined_data[key],np.min(noise_free_posteriors))
-                elif strats[1]=="mean":
-                    refined_data[key] = np.append(refined_data[key],np.mean(noise_free_posteriors))
-                elif strats[1]=="max":
-                    refined_data[key] = np.append(refined_data[key],np.max(noise_free_posteriors)) 
-  
-  
-  
-        # FUTURE WORK: Here, anterior and posterior timestamps can be seperated!
-    if counter >= 4: data_is_enough = True
-    return data_is_enough, refined_data
+    @classmethod
+    def grid(cls, columns: int, rows: int, pitch: float = 13):
+        # piezo 1 at the origin, numbered along x first: the 2x2 array is
+        # 1:(0,0) 2:(13,0) 3:(0,13) 4:(13,13)
+        return cls({1 + i + columns*j: (i*pitch, j*pitch) for j in range(rows) for i in range(columns)})
+
+    def __len__(self):
+        return self.numbers.size
+
+    def keys(self) -> list:
+        return [str(n) for n in self.numbers]
 
+    def group(self, piezonumbers: np.array, timestamps: np.array):
+        # Returns (grouped, offsets): the timestamps of transducer i are
+        # grouped[offsets[i]:offsets[i+1]], in recording order. Records of
+        # unknown piezo numbers are dropped.
+        n = len(self)
+        index = np.searchsorted(self.numbers, piezonumbers)
+        known = self.numbers[np.minimum(index, n-1)] == piezonumbers
+        index = np.where(known, index, n).astype(np.uint16) # stable sort of small ints is a radix sort
+        order = np.argsort(index, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(index, minlength=n+1)[:n])))
+        return np.asarray(timestamps)[order[:offsets[-1]]], offsets
+
+    def split(self, piezonumbers: np.array, timestamps: np.array) -> dict:
+        # {'1': timestamps of piezo 1, ...}, views into one grouped array
+        grouped, offsets = self.group(piezonumbers, timestamps)
+        return {key: grouped[offsets[i]:offsets[i+1]] for i, key in enumerate(self.keys())}
+
+    def position(self, key) -> np.array:
+        return self.xy[np.searchsorted(self.numbers, int(key))]
+
+DEFAULT_LAYOUT = TransducerLayout.grid(2, 2, 13)
 
 ##############################################################################
+def segment_reduce(values: np.array, starts: np.array, counts: np.array, strategy) -> np.array:
+    # Reduces the consecutive segments values[starts[i]:starts[i]+counts[i]]
+    # (all counts > 0) with strategy: "min", "mean", "max", "median",
+    # "trimmed_mean" (10% cut from each end), ("trimmed_mean", proportion) or
+    # any function of a 1D array.
+    if strategy == "min":
+        return np.minimum.reduceat(values, starts)
+    if strategy == "max":
+        return np.maximum.reduceat(values, starts)
+    if strategy == "mean":
+        return np.add.reduceat(values, starts) / counts
+    if callable(strategy):
+        return np.array([strategy(values[s:s+c]) for s, c in zip(starts, counts)], dtype=float)
+    # order statistics: sort inside every segment
+    segment = np.repeat(np.arange(starts.size), counts)
+    values = values[np.lexsort((values, segment))]
+    if strategy == "median":
+        return (values[starts + (counts-1)//2] + values[starts + counts//2]) / 2
+    name, proportion = (strategy, 0.1) if isinstance(strategy, str) else strategy
+    if name == "trimmed_mean":
+        cut = np.floor(counts*proportion).astype(int) # same cut as scipy.stats.trim_mean
+        cumulative = np.concatenate(([0], np.cumsum(values)))
+        return (cumulative[starts+counts-cut] - cumulative[starts+cut]) / (counts - 2*cut)
+    raise ValueError(f'Unknown strategy: {strategy}')
+
+##############################################################################
+def gate_echoes(grouped: np.array, offsets: np.array, windows, strategies, clock_period: float = 0.7) -> np.array:
+    # Gating and noise rejection of all transducers and windows in one pass.
+    # grouped, offsets: TransducerLayout.group output. windows: ((low, high), ..)
+    # in us, strategies: one per window (see segment_reduce). Returns an
+    # (n_transducers, n_windows) array of refined timestamps, nan where no
+    # timestamp of the window is kept. A lone timestamp is noise: a timestamp
+    # is kept only if the previous or next timestamp of the same transducer
+    # and window (in recording order) is within clock_period us, the 0.5 us
+    # clock period of the device with a margin.
+    n, w = offsets.size - 1, len(windows)
+    low, high = np.transpose(np.asarray(windows, dtype=float))
+    # the (window, element) mask lists the selected timestamps window by window,
+    # and inside a window transducer by transducer in recording order
+    inside = (grouped > low[:,None]) & (grouped < high[:,None])
+    values = np.concatenate([grouped[mask] for mask in inside])
+    # selected timestamps of every (window, transducer) segment
+    starts = (np.arange(w)[:,None]*grouped.size + offsets[:-1]).ravel()
+    counts = np.add.reduceat(np.append(inside.ravel(), False), starts, dtype=np.intp)
+    counts[np.tile(np.diff(offsets) == 0, w)] = 0 # reduceat returns an element for empty segments
+    starts = np.cumsum(counts) - counts
+
+    same = np.ones(max(values.size-1, 0), dtype=bool)
+    same[starts[(starts > 0) & (counts > 0)] - 1] = False
+    close = (np.abs(np.diff(values)) < clock_period) & same
+    keep = np.zeros(values.size, dtype=bool)
+    keep[:-1] |= close
+    keep[1:] |= close
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    counts = (kept[starts+counts] - kept[starts]).reshape(w, n)
+    values = values[keep]
+
+    bounds = np.concatenate(([0], np.cumsum(counts.sum(axis=1))))
+    refined = np.full((n, w), np.nan)
+    for j, strategy in enumerate(strategies):
+        found = counts[j] > 0
+        if np.any(found):
+            starts = np.concatenate(([0], np.cumsum(counts[j][found])[:-1]))
+            refined[found,j] = segment_reduce(values[bounds[j]:bounds[j+1]], starts, counts[j][found], strategy)
+    return refined
+
+##############################################################################
+def evaluate_data(grouped: np.array, offsets: np.array, ants, posts, strats) -> tuple:
+    # ants, posts: lower and upper bounds for wall locations [us]
+    # strats: reduction of the anterior and posterior timestamps, see segment_reduce
+    refined_data = gate_echoes(grouped, offsets, (ants, posts), strats)
+    counter = np.count_nonzero(~np.isnan(refined_data))
+    data_is_enough = counter >= 4
+    return data_is_enough, refined_data
+
 
-def ProcessData(piezonumbers, timestamps, ants, posts, strats):
+##############################################################################
+def ProcessData(piezonumbers, timestamps, ants, posts, strats, layout: TransducerLayout = None):
     #   Each CSV data file will come from a single monitoring action.
     # Therefore, we don't need to compute multiple volumes even if there are
     # multiple complete data packages (multiple 1-2-3-4 full recordings).
     # We can treat them as a single monitoring action and take average which will
     # increase our calculation accuracy.
+    # layout: transducer positions, the 2x2 array with 13 mm pitch by default
     
-    __Vwater = 1420 # m/s
-    XY = {'1': [0,0] , '2':[13,0], '3':[0,13] , '4':[13,13]}
-    
-    data = {'1': np.empty((0)) , '2':np.empty((0)), '3':np.empty((0)) , '4':np.empty((0))}
-
-    mask1 = (piezonumbers == 1)
-    data['1'] = np.append(data['1'], timestamps[mask1])
-    mask2 = (piezonumbers == 2)
-    data['2'] = np.append(data['2'], timestamps[mask2])
-    mask3 = (piezonumbers == 3)
-    data['3'] = np.append(data['3'], timestamps[mask3])
-    mask4 = (piezonumbers == 4)
-    data['4'] = np.append(data['4'], timestamps[mask4])
-
-    data_is_enough, refined_data = evaluate_data(data, ants, posts, strats)
+    data_is_enough, coordinates, refined_data = session_coordinates(piezonumbers, timestamps, ants, posts, strats, layout)
     if data_is_enough:
         # print(f'>>> {now()} - Successful monitoring session')
-        # form x,y,z array from timestamps (columns are x,y,z)
-        coordinates = np.empty((0,3))
-        for key in refined_data.keys():
-            for timestamp in refined_data[key]:
-                dist = __Vwater * timestamp * 1E-3 / 2 # in mm
-                coordinates = np.append(np.round(coordinates,3), np.array([[XY[key][0],XY[key][1],dist]]),axis=0)           
         # feed it to the function and calculate the volume
         volume, r, C = calculate_the_volume(coordinates)
         return True, round(volume,3), round(r,3), C, coordinates, refined_data
     else:
         print(f'>>> {now()} - Not enough data points!')
         return False, None, None, None, None, None
+
+##############################################################################
+def ProcessDataBatch(segments, ants, posts, strats, layout: TransducerLayout = None) -> np.array:
+    # ProcessData's volumes [mL] of many recordings with the same limits and
+    # strategies, e.g. the segments of one offline measurement, fitted together
+    # by calculate_the_volumes. segments: (piezonumbers, timestamps) pairs.
+    # Returns one volume per segment, nan where there is not enough data.
+    coordinate_sets, enough = [], []
+    for piezonumbers, timestamps in segments:
+        data_is_enough, coordinates, _ = session_coordinates(piezonumbers, timestamps, ants, posts, strats, layout)
+        if data_is_enough:
+            coordinate_sets.append(coordinates)
+        else:
+            print(f'>>> {now()} - Not enough data points!')
+        enough.append(data_is_enough)
+    volumes = np.full(len(enough), np.nan)
+    volumes[np.array(enough, dtype=bool)] = np.round(calculate_the_volumes(coordinate_sets)[0], 3)
+    return volumes
+
+##############################################################################
+def session_coordinates(piezonumbers, timestamps, ants, posts, strats, layout: TransducerLayout = None) -> tuple:
+    # Gating of one recording. Returns (data_is_enough, coordinates, refined_data),
+    # coordinates is None if there are fewer than 4 walls.
+    __Vwater = 1420 # m/s
+    layout = DEFAULT_LAYOUT if layout is None else layout
+    
+    grouped, offsets = layout.group(piezonumbers, timestamps)
+
+    data_is_enough, refined_data = evaluate_data(grouped, offsets, ants, posts, strats)
+    if not data_is_enough:
+        return False, None, refined_data
+    # form x,y,z array from timestamps (columns are x,y,z), transducer by
+    # transducer, anterior before posterior
+    transducer, _ = np.nonzero(~np.isnan(refined_data))
+    dist = __Vwater * refined_data[~np.isnan(refined_data)] * 1E-3 / 2 # in mm
+    coordinates = np.column_stack((layout.xy[transducer], dist))
+    coordinates[:-1] = np.round(coordinates[:-1],3) # every row but the last, as rounded on each append before
+    return True, coordinates, refined_data
@@ -5,9 +5,16 @@ import ProcessBMDL as bmdl
 from sys import exit
 from os import system, getcwd
 
-def lambda_handler(data, ants, posts, strats):
+def segment_records(data):
+    # (piezonumbers, timestamps) of a segment of the sensor CSV
     piezonumbers = np.asarray(data[:,3]) // 1000
     timestamps = np.asarray(data[:,5]) * 100 / 32
+    return piezonumbers, timestamps
+
+
+
+def lambda_handler(data, ants, posts, strats):
+    piezonumbers, timestamps = segment_records(data)
     
     SUCCESS, volume, r, C, coordinates, refined_timestmaps = bmdl.ProcessData(piezonumbers, timestamps, ants, posts, strats)
 
@@ -18,7 +25,7 @@ def lambda_handler(data, ants, posts, strats):
     # print(f">>> Rad = {r} mm, @ {C} mm")
     # print(f">>> {coordinates.shape[0]} Coords")
     # print(f"{coordinates} mm")
-    # print(f">>> Selected timestamps =\n{refined_timestmaps.values()} mm \n")
+    # print(f">>> Selected timestamps (rows: transducers, columns: anterior, posterior) =\n{refined_timestmaps} us \n")
 
     return volume
 
@@ -48,10 +55,9 @@ if __name__ == "__main__":
     N = 10
     length = data.shape[0]//N
     
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape1[i] = lambda_handler(partial_data, ants, posts, strats)
+    # the N segments are gated one by one and fitted together (bmdl.ProcessDataBatch)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape1[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
 
     
@@ -66,10 +72,8 @@ if __name__ == "__main__":
     N = 10
     length = data.shape[0]//N
     
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape2[i] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape2[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
 
 
@@ -84,10 +88,8 @@ if __name__ == "__main__":
     N = 5
     length = data.shape[0]//N
 
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape3[i] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape3[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
     ####################################################################### GOOD
   
@@ -100,10 +102,8 @@ if __name__ == "__main__":
     N = 5
     length = data.shape[0]//N
 
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape3[i+5] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape3[5:5+N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
     
 
     
@@ -125,10 +125,8 @@ if __name__ == "__main__":
     N = 10
     length = data.shape[0]//N
 
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape4[i] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape4[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
 
     
@@ -143,10 +141,8 @@ if __name__ == "__main__":
     N = 10
     length = data.shape[0]//N
 
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape5[i] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape5[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
 
     
@@ -161,10 +157,8 @@ if __name__ == "__main__":
     N = 10
     length = data.shape[0]//N
 
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape6[i] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape6[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
 
     ####################################################################### GOOD
@@ -178,10 +172,8 @@ if __name__ == "__main__":
     N = 10
     length = data.shape[0]//N
 
-    for i in range(N):
-        partial_data = data[length*i:length*(i+1) , :]
-        # print(f'\n>>> "{csvfilename}" - {i+1}')
-        Shape7[i] = lambda_handler(partial_data, ants, posts, strats)
+    segments = [segment_records(data[length*i:length*(i+1) , :]) for i in range(N)]
+    Shape7[:N,0] = bmdl.ProcessDataBatch(segments, ants, posts, strats)
 
 
     #######################################################################
@@ -0,0 +1,139 @@
+import importlib.util, os
+import numpy as np
+import pytest
+
+
+def load(name):
+    # the folders share module names, so the module next to this file is loaded by path
+    spec = importlib.util.spec_from_file_location(f"invitro_{name}", os.path.join(os.path.dirname(__file__), f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+ProcessBMDL = load("ProcessBMDL")
+
+# the sphere flasks of the offline sweep: radius [mm], depth of the center [mm], and the
+# anterior and posterior windows [us] and strategies of modified_offline_lambda_function.py
+FLASKS = {
+    "500ml sphere": (49.2, 100, (50, 100), (150, 250), ("max", "mean")),
+    "250ml sphere": (39.1, 80, (50, 100), (100, 180), ("max", "min")),
+    "100ml sphere": (28.8, 75, (50, 100), (100, 180), ("max", "min")),
+}
+BOUNDS = [(-20,20), (-20,20), (5,170), (5, 62)]
+
+
+def recording(rng, center, r, ants, posts, echoes=3, missing=()):
+    # (piezonumbers, timestamps) of the 2x2 array under a sphere, a few close
+    # echoes per wall and a stray timestamp that the gating drops. The
+    # transducers in missing record no wall.
+    piezonumbers, timestamps = [], []
+    for number, (x, y) in zip(ProcessBMDL.DEFAULT_LAYOUT.numbers, ProcessBMDL.DEFAULT_LAYOUT.xy):
+        half = np.sqrt(r**2 - (x-center[0])**2 - (y-center[1])**2)
+        for z in ((center[2]-half, center[2]+half) if number not in missing else ()):
+            t = 2*z/(1420*1E-3) + rng.normal(0, 0.2)
+            timestamps += list(t + 0.2*np.arange(echoes))
+            piezonumbers += [number]*echoes
+        piezonumbers.append(number); timestamps.append(np.mean(ants) + 5)
+    return np.array(piezonumbers), np.array(timestamps)
+
+
+def sweep(rng, flask, segments=10, missing=()):
+    # segments of one flask recording with the flask moved a little between them,
+    # and the windows and strategies to gate them with
+    r, depth, ants, posts, strats = FLASKS[flask]
+    recordings = [recording(rng, (*rng.uniform(3.5, 9.5, 2), depth), r, ants, posts, missing=missing) for _ in range(segments)]
+    return recordings, ants, posts, strats
+
+
+def coordinate_sets(rng, missing=()):
+    # the coordinates of every segment of every flask, fewer rows where walls are missing
+    sets = []
+    for flask in FLASKS:
+        segments, ants, posts, strats = sweep(rng, flask, missing=missing)
+        sets += [ProcessBMDL.session_coordinates(*segment, ants, posts, strats)[1] for segment in segments]
+    return sets
+
+
+@pytest.mark.parametrize("flask", FLASKS)
+def test_algebraic_matches_minimize(flask):
+    segments, ants, posts, strats = sweep(np.random.default_rng(0), flask)
+    for segment in segments:
+        success, coordinates, _ = ProcessBMDL.session_coordinates(*segment, ants, posts, strats)
+        assert success and coordinates.shape == (8, 3)
+        volume = ProcessBMDL.calculate_the_volume(coordinates)[0]
+        assert volume == pytest.approx(ProcessBMDL.calculate_the_volume(coordinates, "minimize")[0], rel=1e-4)
+
+
+def test_a_diagonal_pair_falls_back_to_minimize():
+    segments, ants, posts, strats = sweep(np.random.default_rng(1), "250ml sphere", 1, missing=(2, 3))
+    coordinates = ProcessBMDL.session_coordinates(*segments[0], ants, posts, strats)[1] # coplanar walls
+    info = {}
+    volume = ProcessBMDL.calculate_the_volume(coordinates, info=info)[0]
+    assert info['fallback']
+    assert volume == pytest.approx(ProcessBMDL.calculate_the_volume(coordinates, "minimize")[0])
+
+
+def test_a_flask_off_to_the_side_falls_back_to_minimize():
+    # the center is at x = 30, outside the (-20, 20) bound
+    ants, posts = (50, 100), (150, 250)
+    segment = recording(np.random.default_rng(2), (30, 5, 100), 45, ants, posts)
+    coordinates = ProcessBMDL.session_coordinates(*segment, ants, posts, ("mean", "mean"))[1]
+    info = {}
+    volume = ProcessBMDL.calculate_the_volume(coordinates, info=info)[0]
+    assert info['fallback']
+    assert volume == pytest.approx(ProcessBMDL.calculate_the_volume(coordinates, "minimize")[0])
+
+
+def test_batch_matches_per_set_fit():
+    rng = np.random.default_rng(3)
+    sets = coordinate_sets(rng) + coordinate_sets(rng, missing=(4,)) # 8 and 6 walls
+    sets += coordinate_sets(rng, missing=(2, 3))[:3] # coplanar
+    sets.append(ProcessBMDL.session_coordinates(*recording(rng, (30, 5, 100), 45, (50, 100), (150, 250)),
+                                                (50, 100), (150, 250), ("mean", "mean"))[1]) # center outside the bounds
+    parameters, converged = ProcessBMDL.Sphere_fit_batch(sets, BOUNDS) # list input, padded and masked inside
+    for coordinates, fitted in zip(sets, parameters):
+        np.testing.assert_allclose(fitted, ProcessBMDL.Sphere_fit_algebraic(coordinates, BOUNDS), rtol=1e-6, atol=1e-6)
+    assert np.all(converged[:-4]) and not np.any(converged[-4:])
+
+
+def test_batch_ignores_the_padded_rows():
+    sets = coordinate_sets(np.random.default_rng(4), missing=(1,))
+    padded = np.full((len(sets), 9, 3), 1e3) # garbage in the padding
+    mask = np.zeros((len(sets), 9), dtype=bool)
+    for index, coordinates in enumerate(sets):
+        padded[index, :coordinates.shape[0]] = coordinates
+        mask[index, :coordinates.shape[0]] = True
+    parameters, _ = ProcessBMDL.Sphere_fit_batch(padded, BOUNDS, mask)
+    listed, _ = ProcessBMDL.Sphere_fit_batch(sets, BOUNDS)
+    np.testing.assert_allclose(parameters, listed, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("flask", FLASKS)
+def test_batch_sweep_matches_process_data(flask):
+    segments, ants, posts, strats = sweep(np.random.default_rng(5), flask)
+    segments.insert(3, (np.array([1, 2]), np.array([60.0, 60.1]))) # not enough walls
+    volumes = ProcessBMDL.ProcessDataBatch(segments, ants, posts, strats)
+    for (piezonumbers, timestamps), volume in zip(segments, volumes):
+        success, expected = ProcessBMDL.ProcessData(piezonumbers, timestamps, ants, posts, strats)[:2]
+        if success:
+            assert volume == pytest.approx(expected, abs=1e-3)
+        else:
+            assert np.isnan(volume)
+    assert np.count_nonzero(np.isnan(volumes)) == 1
+    r = FLASKS[flask][0]
+    assert np.nanmean(volumes) == pytest.approx(4/3*np.pi*r**3/1000, rel=0.05)
+
+
+def test_empty_batches():
+    parameters, converged = ProcessBMDL.Sphere_fit_batch([], BOUNDS)
+    assert parameters.shape == (0, 4) and converged.shape == (0,)
+    assert ProcessBMDL.ProcessDataBatch([], (15, 60), (100, 200), ("mean", "mean")).shape == (0,)
+
+
+def test_coordinates_are_rounded_as_before():
+    # the old per-append rounding left the last row unrounded
+    segments, ants, posts, strats = sweep(np.random.default_rng(6), "500ml sphere", 1)
+    coordinates = ProcessBMDL.ProcessData(*segments[0], ants, posts, strats)[4]
+    np.testing.assert_array_equal(coordinates[:-1], np.round(coordinates[:-1], 3))
+    assert coordinates[-1,2] != round(coordinates[-1,2], 3)
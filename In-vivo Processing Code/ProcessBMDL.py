@@ -4,8 +4,9 @@
 from sys import exit
 from os import system
 import numpy as np
-from scipy.optimize import minimize,differential_evolution
 from datetime import datetime
+from itertools import combinations
+from math import comb
 
 
 
@@ -22,81 +23,265 @@ def Sphere_func(parameters : np.array, coordinates: np.array) -> float:
 
 
 
-def Calc_Volume_1(coordinates: np.array) -> float:
-    # input coordinates: columns are x, y and z. Returns the volume
+def Sphere_fit_minimize(coordinates: np.array, bounds: list, initial: np.array = None, info: dict = None) -> np.array:
+    # The scipy fit of Sphere_func, from initial or from the mean of the
+    # coordinates with r = 50. info: if given, info['iterations'] is set to
+    # the optimizer iterations and info['seeded'] to whether initial was used
+    from scipy.optimize import minimize # only this path needs SciPy, keeps it out of the cold start
     x, y, z = np.transpose(coordinates)
-    initial_guess = np.array([np.mean(x), np.mean(y), np.mean(z), 50]) # np.std(x) as r
+    initial_guess = np.array([np.mean(x), np.mean(y), np.mean(z), 50]) if initial is None else np.asarray(initial) # np.std(x) as r
+    best_fit_sphere = minimize(Sphere_func, initial_guess, coordinates, bounds=bounds)
+    if info is not None:
+        info['iterations'], info['seeded'] = best_fit_sphere.nit, initial is not None
+    return best_fit_sphere.x
+
+
+
+def Sphere_fit_algebraic(coordinates: np.array, bounds: list, refine_steps: int = 10, initial: np.array = None, info: dict = None,
+                         max_condition: float = 1e6) -> np.array:
+    # Closed-form sphere fit. |p|^2 = 2*p.c + (r^2 - |c|^2) is linear in
+    # (x0, y0, z0, r^2 - |c|^2), so one linear least squares gives the sphere,
+    # then a few Gauss-Newton steps on Sphere_func's residuals (analytic
+    # Jacobian) refine it. The closed form needs coordinates that pin a sphere
+    # down and an optimum inside the bounds: if the [2p, 1] design matrix is
+    # rank deficient or its condition number is above max_condition (coplanar
+    # sets, e.g. two transducer columns), if the steps do not converge or if
+    # the result is on or outside a bound, Sphere_fit_minimize's result is
+    # returned instead.
+    # initial: (x0, y0, z0, r) of a previous fit, only the fallback starts
+    # from it, the closed-form result does not depend on it.
+    # info: if given, info['iterations'] is set to the Gauss-Newton steps taken
+    # (the optimizer iterations after a fallback) and info['fallback'] to
+    # whether Sphere_fit_minimize was used
+    coordinates = np.asarray(coordinates, dtype=float)
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    mean = np.mean(coordinates, axis=0) # centered, so the condition number does not depend on the position
+    A = np.column_stack((2*(coordinates - mean), np.ones(coordinates.shape[0])))
+    singular_values = np.linalg.svd(A, compute_uv=False)
+    if singular_values.size == 4 and singular_values[-1]*max_condition > singular_values[0]:
+        solution = np.linalg.lstsq(A, np.sum((coordinates - mean)**2, axis=1), rcond=None)[0]
+        center = solution[:3] + mean
+        # for a fixed center the best radius is the mean distance
+        parameters = np.append(center, np.mean(np.linalg.norm(coordinates - center, axis=1)))
+
+        for iterations in range(1, refine_steps+1):
+            diff = coordinates - parameters[:3]
+            dist = np.maximum(np.sqrt(np.sum(diff**2, axis=1)), 1e-12)
+            residuals = dist - parameters[3]
+            jacobian = np.empty((dist.size, 4))
+            jacobian[:,:3] = -diff/dist[:,None]
+            jacobian[:,3] = -1
+            step = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+            parameters = parameters + step
+            if np.max(np.abs(step)) < 1e-6:
+                if np.all((parameters > lower) & (parameters < upper)):
+                    if info is not None:
+                        info['iterations'], info['fallback'] = iterations, False
+                    return parameters
+                break
+    if info is not None:
+        info['fallback'] = True
+    return Sphere_fit_minimize(coordinates, bounds, initial, info)
+
+
+
+def Sphere_fit_ransac(coordinates: np.array, bounds: list, hypotheses: int = 100, threshold: float = 2.0, seed: int = 0, info: dict = None):
+    # Robust sphere fit, returns (parameters, inliers). Spheres through 4 points
+    # are solved for a batch of hypotheses (all 4-point subsets if there are no
+    # more than `hypotheses`, otherwise that many random ones) and scored
+    # together: the sum of squared distances to the surface, capped at
+    # threshold [mm]. The best one's inliers are refitted with
+    # Sphere_fit_algebraic. inliers marks the coordinates that were kept.
+    # With 4 coordinates or less, or without a consensus of 4, all of them are
+    # fitted. Every fit goes through Sphere_fit_algebraic's checks, so the
+    # coplanar sets of a few transducers get the minimize result.
+    # info: passed on to Sphere_fit_algebraic
+    coordinates = np.asarray(coordinates, dtype=float)
+    n = coordinates.shape[0]
+    lower, upper = np.transpose(np.asarray(bounds, dtype=float))
+    if n <= 4:
+        return Sphere_fit_algebraic(coordinates, bounds, info=info), np.ones(n, dtype=bool)
+    if comb(n, 4) <= hypotheses:
+        samples = np.array(list(combinations(range(n), 4)))
+    else:
+        samples = np.argsort(np.random.default_rng(seed).random((hypotheses, n)), axis=1)[:,:4]
+
+    # |p|^2 = 2*p.c + (r^2 - |c|^2) through the 4 points of every sample
+    points = coordinates[samples]
+    A = np.concatenate((2*points, np.ones((samples.shape[0], 4, 1))), axis=2)
+    valid = np.abs(np.linalg.det(A)) > 1e-9 * np.max(np.abs(points))**3 # coplanar samples have no sphere
+    solution = np.linalg.solve(A[valid], np.sum(points[valid]**2, axis=2)[...,None])[...,0]
+    center = solution[:,:3]
+    r = np.sqrt(np.maximum(solution[:,3] + np.sum(center**2, axis=1), 0))
+    parameters = np.column_stack((center, r))
+    inside = np.all((parameters >= lower) & (parameters <= upper), axis=1)
+    if not np.any(inside):
+        return Sphere_fit_algebraic(coordinates, bounds, info=info), np.ones(n, dtype=bool)
+    parameters = parameters[inside]
+
+    residuals = np.abs(np.linalg.norm(coordinates[None,:,:] - parameters[:,None,:3], axis=2) - parameters[:,3:])
+    cost = np.sum(np.minimum(residuals, threshold)**2, axis=1)
+    inliers = residuals[np.argmin(cost)] < threshold
+    for _ in range(2): # refit on the inliers, then take the inliers of the refit
+        if np.count_nonzero(inliers) < 4:
+            return Sphere_fit_algebraic(coordinates, bounds, info=info), np.ones(n, dtype=bool)
+        fitted = Sphere_fit_algebraic(coordinates[inliers], bounds, info=info)
+        inliers = np.abs(np.linalg.norm(coordinates - fitted[:3], axis=1) - fitted[3]) < threshold
+    return fitted, inliers
+
+
+
+def Calc_Volume_1(coordinates: np.array, method: str = "algebraic", initial: np.array = None, info: dict = None, hypotheses: int = 100) -> float:
+    # input coordinates: columns are x, y and z. Returns the volume
+    # method: "algebraic" (closed-form + Gauss-Newton, minimize for the sets
+    # it cannot fit, see Sphere_fit_algebraic), "ransac" (robust, at most
+    # `hypotheses` 4-point spheres scored) or "minimize" (scipy)
+    # initial: (x0, y0, z0, r) of a previous fit, the start of the minimize fits
+    # info: if given, info['iterations'] is set to the optimizer iterations and,
+    # for "ransac", info['rejected'] to the indexes of the rejected coordinates
     r_limit = (1e6*(3/4)/np.pi)**(1/3)
-    best_fit_sphere = minimize(Sphere_func, initial_guess, coordinates, bounds=[(-20,20), (-20,20), (5,170), (5, r_limit)])
-    x0, y0, z0, r = best_fit_sphere.x
+    bounds = [(-20,20), (-20,20), (5,170), (5, r_limit)]
+    if method == "algebraic":
+        x0, y0, z0, r = Sphere_fit_algebraic(coordinates, bounds, initial=initial, info=info)
+    elif method == "ransac":
+        (x0, y0, z0, r), inliers = Sphere_fit_ransac(coordinates, bounds, hypotheses, info=info)
+        if info is not None:
+            info['rejected'] = np.flatnonzero(~inliers)
+    else:
+        x0, y0, z0, r = Sphere_fit_minimize(coordinates, bounds, initial, info)
     return 4/3 * np.pi * r**3 / 1000, r, (x0,y0,z0)
 
 
 
 
-def noise_free(masked_data: np.array) -> np.array:
-    CLOCK_PERIOD = 0.7 # normally it is 0.5 microseconds, set to 0.7 to be safe
-    #   Input array is the timestamp array containing the timestamps within the
-    #   upper and lower bounds. But, to be counted as a legitimate echo timestamp,
-    #   there needs to be at least two timestamps within a time interval, equal to
-    #   the clock period. If a timestamp is alone then that timestamp will be disregarded.
-
-    #   mask1: element True, if following element is within CLOCK_PERIOD
-    mask1 = np.append(np.abs(masked_data[:-1]-masked_data[1:]) < CLOCK_PERIOD, False)
-    #   mask2: element True, if previous element is within CLOCK_PERIOD
-    mask2 = np.insert(np.abs(masked_data[1:]-masked_data[:-1]) < CLOCK_PERIOD, 0, False)
-    combined_mask = mask1 | mask2
-
-    #combined_mask = np.zeros(masked_data.size)
-    #for j in range(masked_data.size):
-    #    differences = np.abs(masked_data - masked_data[j])
-    #    combined_mask[j] = np.any((differences > 0.3) & (differences < 0.7))
-    
-    return masked_data[combined_mask]
-    #return masked_data
-
-
-
-
-def evaluate_data(data: dict) -> dict:
+class TransducerLayout:
+    # Positions [mm] of the transducers in the array plane, keyed by piezo
+    # number. group() sorts the records once by transducer, so the grouping
+    # cost does not grow with the number of elements.
+
+    def __init__(self, positions: dict):
+        self.numbers = np.array(sorted(positions), dtype=int)
+        self.xy = np.array([positions[n] for n in self.numbers], dtype=float)
+
+    @classmethod
+    def grid(cls, columns: int, rows: int, pitch: float = 13):
+        # piezo 1 at the origin, numbered along x first: the 2x2 array is
+        # 1:(0,0) 2:(13,0) 3:(0,13) 4:(13,13)
+        return cls({1 + i + columns*j: (i*pitch, j*pitch) for j in range(rows) for i in range(columns)})
+
+    def __len__(self):
+        return self.numbers.size
+
+    def keys(self) -> list:
+        return [str(n) for n in self.numbers]
+
+    def group(self, piezonumbers: np.array, timestamps: np.array):
+        # Returns (grouped, offsets): the timestamps of transducer i are
+        # grouped[offsets[i]:offsets[i+1]], in recording order. Records of
+        # unknown piezo numbers are dropped.
+        n = len(self)
+        index = np.searchsorted(self.numbers, piezonumbers)
+        known = self.numbers[np.minimum(index, n-1)] == piezonumbers
+        index = np.where(known, index, n).astype(np.uint16) # stable sort of small ints is a radix sort
+        order = np.argsort(index, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(index, minlength=n+1)[:n])))
+        return np.asarray(timestamps)[order[:offsets[-1]]], offsets
+
+    def split(self, piezonumbers: np.array, timestamps: np.array) -> dict:
+        # {'1': timestamps of piezo 1, ...}, views into one grouped array
+        grouped, offsets = self.group(piezonumbers, timestamps)
+        return {key: grouped[offsets[i]:offsets[i+1]] for i, key in enumerate(self.keys())}
+
+    def position(self, key) -> np.array:
+        return self.xy[np.searchsorted(self.numbers, int(key))]
+
+
+DEFAULT_LAYOUT = TransducerLayout.grid(2, 2, 13)
+
+
+
+
+def segment_reduce(values: np.array, starts: np.array, counts: np.array, strategy) -> np.array:
+    # Reduces the consecutive segments values[starts[i]:starts[i]+counts[i]]
+    # (all counts > 0) with strategy: "min", "mean", "max", "median",
+    # "trimmed_mean" (10% cut from each end), ("trimmed_mean", proportion) or
+    # any function of a 1D array.
+    if strategy == "min":
+        return np.minimum.reduceat(values, starts)
+    if strategy == "max":
+        return np.maximum.reduceat(values, starts)
+    if strategy == "mean":
+        return np.add.reduceat(values, starts) / counts
+    if callable(strategy):
+        return np.array([strategy(values[s:s+c]) for s, c in zip(starts, counts)], dtype=float)
+    # order statistics: sort inside every segment
+    segment = np.repeat(np.arange(starts.size), counts)
+    values = values[np.lexsort((values, segment))]
+    if strategy == "median":
+        return (values[starts + (counts-1)//2] + values[starts + counts//2]) / 2
+    name, proportion = (strategy, 0.1) if isinstance(strategy, str) else strategy
+    if name == "trimmed_mean":
+        cut = np.floor(counts*proportion).astype(int) # same cut as scipy.stats.trim_mean
+        cumulative = np.concatenate(([0], np.cumsum(values)))
+        return (cumulative[starts+counts-cut] - cumulative[starts+cut]) / (counts - 2*cut)
+    raise ValueError(f'Unknown strategy: {strategy}')
+
+
+
+def gate_echoes(grouped: np.array, offsets: np.array, windows, strategies, clock_period: float = 0.7) -> np.array:
+    # Gating and noise rejection of all transducers and windows in one pass.
+    # grouped, offsets: TransducerLayout.group output. windows: ((low, high), ..)
+    # in us, strategies: one per window (see segment_reduce). Returns an
+    # (n_transducers, n_windows) array of refined timestamps, nan where no
+    # timestamp of the window is kept. A lone timestamp is noise: a timestamp
+    # is kept only if the previous or next timestamp of the same transducer
+    # and window (in recording order) is within clock_period us, the 0.5 us
+    # clock period of the device with a margin.
+    n, w = offsets.size - 1, len(windows)
+    low, high = np.transpose(np.asarray(windows, dtype=float))
+    # the (window, element) mask lists the selected timestamps window by window,
+    # and inside a window transducer by transducer in recording order
+    inside = (grouped > low[:,None]) & (grouped < high[:,None])
+    values = np.concatenate([grouped[mask] for mask in inside])
+    # selected timestamps of every (window, transducer) segment
+    starts = (np.arange(w)[:,None]*grouped.size + offsets[:-1]).ravel()
+    counts = np.add.reduceat(np.append(inside.ravel(), False), starts, dtype=np.intp)
+    counts[np.tile(np.diff(offsets) == 0, w)] = 0 # reduceat returns an element for empty segments
+    starts = np.cumsum(counts) - counts
+
+    same = np.ones(max(values.size-1, 0), dtype=bool)
+    same[starts[(starts > 0) & (counts > 0)] - 1] = False
+    close = (np.abs(np.diff(values)) < clock_period) & same
+    keep = np.zeros(values.size, dtype=bool)
+    keep[:-1] |= close
+    keep[1:] |= close
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    counts = (kept[starts+counts] - kept[starts]).reshape(w, n)
+    values = values[keep]
+
+    bounds = np.concatenate(([0], np.cumsum(counts.sum(axis=1))))
+    refined = np.full((n, w), np.nan)
+    for j, strategy in enumerate(strategies):
+        found = counts[j] > 0
+        if np.any(found):
+            starts = np.concatenate(([0], np.cumsum(counts[j][found])[:-1]))
+            refined[found,j] = segment_reduce(values[bounds[j]:bounds[j+1]], starts, counts[j][found], strategy)
+    return refined
+
+
+
+def evaluate_data(grouped: np.array, offsets: np.array) -> tuple:
     # # lower and upper bounds for wall locations [us]
     ant_lim_low = 15
     ant_lim_high = 40
     post_lim_low = 105
     post_lim_high = 120
-    
-
-
-    refined_data = {'1':np.empty(0) , '2':np.empty(0) , '3':np.empty(0) , '4':np.empty(0)}
-    
-    data_is_enough = False
-    counter = 0
-    for key in data.keys():
-        ant_mask = (data[key]>ant_lim_low) & (data[key]<ant_lim_high)
-        post_mask = (data[key]>post_lim_low) & (data[key]<post_lim_high)
-        anteriors = data[key] [ant_mask] # within bounds
-        posteriors = data[key] [post_mask] # within bounds
-
-        
-        # ANTERIOR STRATEGY
-        if anteriors.size > 0:
-            noise_free_anteriors = noise_free(anteriors) # eliminate noise peaks
-            if noise_free_anteriors.size > 0:
-                counter += 1
-                refined_data[key] = np.append(refined_data[key],np.mean(noise_free_anteriors))
-        
-        # POSTERIOR STRATEGY
-        if posteriors.size > 0:
-            noise_free_posteriors = noise_free(posteriors)
-            if noise_free_posteriors.size > 0:
-                counter += 1
-                refined_data[key] = np.append(refined_data[key],np.mean(noise_free_posteriors)) 
-  
-  
-  
-        # FUTURE WORK: Here, anterior and posterior timestamps can be seperated!
+
+    # refined timestamps, one row per transducer: [anterior, posterior], nan if none
+    refined_data = gate_echoes(grouped, offsets, ((ant_lim_low, ant_lim_high), (post_lim_low, post_lim_high)), ("mean", "mean"))
+    counter = np.count_nonzero(~np.isnan(refined_data))
     print(f'$$$ # of coordinates: {counter}')
-    if counter >= 4: data_is_enough = True
+    data_is_enough = counter >= 4
     return data_is_enough, refined_data
 
 
@@ -104,41 +289,42 @@ def evaluate_data(data: dict) -> dict:
 
 
 
-def ProcessData(csvFileName, csvDATA: np.array):
+def ProcessData(csvFileName, csvDATA: np.array, layout: TransducerLayout = None,
+                method: str = "algebraic", hypotheses: int = 100, warm_start=None, device=None):
     #   Each CSV data file will come from a single monitoring action.
     # Therefore, we don't need to compute multiple volumes even if there are
     # multiple complete data packages (multiple 1-2-3-4 full recordings).
     # We can treat them as a single monitoring action and take average which will
     # increase our calculation accuracy.
+    # layout: transducer positions, the 2x2 array with 13 mm pitch by default
+    # method, hypotheses: sphere fit of Calc_Volume_1, "ransac" rejects outliers
+    # warm_start: optional WarmStartCache, a minimize fit starts from the last
+    # sphere of the device
     print(f'\n$$$ Processing {csvFileName} data (Length:{csvDATA.shape[0]})...')
     __Vwater = 1420 # m/s
-    XY = {'1': [0,0] , '2':[13,0], '3':[0,13] , '4':[13,13]}
-    
-    data = {'1': np.empty((0)) , '2':np.empty((0)), '3':np.empty((0)) , '4':np.empty((0))}
+    layout = DEFAULT_LAYOUT if layout is None else layout
 
     piezonumbers = csvDATA[:,0]
     timestamps = csvDATA[:,1]
+    grouped, offsets = layout.group(piezonumbers, timestamps)
 
-    mask1 = (piezonumbers == 1)
-    data['1'] = np.append(data['1'], timestamps[mask1])
-    mask2 = (piezonumbers == 2)
-    data['2'] = np.append(data['2'], timestamps[mask2])
-    mask3 = (piezonumbers == 3)
-    data['3'] = np.append(data['3'], timestamps[mask3])
-    mask4 = (piezonumbers == 4)
-    data['4'] = np.append(data['4'], timestamps[mask4])
-
-    data_is_enough, refined_data = evaluate_data(data)
+    data_is_enough, refined_data = evaluate_data(grouped, offsets)
     if data_is_enough:
         print(f'$$$ {now()} - Successful monitoring session')
-        # form x,y,z array from timestamps (columns are x,y,z)
-        coordinates = np.empty((0,3))
-        for key in refined_data.keys():
-            for timestamp in refined_data[key]:
-                dist = __Vwater * timestamp * 1E-3 / 2 # in mm
-                coordinates = np.append(coordinates, np.array([[XY[key][0],XY[key][1],dist]]),axis=0)           
+        # form x,y,z array from timestamps (columns are x,y,z), transducer by
+        # transducer, anterior before posterior
+        transducer, _ = np.nonzero(~np.isnan(refined_data))
+        dist = __Vwater * refined_data[~np.isnan(refined_data)] * 1E-3 / 2 # in mm
+        coordinates = np.column_stack((layout.xy[transducer], dist))
         # feed it to the function and calculate the volume
-        volume, r, C = Calc_Volume_1(coordinates)
+        initial = None if warm_start is None else warm_start.get(device)
+        info = {}
+        volume, r, C = Calc_Volume_1(coordinates, method, initial, info, hypotheses)
+        if len(info.get('rejected', [])):
+            print(f"$$$ Rejected coordinates: {coordinates[info['rejected']]} mm")
+        if warm_start is not None: # the stats count the minimize fits, the only ones the seed can start
+            minimized = method == "minimize" or info.get('fallback', False)
+            warm_start.put(device, (*C, r), info['iterations'] if minimized else None, minimized and info['seeded'])
         return True, round(volume), r, C, coordinates, refined_data
     else:
         print(f'$$$ {now()} - Not enough data points!')
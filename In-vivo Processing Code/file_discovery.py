@@ -0,0 +1,175 @@
+"""Finds the CSV files uploaded after the last processed one. """
+
+
+import os, json
+
+
+
+def file_number(key: str):
+    # '123.csv' -> 123, anything else -> None
+    name, _, extension = key.rpartition('.')
+    if extension.lower() != 'csv' or not name.isdigit():
+        return None
+    return int(name)
+
+
+
+def window_listings(mark: int, window: int) -> list:
+    # S3 lists keys in lexicographic order, so for unpadded integer names
+    # StartAfter alone would also return old keys such as '13.csv' after
+    # '123.csv'. The numbers in (mark, mark+window] are split into ranges of
+    # equal digit count and equal first digit inside aligned blocks of the
+    # window size, and each range is listed under the prefix its two ends
+    # share: at least the first digit, and the whole name ('7.') for a single
+    # number, so no listing covers the whole bucket. The only old keys a
+    # listing returns are the shorter names under its prefix.
+    block = 10**len(str(max(window-1, 1)))
+    listings = []
+    low, high = mark + 1, mark + window
+    while low <= high:
+        leading = 10**(len(str(low)) - 1) # numbers of one first digit and digit count
+        top = min(high, (low//block + 1)*block - 1, (low//leading + 1)*leading - 1)
+        lo, hi = str(low), str(top)
+        i = 0
+        while i < len(lo) and lo[i] == hi[i]:
+            i += 1
+        prefix = lo + '.' if low == top else lo[:i]
+        start_after = f'{low-1}.csv' if len(str(low-1)) == len(lo) else ''
+        listings.append((prefix, start_after))
+        low = top + 1
+    return listings
+
+
+
+class LocalBucketClient:
+    # Stand-in for the boto3 S3 client, serving a local folder per bucket.
+    # Only the calls used by the lambda are implemented.
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, MaxKeys=1000):
+        keys = sorted(key for key in os.listdir(os.path.join(self.root, Bucket)) if key.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        keys = [key for key in keys if key > after]
+        page = keys[:MaxKeys]
+        response = {'KeyCount': len(page), 'IsTruncated': len(keys) > MaxKeys,
+                    'Contents': [{'Key': key, 'Size': os.path.getsize(os.path.join(self.root, Bucket, key))} for key in page]}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        if not page:
+            del response['Contents'] # S3 omits the key when nothing matches
+        return response
+
+    def get_object(self, Bucket, Key):
+        path = os.path.join(self.root, Bucket, Key)
+        return {'Body': open(path, 'rb'), 'ContentLength': os.path.getsize(path)}
+
+    def put_object(self, Bucket, Key, Body):
+        with open(os.path.join(self.root, Bucket, Key), 'wb') as file:
+            file.write(Body if isinstance(Body, bytes) else Body.encode('utf8'))
+
+
+
+class FileMark:
+    # High-water mark kept in a local JSON file.
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def get(self):
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'r') as file:
+            return json.load(file)['last_file']
+
+    def set(self, filenum: int):
+        with open(self.path, 'w') as file:
+            json.dump({'last_file': int(filenum)}, file)
+
+
+
+class DynamoMark:
+    # High-water mark kept as an item of a DynamoDB table (e.g. Counter_Table).
+
+    def __init__(self, table, mark_id: str = 'last_file'):
+        self.table = table
+        self.mark_id = mark_id
+
+    def get(self):
+        item = self.table.get_item(Key={'CounterId': self.mark_id}).get('Item')
+        return None if item is None else int(item['counter_value'])
+
+    def set(self, filenum: int):
+        self.table.put_item(Item={'CounterId': self.mark_id, 'counter_value': int(filenum)})
+
+
+
+class LatestFileCursor:
+    # Lists only the keys after a persistent high-water mark, using Prefix,
+    # StartAfter and pagination. window is the largest jump expected between
+    # consecutive file numbers; bursts longer than that are followed window by
+    # window. Without a stored mark the whole bucket is listed once.
+
+    def __init__(self, client, bucket: str, mark_store, window: int = 1000):
+        self.client = client
+        self.bucket = bucket
+        self.mark_store = mark_store
+        self.window = window
+        self.list_calls = 0
+
+    def list_keys(self, prefix: str = '', start_after: str = '') -> list:
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix, 'StartAfter': start_after}
+        keys = []
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            self.list_calls += 1
+            keys += [content['Key'] for content in response.get('Contents', [])]
+            if not response.get('IsTruncated'):
+                return keys
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def new_files(self) -> list:
+        # sorted file numbers newer than the mark
+        mark = self.mark_store.get()
+        if mark is None:
+            numbers = (file_number(key) for key in self.list_keys())
+            return sorted(n for n in numbers if n is not None)
+        found = set()
+        while True:
+            numbers = set()
+            for prefix, start_after in window_listings(mark, self.window):
+                numbers.update(file_number(key) for key in self.list_keys(prefix, start_after))
+            numbers = {n for n in numbers if n is not None and n > mark}
+            found |= numbers
+            # longer names under a prefix (100.csv under '1') may lie past
+            # the window, the next window follows on from the last number in it
+            numbers = [n for n in numbers if n <= mark + self.window]
+            if not numbers:
+                return sorted(found)
+            mark = max(numbers)
+
+    def latest(self):
+        # newest unprocessed file number, or None
+        files = self.new_files()
+        return files[-1] if files else None
+
+    def advance(self, filenum: int):
+        mark = self.mark_store.get()
+        if mark is None or filenum > mark:
+            self.mark_store.set(filenum)
+
+    def advance_over(self, filenums) -> int:
+        # Moves the mark over the file numbers that follow it without a gap
+        # (mark+1, mark+2, ...), so a lower file that failed or was never
+        # processed stays after the mark. Without a stored mark nothing is
+        # set, the next poll lists the bucket. Returns the mark.
+        mark = self.mark_store.get()
+        if mark is None:
+            return None
+        filenums, last = set(filenums), mark
+        while last + 1 in filenums:
+            last += 1
+        if last > mark:
+            self.mark_store.set(last)
+        return last
@@ -0,0 +1,297 @@
+"""Publishes the calculated volumes to the AppSync GraphQL API. """
+
+
+import json, time, threading, queue
+from datetime import datetime
+from http import client as http_client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+TODO_FIELDS = """
+              id
+              piezo_no
+              bladder_volume
+              anterior_d1
+              anterior_d2
+              anterior_d3
+              anterior_d4
+              post_d1
+              post_d2
+              post_d3
+              post_d4
+              createdAt
+              updatedAt"""
+
+
+
+class OutcomeUnknown(Exception):
+    # The request was sent but no answer came back, the server may or may not
+    # have applied it. Such a request must not be sent again.
+    pass
+
+
+
+class ConnectionPool:
+    # Keeps HTTP(S) connections to one host open between requests, so a warm
+    # container pays the TCP/TLS handshake once instead of once per mutation.
+    # Connections idle for more than max_idle seconds are not reused, the
+    # server may have closed them in the meantime.
+
+    def __init__(self, endpoint: str, size: int = 4, timeout: float = 10, max_idle: float = 30):
+        url = urlsplit(endpoint)
+        self.connection_class = http_client.HTTPSConnection if url.scheme == 'https' else http_client.HTTPConnection
+        self.host = url.netloc
+        self.path = url.path or '/'
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue()
+
+    def get_connection(self):
+        # (connection, reused), the most recently used idle one if it is fresh enough
+        while True:
+            try:
+                connection, since = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connection_class(self.host, timeout=self.timeout), False
+            if time.monotonic() - since <= self.max_idle:
+                return connection, True
+            connection.close()
+
+    def post(self, body: bytes, headers: dict):
+        # Returns (status, response body). A failure while sending means the
+        # server never got the whole request: a reused connection is replaced
+        # once, a new one raises the error. A failure after the request was
+        # sent raises OutcomeUnknown and is never retried here.
+        connection, reused = self.get_connection()
+        try:
+            connection.request('POST', self.path, body=body, headers=headers)
+        except (OSError, http_client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            return self.post(body, headers)
+        try:
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http_client.HTTPException) as error:
+            connection.close()
+            raise OutcomeUnknown(f'no response from {self.host}: {error!r}') from error
+        if response.will_close or self.idle.qsize() >= self.size:
+            connection.close()
+        else:
+            self.idle.put((connection, time.monotonic()))
+        return response.status, data
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait()[0].close()
+
+
+
+class GraphqlClient:
+
+    def __init__(self, endpoint, headers, retries: int = 3, backoff: float = 0.2, pool_size: int = 4, timeout: float = 10):
+        self.endpoint = endpoint
+        self.headers = dict(headers, **{'Content-Type': 'application/json'})
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(endpoint, pool_size, timeout)
+
+    @staticmethod
+    def serialization_helper(o):
+        if isinstance(o, datetime):
+            return o.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def execute(self, query, operation_name, variables={}):
+        data = json.dumps({
+            "query": query,
+            "variables": variables,
+            "operationName": operation_name
+        },
+            default=self.serialization_helper,
+        ).encode('utf8')
+        # Only the requests the server did not apply are retried, with
+        # exponential backoff: connection errors before the request was sent
+        # and HTTP 429/503 (throttled, unavailable). Other server errors raise
+        # OutcomeUnknown, like a request without a response; anything else is
+        # returned to the caller.
+        for attempt in range(self.retries + 1):
+            try:
+                status, response = self.pool.post(data, self.headers)
+                if status < 500 and status != 429:
+                    return response.decode('utf8')
+                if status not in (429, 503):
+                    raise OutcomeUnknown(f'GraphQL endpoint returned HTTP {status}')
+                error = RuntimeError(f'GraphQL endpoint returned HTTP {status}')
+            except OutcomeUnknown:
+                raise
+            except (OSError, http_client.HTTPException) as exception:
+                error = exception
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2**attempt)
+        raise error
+
+
+
+def create_todo_mutation(count: int) -> str:
+    # One mutation with `count` aliased createTodo fields, inputs $input0.. $input{count-1}
+    arguments = ', '.join(f'$input{i}: CreateTodoInput!' for i in range(count))
+    fields = '\n'.join(f'            todo{i}: createTodo(input: $input{i}) {{{TODO_FIELDS}\n                }}' for i in range(count))
+    return f"""
+            mutation createTodo({arguments}) {{
+{fields}
+                }}
+               """
+
+
+
+def applied_inputs(response: str, count: int) -> list:
+    # Which of the `count` aliased createTodo fields the server applied: a
+    # field is applied if the response data holds it. A body with `errors`
+    # nulls the fields that failed (or all of them without data).
+    data = json.loads(response).get('data') or {}
+    return [data.get(f'todo{i}') is not None for i in range(count)]
+
+
+
+class TodoPublisher:
+    # Collects createTodo inputs and sends them batch_size at a time in a single
+    # request. With background=True a worker thread flushes the queue every
+    # flush_interval seconds; flush() always sends what is pending and waits.
+    # Each input carries its allocated id, which is sent at most once unless
+    # the server reported it as not applied: `published` holds the ids the
+    # server confirmed, `unconfirmed` the ids of requests without a usable
+    # answer, which are never sent again.
+
+    def __init__(self, gq_client, batch_size: int = 10, background: bool = False, flush_interval: float = 1.0):
+        self.gq_client = gq_client
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+        self.responses = []
+        self.errors = []
+        self.published = set()
+        self.unconfirmed = set()
+        self.worker = None
+        self.stop_event = threading.Event()
+        if background:
+            self.flush_interval = flush_interval
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def add(self, todo_input: dict):
+        with self.lock:
+            self.pending.append(todo_input)
+            full = len(self.pending) >= self.batch_size
+        if full and self.worker is None:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        sent = self.published | self.unconfirmed
+        batch = [todo_input for todo_input in batch if todo_input['id'] not in sent]
+        for start in range(0, len(batch), self.batch_size):
+            inputs = batch[start:start+self.batch_size]
+            failed, error = [], None
+            try:
+                response = self.gq_client.execute(
+                    query=create_todo_mutation(len(inputs)),
+                    operation_name='createTodo',
+                    variables={f'input{i}': todo_input for i, todo_input in enumerate(inputs)})
+                applied = applied_inputs(response, len(inputs))
+            except OutcomeUnknown as exception:
+                # may have been applied: not queued again
+                self.unconfirmed.update(todo_input['id'] for todo_input in inputs)
+                error = exception
+            except ValueError as exception: # not a JSON body, nothing is known either
+                self.unconfirmed.update(todo_input['id'] for todo_input in inputs)
+                error = exception
+            except Exception as exception:
+                # not applied, queued again
+                failed, error = inputs, exception
+            else:
+                self.responses.append(response)
+                self.published.update(todo_input['id'] for todo_input, done in zip(inputs, applied) if done)
+                failed = [todo_input for todo_input, done in zip(inputs, applied) if not done]
+                if failed:
+                    error = RuntimeError(f'GraphQL errors: {json.loads(response).get("errors")}')
+            if error is not None:
+                # the failed inputs and the ones not sent yet stay queued for the next flush
+                self.errors.append((inputs, error))
+                with self.lock:
+                    self.pending = failed + batch[start+self.batch_size:] + self.pending
+                if self.worker is None:
+                    raise error
+                return
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if self.worker is not None:
+            self.stop_event.set()
+            self.worker.join()
+        self.flush()
+
+
+
+class LocalGraphqlServer:
+    # Stand-in for the AppSync endpoint on localhost. Every applied request
+    # body is kept in `requests`; `fail_next` answers that many requests with
+    # HTTP 503, `lose_next` applies that many and closes the connection
+    # without an answer, and the inputs whose id is in `error_ids` fail with
+    # a GraphQL error in a 200 response.
+
+    def __init__(self):
+        server = self
+        self.requests = []
+        self.connections = set()
+        self.fail_next = 0
+        self.lose_next = 0
+        self.error_ids = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server.connections.add(self.client_address)
+                if server.fail_next > 0:
+                    server.fail_next -= 1
+                    status, answer = 503, {'errors': [{'message': 'unavailable'}]}
+                else:
+                    aliases = [f'todo{i}' for i in range(len(body['variables']))]
+                    failed = [alias for alias, value in zip(aliases, body['variables'].values()) if value['id'] in server.error_ids]
+                    server.requests.append(dict(body, variables={name: value for name, value in body['variables'].items()
+                                                                 if value['id'] not in server.error_ids}))
+                    if server.lose_next > 0:
+                        server.lose_next -= 1
+                        self.close_connection = True
+                        return
+                    answer = {'data': {alias: None if alias in failed else dict(value, createdAt=None, updatedAt=None)
+                                       for alias, value in zip(aliases, body['variables'].values())}}
+                    if failed:
+                        answer['errors'] = [{'message': 'ConditionalCheckFailed', 'path': [alias]} for alias in failed]
+                    status = 200
+                data = json.dumps(answer).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = f'http://127.0.0.1:{self.httpd.server_address[1]}/graphql'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
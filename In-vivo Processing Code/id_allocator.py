@@ -0,0 +1,114 @@
+"""Hands out the record ids of the createTodo mutations. """
+
+
+import os, re, json, uuid, threading
+
+
+
+class IdAllocator:
+    # Reserves block_size ids with one atomic update of the counter item and
+    # hands them out locally until the block is used up. Ids of a block that is
+    # not used up (e.g. the container is recycled) are skipped, never reused.
+    # If the table cannot be reached, a uuid4 is returned instead; it cannot
+    # collide with the integer ids.
+
+    def __init__(self, table, counter_id: str = 'todo_counter', block_size: int = 50):
+        self.table = table
+        self.counter_id = counter_id
+        self.block_size = block_size
+        self.next_value = 0
+        self.last_value = -1 # empty block
+        self.lock = threading.Lock()
+        self.reservations = 0
+        self.fallbacks = 0
+
+    def reserve(self):
+        response = self.table.update_item(
+            Key={'CounterId': self.counter_id},
+            UpdateExpression='SET counter_value = if_not_exists(counter_value, :zero) + :increment',
+            ExpressionAttributeValues={':increment': self.block_size, ':zero': 0},
+            ReturnValues='UPDATED_NEW')
+        self.last_value = int(response['Attributes']['counter_value'])
+        self.next_value = self.last_value - self.block_size + 1
+        self.reservations += 1
+
+    def next_id(self) -> str:
+        with self.lock:
+            if self.next_value > self.last_value:
+                try:
+                    self.reserve()
+                except Exception as error:
+                    print(f'$$$ id block could not be reserved ({error}), using a uuid')
+                    self.fallbacks += 1
+                    return str(uuid.uuid4())
+            value = self.next_value
+            self.next_value += 1
+            return str(value)
+
+
+
+class MemoryTable:
+    # Stand-in for a DynamoDB Table keyed by CounterId. Implements get_item,
+    # put_item and the `SET a = [if_not_exists(a, :zero) | a] + :increment`
+    # updates used by the lambda.
+
+    UPDATE = re.compile(r'SET (\w+) = (?:if_not_exists\(\1, (:\w+)\)|\1) \+ (:\w+)$')
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_item(self, Key):
+        with self.lock:
+            item = self.load().get(Key['CounterId'])
+        return {} if item is None else {'Item': dict(item)}
+
+    def put_item(self, Item):
+        with self.lock:
+            items = self.load()
+            items[Item['CounterId']] = dict(Item)
+            self.save(items)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues='NONE'):
+        match = self.UPDATE.match(UpdateExpression.strip())
+        if match is None:
+            raise ValueError(f'Unsupported UpdateExpression: {UpdateExpression}')
+        attribute, zero, increment = match.groups()
+        with self.lock:
+            items = self.load()
+            item = items.setdefault(Key['CounterId'], dict(Key))
+            if attribute not in item:
+                if zero is None:
+                    raise ValueError(f'{attribute} does not exist') # DynamoDB ValidationException
+                item[attribute] = ExpressionAttributeValues[zero]
+            item[attribute] += ExpressionAttributeValues[increment]
+            self.save(items)
+        return {'Attributes': {attribute: item[attribute]}}
+
+    def load(self):
+        return self.items
+
+    def save(self, items):
+        self.items = items
+
+
+
+class FileTable(MemoryTable):
+    # MemoryTable persisted in a JSON file, so several runs (or a warm and an
+    # offline process taking turns) share the counters. Writes are atomic.
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+    def save(self, items):
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(items, file)
+        os.replace(self.path + '.tmp', self.path)
@@ -1,102 +1,174 @@
+import time
+INIT_START = time.perf_counter()
 
-import boto3, csv, json, uuid, os, sys
-from datetime import datetime
+import json, os, threading
 import numpy as np
-from requests_aws4auth import AWS4Auth
 
-from ProcessBMDL import *
-from sys import exit
-from urllib import request
+from ProcessBMDL import ProcessData
+from file_discovery import LatestFileCursor, DynamoMark, file_number
+from graphql_publisher import GraphqlClient, TodoPublisher
+from id_allocator import IdAllocator
+from warm_start import WarmStartCache, FileWarmStartCache
+from urllib import parse
+from concurrent.futures import ThreadPoolExecutor
 
 
 BUCKET_NAME = os.environ['BUCKET_NAME']
-s3_client = boto3.client('s3')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 8)) # objects fetched in parallel per event
+PUBLISH_BATCH_SIZE = int(os.environ.get('PUBLISH_BATCH_SIZE', 10)) # createTodo mutations per request
+ID_BLOCK_SIZE = int(os.environ.get('ID_BLOCK_SIZE', 50)) # record ids reserved per counter update
+CHUNK_SIZE = 1 << 20 # bytes of the S3 body read and parsed at a time
+FIT_METHOD = os.environ.get('FIT_METHOD', 'algebraic') # or 'ransac' to reject outlier echoes
+RANSAC_HYPOTHESES = int(os.environ.get('RANSAC_HYPOTHESES', 100)) # bounds the robust fit's latency
+WARM_START = os.environ.get('WARM_START') # opt-in seed of the minimize fits: 'memory' or a JSON file such as /tmp/warm_start.json
+GRAPHQL_ENDPOINT = 'https://sav4o2b7vra63eqfxafzktphpu.appsync-api.us-east-2.amazonaws.com/graphql'
+GRAPHQL_HEADERS = {'x-api-key': ' da2-t75j7zwzfbewxjaywrkz4avz6i'}
 
-dynamodb = boto3.resource('dynamodb')
-counter_table  = dynamodb.Table('Counter_Table')
+# Clients are created on first use and reused by every warm invocation.
+# The todo counter is not reset on import, the id allocator starts it at 0
+# when the item does not exist yet.
+_clients = {}
+_clients_lock = threading.RLock()
+init_report = {'cold_start': True, 'import_ms': None, 'clients_ms': {}}
 
-response = counter_table.put_item(
-    Item={  'CounterId': 'todo_counter',
-            'counter_value': 0})
 
-def lastFileinDirectory(response):
-    file_list = []
-    for content in response.get('Contents', []):
-        if '.csv' in content['Key'].lower():
-            file_list.append(content['Key'])
-    filenums = []
-    for file in file_list:
-        filenum = file.split('.')[0]
-        filenums.append(int(filenum))
-    filenums.sort()
-    return filenums[-1]
 
+def get_client(name: str):
+    # name: 's3', 'counter_table', 'id_allocator', 'graphql', 'publisher' or
+    # 'warm_start' (None unless WARM_START is set)
+    with _clients_lock:
+        if name not in _clients:
+            t0 = time.perf_counter()
+            if name == 's3':
+                import boto3
+                _clients[name] = boto3.client('s3')
+            elif name == 'counter_table':
+                import boto3
+                _clients[name] = boto3.resource('dynamodb').Table('Counter_Table')
+            elif name == 'id_allocator':
+                _clients[name] = IdAllocator(get_client('counter_table'), 'todo_counter', ID_BLOCK_SIZE)
+            elif name == 'graphql':
+                _clients[name] = GraphqlClient(GRAPHQL_ENDPOINT, GRAPHQL_HEADERS)
+            elif name == 'publisher':
+                _clients[name] = TodoPublisher(get_client('graphql'), PUBLISH_BATCH_SIZE)
+            elif name == 'warm_start':
+                _clients[name] = None if not WARM_START else WarmStartCache() if WARM_START == 'memory' else FileWarmStartCache(WARM_START)
+            init_report['clients_ms'][name] = round(1e3*(time.perf_counter()-t0), 1)
+        return _clients[name]
 
 
-def lambda_handler(event, context):
 
-    class GraphqlClient:
-
-        def __init__(self, endpoint, headers):
-            self.endpoint = endpoint
-            self.headers = headers
-
-        @staticmethod
-        def serialization_helper(o):
-            if isinstance(o, datetime):
-                return o.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-
-        def execute(self, query, operation_name, variables={}):
-            data = json.dumps({
-                "query": query,
-                "variables": variables,
-                "operationName": operation_name
-            },
-                default=self.serialization_helper,
-            )
-            r = request.Request(
-                headers=self.headers,
-                url=self.endpoint,
-                method='POST',
-                data=data.encode('utf8')
-            )
-            response = request.urlopen(r).read()
-            return response.decode('utf8')
-
-    gq_client = GraphqlClient(
-        endpoint='https://sav4o2b7vra63eqfxafzktphpu.appsync-api.us-east-2.amazonaws.com/graphql',
-        headers={'x-api-key': ' da2-t75j7zwzfbewxjaywrkz4avz6i'}
-    )
-
-    response = s3_client.list_objects_v2(Bucket=BUCKET_NAME)
-    LAST_FILE_NUM = lastFileinDirectory(response)
-
-    # For each unprocessed csv file, process the file and return output
-    csv_filename = str(LAST_FILE_NUM).lower() + '.csv'
-    csv_file = s3_client.get_object(Bucket=BUCKET_NAME, Key=csv_filename)
-    records_list = csv_file['Body'].read().decode('utf-8-sig').splitlines()   # make a list
-    
-        
-    reverse = False
-    if (records_list[0].split(','))[0] == 'CO Concentration': # if reverse order
-            reverse = True
-    np_records = np.zeros((len(records_list) , 2))
-    for idx,element in enumerate(records_list):
-        if idx == 0:
+def get_file_cursor():
+    # last processed file number is kept next to the todo counter
+    if 'file_cursor' not in _clients:
+        s3_client, counter_table = get_client('s3'), get_client('counter_table')
+        with _clients_lock:
+            _clients.setdefault('file_cursor', LatestFileCursor(s3_client, BUCKET_NAME, DynamoMark(counter_table, 'last_file')))
+    return _clients['file_cursor']
+
+
+
+def report_cold_start():
+    # Prints the init timings once per container, as a JSON line for the logs.
+    if init_report['cold_start']:
+        print(f"$$$ INIT {json.dumps(init_report)}")
+        init_report['cold_start'] = False
+
+
+
+def parse_csv_header(header: bytes):
+    # (number of columns, reverse). 'CO Concentration' as the first header
+    # means the piezo number and timestamp columns are swapped.
+    if header.startswith(b'\xef\xbb\xbf'):
+        header = header[3:] # utf-8-sig
+    header = header.rstrip(b'\r').split(b',')
+    return len(header), header[0].strip() == b'CO Concentration'
+
+
+
+def parse_csv_rows(rows: bytes, ncols: int, reverse: bool) -> np.array:
+    # Parses complete CSV lines into (N,2) records in one vectorized pass:
+    # column 0 is the piezo number (//1000), column 1 the timestamp (*100/32).
+    rows = rows.replace(b'\r', b'').strip(b'\n').replace(b'\n', b',')
+    values = np.fromstring(rows.decode('ascii'), dtype=float, sep=',').reshape(-1, ncols)
+    np_records = np.empty((values.shape[0], 2))
+    piezo_col, time_col = (1, 0) if reverse else (0, 1)
+    np.floor_divide(values[:,piezo_col], 1000, out=np_records[:,0]) # piezo number
+    np.multiply(values[:,time_col], 100, out=np_records[:,1])
+    np.divide(np_records[:,1], 32, out=np_records[:,1]) # timestamp
+    return np_records
+
+
+
+def parse_csv_records(body: bytes) -> np.array:
+    # Parses the raw CSV bytes into the (N,2) records array.
+    header, _, rows = body.partition(b'\n')
+    ncols, reverse = parse_csv_header(header)
+    return parse_csv_rows(rows, ncols, reverse)
+
+
+
+def parse_csv_stream(body, content_length: int = None, chunk_size: int = CHUNK_SIZE) -> np.array:
+    # Same result as parse_csv_records(body.read()), but the body is read and
+    # parsed chunk by chunk into one array that is preallocated from the
+    # content length (grown if the estimate is short) and trimmed in place.
+    # Peak memory is the records array plus one chunk.
+    buffer = b''
+    while b'\n' not in buffer:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+    header, _, buffer = buffer.partition(b'\n')
+    ncols, reverse = parse_csv_header(header)
+
+    line_length = max(len(buffer) / max(buffer.count(b'\n'), 1), 1)
+    capacity = int((content_length or len(buffer)) / line_length * 1.05) + 16
+    np_records = np.empty((capacity, 2))
+    count = 0
+    while True:
+        chunk = body.read(chunk_size)
+        buffer += chunk
+        cut = buffer.rfind(b'\n') + 1 if chunk else len(buffer) # last line may lack a newline
+        rows, buffer = buffer[:cut], buffer[cut:]
+        if rows.strip():
+            parsed = parse_csv_rows(rows, ncols, reverse)
+            if count + parsed.shape[0] > np_records.shape[0]:
+                np_records.resize((max(2*np_records.shape[0], count + parsed.shape[0]), 2), refcheck=False)
+            np_records[count:count+parsed.shape[0]] = parsed
+            count += parsed.shape[0]
+        if not chunk:
+            break
+    np_records.resize((count, 2), refcheck=False)
+    return np_records
+
+
+
+def event_csv_objects(event) -> list:
+    # (bucket, key) of every CSV in the S3 ObjectCreated records of the event
+    objects = []
+    for record in (event or {}).get('Records', []):
+        if not record.get('eventName', '').startswith('ObjectCreated') or 's3' not in record:
             continue
-        if reverse:
-            np_records[idx,0] = float(element.split(',')[1])//1000 # timestamp
-            np_records[idx,1] = float( element.split(',')[0] )*100 /32 # CO Concen
-        else:
-            np_records[idx,0] = float(element.split(',')[0])//1000 # timestamp
-            np_records[idx,1] = float( element.split(',')[1] )*100 /32 # CO Concen
-
-    SUCCESS, volume, r, C, coordinates, refined_timestmaps = ProcessData(csv_filename,np_records)
+        key = parse.unquote_plus(record['s3']['object']['key'])
+        if file_number(key) is not None:
+            objects.append((record['s3']['bucket']['name'], key))
+    return objects
+
+
+
+def process_object(bucket: str, csv_filename: str) -> dict:
+    # Downloads, parses and processes one CSV. Safe to run on worker threads.
+    csv_file = get_client('s3').get_object(Bucket=bucket, Key=csv_filename)
+    np_records = parse_csv_stream(csv_file['Body'], csv_file.get('ContentLength'))
+
+    SUCCESS, volume, r, C, coordinates, refined_timestmaps = ProcessData(csv_filename,np_records,
+                                                                         method=FIT_METHOD, hypotheses=RANSAC_HYPOTHESES,
+                                                                         warm_start=get_client('warm_start'), device=bucket)
     if not SUCCESS:
-        return None
-    volume = str(volume) + ' mL'
+        return {'key': csv_filename, 'success': False}
     print('...')
-    print(f"$$$ VOLUME = {volume}\n")
+    print(f"$$$ {csv_filename} VOLUME = {volume} mL\n")
     print('...')
     print(f"$$$ Rad = {r} mm \n")
     print(f"$$$ Center = {C} mm \n")
@@ -105,56 +177,83 @@ def lambda_handler(event, context):
     print('...')
     print('...')
     print('...')
+    return {'key': csv_filename, 'success': True, 'volume': int(volume),
+            'radius': float(r), 'center': [float(c) for c in C]}
 
 
-    response = counter_table.update_item(
-    Key={'CounterId': 'todo_counter'},
-    UpdateExpression='SET counter_value = counter_value + :increment',
-    ExpressionAttributeValues={':increment': 1},
-    ReturnValues='UPDATED_NEW')
-    counter = response['Attributes']['counter_value']
-         
-    result = gq_client.execute(query= """
-            mutation createTodo($createtodoinput: CreateTodoInput!) {
-            createTodo(input: $createtodoinput) {
-              id
-              piezo_no
-              bladder_volume
-              anterior_d1
-              anterior_d2
-              anterior_d3
-              anterior_d4
-              post_d1
-              post_d2
-              post_d3
-              post_d4
-              createdAt
-              updatedAt
-                }
-                }
-               """,
-               
-            
-        operation_name='createTodo',
-        variables={
-                    "createtodoinput":
-                        {           #id, counter ı dusun
-                            "id":str(counter),
-                            "piezo_no":0,
-                            "bladder_volume":str(volume),
-                            "anterior_d1":1,
-                            "anterior_d2":2,
-                            "anterior_d3":3,
-                            "anterior_d4":4,
-                            "post_d1":1,
-                            "post_d2":2,
-                            "post_d3":3,
-                            "post_d4":4
-                                
-                        }
-                })
 
+def lambda_handler(event, context):
+    publisher = get_client('publisher')
+    file_cursor = get_file_cursor()
+    report_cold_start()
+
+    # EVENT MODE: every CSV referenced by the S3 ObjectCreated records is
+    # processed, downloads run on a thread pool and the results are published
+    # in event order with one batched request per PUBLISH_BATCH_SIZE volumes.
+    # A failed publish request is reported in publish_errors and not raised:
+    # the objects were processed, and a retry of the whole event would send
+    # volumes that may already be applied again. The publisher keeps the
+    # inputs it can safely re-send for its next flush.
+    objects = event_csv_objects(event)
+    if objects:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(objects))) as pool:
+            futures = [pool.submit(process_object, bucket, key) for bucket, key in objects]
+        results, publish_errors = [], []
+        for (bucket, key), future in zip(objects, futures):
+            try:
+                result = future.result()
+            except Exception as error: # one bad upload must not drop the rest
+                result = {'key': key, 'success': False, 'error': str(error)}
+            if result['success']:
+                try: # add() may flush a batch of earlier volumes, its failure is not this object's
+                    publish_volume(publisher, str(result['volume']) + ' mL')
+                except Exception as error:
+                    publish_errors.append(f'{type(error).__name__}: {error}')
+            results.append(result)
+        try:
+            publisher.flush()
+        except Exception as error:
+            publish_errors.append(f'{type(error).__name__}: {error}')
+        # the polling mark is the one of BUCKET_NAME, it only moves over the
+        # files processed without an error that follow it without a gap
+        file_cursor.advance_over(file_number(key) for (bucket, key), result in zip(objects, results)
+                                 if bucket == BUCKET_NAME and 'error' not in result)
+        return {'results': results, 'publish_errors': publish_errors}
+
+    # POLLING MODE: the newest CSV after the last processed one
+    LAST_FILE_NUM = file_cursor.latest()
+    if LAST_FILE_NUM is None: # nothing uploaded since the last invocation
+        return None
 
+    csv_filename = str(LAST_FILE_NUM).lower() + '.csv'
+    result = process_object(BUCKET_NAME, csv_filename)
+    file_cursor.advance(LAST_FILE_NUM)
+    if not result['success']:
+        return None
+    publish_volume(publisher, str(result['volume']) + ' mL')
+    publisher.flush()
     return None
-    
 
+
+
+def publish_volume(publisher, volume: str):
+    # queues the createTodo input, publisher.flush() sends it
+    counter = get_client('id_allocator').next_id()
+
+    publisher.add({         #id, counter ı dusun
+                    "id":str(counter),
+                    "piezo_no":0,
+                    "bladder_volume":str(volume),
+                    "anterior_d1":1,
+                    "anterior_d2":2,
+                    "anterior_d3":3,
+                    "anterior_d4":4,
+                    "post_d1":1,
+                    "post_d2":2,
+                    "post_d3":3,
+                    "post_d4":4
+                })
+
+
+
+init_report['import_ms'] = round(1e3*(time.perf_counter()-INIT_START), 1)
@@ -0,0 +1,107 @@
+"""Sliding-window volume estimates of continuously streaming devices. """
+
+
+import time
+import numpy as np
+
+from ProcessBMDL import DEFAULT_LAYOUT, gate_echoes, Calc_Volume_1
+
+
+
+class VolumeStream:
+    # Keeps the last `capacity` timestamps of every transducer of one device in
+    # a ring buffer, so the memory per device is constant. Records are added as
+    # they arrive; a new volume is fitted after every `emit_records` records or
+    # `emit_seconds` seconds (whichever comes first); a minimize fallback
+    # starts from the sphere of the previous estimate. The gating is the same
+    # as ProcessData's.
+
+    def __init__(self, layout=DEFAULT_LAYOUT, capacity: int = 256, emit_records: int = 64, emit_seconds: float = None,
+                 windows=((15, 40), (105, 120)), strategies=("mean", "mean"), sound_speed: float = 1420, clock=time.monotonic):
+        self.layout = layout
+        self.capacity = capacity
+        self.emit_records = emit_records
+        self.emit_seconds = emit_seconds
+        self.windows = windows
+        self.strategies = strategies
+        self.sound_speed = sound_speed # m/s
+        self.clock = clock
+        self.buffer = np.zeros((len(layout), capacity))
+        self.position = np.zeros(len(layout), dtype=int) # next slot to write
+        self.filled = np.zeros(len(layout), dtype=int)
+        self.pending = 0 # records since the last estimate
+        self.last_emit = clock()
+        self.parameters = None # (x0, y0, z0, r) of the last estimate
+
+    def add(self, piezonumbers, timestamps):
+        # Adds the records (arrays or scalars) and returns the new estimate if
+        # one is due, otherwise None. At most one estimate per call.
+        piezonumbers, timestamps = np.atleast_1d(piezonumbers), np.atleast_1d(timestamps)
+        grouped, offsets = self.layout.group(piezonumbers, timestamps)
+        counts = np.diff(offsets)
+        # slot of every new timestamp, only the last `capacity` of a transducer are kept
+        transducer = np.repeat(np.arange(counts.size), counts)
+        rank = np.arange(grouped.size) - offsets[transducer]
+        newest = rank >= (counts - self.capacity)[transducer]
+        slot = (self.position[transducer] + rank) % self.capacity
+        self.buffer[transducer[newest], slot[newest]] = grouped[newest]
+        self.position = (self.position + counts) % self.capacity
+        self.filled = np.minimum(self.filled + counts, self.capacity)
+        self.pending += grouped.size
+
+        due = self.pending >= self.emit_records or (
+            self.emit_seconds is not None and self.pending > 0 and self.clock() - self.last_emit >= self.emit_seconds)
+        return self.estimate() if due else None
+
+    def window(self):
+        # (grouped, offsets) of the buffered timestamps, oldest first
+        age = np.arange(self.capacity)
+        slots = (self.position[:,None] - self.filled[:,None] + age) % self.capacity
+        grouped = self.buffer[np.arange(len(self.layout))[:,None], slots][age < self.filled[:,None]]
+        return grouped, np.concatenate(([0], np.cumsum(self.filled)))
+
+    def estimate(self):
+        # Fits the buffered window. Returns a dict with the volume [mL], radius
+        # [mm] and center [mm], or None if fewer than 4 walls were found.
+        self.pending = 0
+        self.last_emit = self.clock()
+        refined = gate_echoes(*self.window(), self.windows, self.strategies)
+        found = ~np.isnan(refined)
+        if np.count_nonzero(found) < 4:
+            return None
+        transducer, _ = np.nonzero(found)
+        dist = self.sound_speed * refined[found] * 1E-3 / 2 # in mm
+        coordinates = np.column_stack((self.layout.xy[transducer], dist))
+        volume, r, C = Calc_Volume_1(coordinates, initial=self.parameters)
+        self.parameters = np.array([*C, r])
+        return {'volume': volume, 'radius': r, 'center': C, 'coordinates': coordinates.shape[0]}
+
+
+
+class StreamPool:
+    # VolumeStream per device, created on the first record of the device.
+    # Devices idle for longer than `idle_seconds` are dropped by prune().
+
+    def __init__(self, idle_seconds: float = 3600, clock=time.monotonic, **stream_options):
+        self.streams = {}
+        self.last_seen = {}
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self.stream_options = dict(stream_options, clock=clock)
+
+    def add(self, device, piezonumbers, timestamps):
+        if device not in self.streams:
+            self.streams[device] = VolumeStream(**self.stream_options)
+        self.last_seen[device] = self.clock()
+        return self.streams[device].add(piezonumbers, timestamps)
+
+    def prune(self) -> int:
+        # number of dropped devices
+        now = self.clock()
+        idle = [device for device, seen in self.last_seen.items() if now - seen > self.idle_seconds]
+        for device in idle:
+            del self.streams[device], self.last_seen[device]
+        return len(idle)
+
+    def __len__(self):
+        return len(self.streams)
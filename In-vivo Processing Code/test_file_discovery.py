@@ -0,0 +1,50 @@
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+from file_discovery import window_listings, LocalBucketClient, LatestFileCursor, FileMark
+
+
+def listed(keys, prefix, start_after):
+    # what list_objects_v2 returns for a bucket holding keys
+    return {int(key[:-4]) for key in keys if key.startswith(prefix) and key > start_after}
+
+
+@pytest.mark.parametrize("window", [1, 10, 1000])
+@pytest.mark.parametrize("mark", [0, 8, 9, 10, 98, 99, 100, 999, 1999, 12345])
+def test_listings_have_a_prefix_and_cover_the_window(mark, window):
+    keys = [f'{number}.csv' for number in range(1, mark + window + 20)]
+    found = set()
+    for prefix, start_after in window_listings(mark, window):
+        assert prefix != ''
+        found |= listed(keys, prefix, start_after)
+    assert set(range(mark + 1, mark + window + 1)) <= found
+
+
+def test_single_numbers_are_listed_by_name():
+    assert window_listings(9, 1) == [('10.', '')]
+    assert window_listings(99, 1) == [('100.', '')]
+    assert window_listings(0, 1) == [('1.', '0.csv')]
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    os.makedirs(tmp_path / 'device')
+    for number in range(1, 121):
+        (tmp_path / 'device' / f'{number}.csv').write_text('Piezo,Time\n')
+    mark = FileMark(str(tmp_path / 'mark.json'))
+    return LatestFileCursor(LocalBucketClient(str(tmp_path)), 'device', mark, window=10), mark
+
+
+@pytest.mark.parametrize("last", [0, 9, 95, 99, 110])
+def test_new_files_are_the_files_after_the_mark(bucket, last):
+    cursor, mark = bucket
+    mark.set(last)
+    assert cursor.new_files() == list(range(last + 1, 121))
+
+
+def test_without_a_mark_the_bucket_is_listed(bucket):
+    cursor, mark = bucket
+    assert cursor.new_files() == list(range(1, 121))
+    cursor.advance(120)
+    assert mark.get() == 120 and cursor.new_files() == []
@@ -0,0 +1,57 @@
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+from graphql_publisher import LocalGraphqlServer, GraphqlClient, TodoPublisher, OutcomeUnknown
+
+
+@pytest.fixture
+def server():
+    server = LocalGraphqlServer()
+    yield server
+    server.close()
+
+
+def todos(*ids):
+    return [{'id': str(i), 'piezo_no': 0, 'bladder_volume': '100 mL'} for i in ids]
+
+
+def published_ids(server):
+    return [value['id'] for body in server.requests for value in body['variables'].values()]
+
+
+def test_throttled_requests_are_retried(server):
+    publisher = TodoPublisher(GraphqlClient(server.endpoint, {}, backoff=0), batch_size=2)
+    server.fail_next = 2
+    for todo in todos(1, 2, 3):
+        publisher.add(todo)
+    publisher.flush()
+    assert published_ids(server) == ['1', '2', '3']
+
+
+def test_a_request_without_an_answer_is_not_sent_again(server):
+    publisher = TodoPublisher(GraphqlClient(server.endpoint, {}, backoff=0), batch_size=2)
+    server.lose_next = 1
+    publisher.add(todos(1)[0])
+    with pytest.raises(OutcomeUnknown): # the second add flushes, the server applies it and drops the connection
+        publisher.add(todos(2)[0])
+    assert publisher.pending == []
+    assert publisher.unconfirmed == {'1', '2'}
+    for todo in todos(1, 3): # 1 again must not be sent twice
+        publisher.add(todo)
+    publisher.flush()
+    assert published_ids(server) == ['1', '2', '3']
+
+
+def test_graphql_errors_are_failures(server):
+    publisher = TodoPublisher(GraphqlClient(server.endpoint, {}, backoff=0), batch_size=3)
+    server.error_ids = {'2'}
+    for todo in todos(1, 2):
+        publisher.add(todo)
+    with pytest.raises(RuntimeError):
+        publisher.flush()
+    assert publisher.published == {'1'}
+    assert [todo['id'] for todo in publisher.pending] == ['2'] # only the failed input is queued again
+    server.error_ids = set()
+    publisher.flush()
+    assert published_ids(server) == ['1', '2']
@@ -0,0 +1,72 @@
+import os, sys, uuid
+import threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+from id_allocator import IdAllocator, MemoryTable, FileTable
+
+
+class FailingTable:
+    def __init__(self):
+        self.calls = 0
+    def update_item(self, **kwargs):
+        self.calls += 1
+        raise ConnectionError('table unreachable')
+
+
+@pytest.fixture(params=['memory', 'file'])
+def table(request, tmp_path):
+    return MemoryTable() if request.param == 'memory' else FileTable(str(tmp_path / 'counters.json'))
+
+
+def test_a_block_is_reserved_from_a_missing_counter(table):
+    allocator = IdAllocator(table, block_size=5)
+    assert [allocator.next_id() for _ in range(7)] == ['1', '2', '3', '4', '5', '6', '7']
+    assert allocator.reservations == 2
+    assert table.get_item(Key={'CounterId': 'todo_counter'})['Item']['counter_value'] == 10
+
+
+def test_the_counter_must_exist_without_if_not_exists(table):
+    with pytest.raises(ValueError):
+        table.update_item(Key={'CounterId': 'todo_counter'}, UpdateExpression='SET counter_value = counter_value + :increment',
+                          ExpressionAttributeValues={':increment': 1})
+    table.put_item(Item={'CounterId': 'todo_counter', 'counter_value': 41})
+    response = table.update_item(Key={'CounterId': 'todo_counter'}, UpdateExpression='SET counter_value = counter_value + :increment',
+                                 ExpressionAttributeValues={':increment': 1}, ReturnValues='UPDATED_NEW')
+    assert response['Attributes']['counter_value'] == 42
+
+
+def test_allocators_sharing_a_table_hand_out_disjoint_ids(table):
+    first, second = IdAllocator(table, block_size=3), IdAllocator(table, block_size=4)
+    ids = [allocator.next_id() for _ in range(10) for allocator in (first, second)]
+    assert len(set(ids)) == len(ids)
+    assert first.fallbacks == second.fallbacks == 0
+
+
+def test_threads_of_one_allocator_hand_out_disjoint_ids():
+    allocator = IdAllocator(MemoryTable(), block_size=7)
+    ids = []
+    def take():
+        for _ in range(50):
+            ids.append(allocator.next_id())
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(map(int, ids)) == list(range(1, 201))
+
+
+def test_file_table_counters_outlive_the_allocator(tmp_path):
+    path = str(tmp_path / 'counters.json')
+    assert IdAllocator(FileTable(path), block_size=10).next_id() == '1'
+    assert IdAllocator(FileTable(path), block_size=10).next_id() == '11' # the rest of the first block is skipped
+
+
+def test_a_uuid_is_returned_when_the_table_fails():
+    table = FailingTable()
+    allocator = IdAllocator(table)
+    ids = [allocator.next_id(), allocator.next_id()]
+    assert all(uuid.UUID(value).version == 4 for value in ids) and ids[0] != ids[1]
+    assert allocator.fallbacks == 2 and allocator.reservations == 0
+    assert table.calls == 2 # every id retries the reservation
@@ -0,0 +1,148 @@
+import os, sys, io, subprocess
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__)) # lambda_function imports its neighbours by name
+os.environ.setdefault('BUCKET_NAME', 'device')
+import lambda_function, ProcessBMDL
+from file_discovery import LocalBucketClient, LatestFileCursor, FileMark
+from graphql_publisher import OutcomeUnknown
+
+
+class Publisher:
+    # fail_add: number of the add() call that raises, fail_flush: flush() raises
+    def __init__(self, fail_add=None, fail_flush=False):
+        self.items = []
+        self.fail_add, self.fail_flush = fail_add, fail_flush
+    def add(self, item):
+        self.items.append(item)
+        if len(self.items) == self.fail_add:
+            raise RuntimeError('batch failed')
+    def flush(self):
+        if self.fail_flush:
+            raise OutcomeUnknown('no answer')
+
+
+class Ids:
+    def __init__(self):
+        self.counter = 0
+    def next_id(self):
+        self.counter += 1
+        return self.counter
+
+
+def recording():
+    # CSV of a 2x2 array under a sphere: two close timestamps per wall, in
+    # device units (piezo number * 1000, time * 32/100 us)
+    lines = ['Piezo,Time']
+    for number, (x, y) in zip(ProcessBMDL.DEFAULT_LAYOUT.numbers, ProcessBMDL.DEFAULT_LAYOUT.xy):
+        half = np.sqrt(30**2 - (x-6.5)**2 - (y-6.5)**2)
+        for z in (50-half, 50+half):
+            t = 2*z/(1420*1E-3)
+            lines += [f'{number*1000},{t*32/100:.4f}', f'{number*1000},{(t+0.3)*32/100:.4f}']
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    bucket = lambda_function.BUCKET_NAME
+    os.makedirs(tmp_path / bucket)
+    for number in (1, 2, 3, 10, 11):
+        (tmp_path / bucket / f'{number}.csv').write_text(recording())
+    client = LocalBucketClient(str(tmp_path))
+    mark = FileMark(str(tmp_path / 'mark.json'))
+    mark.set(0)
+    def run(*keys, bucket=bucket, publisher=None):
+        monkeypatch.setitem(lambda_function._clients, 'publisher', publisher or Publisher())
+        records = [{'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': bucket}, 'object': {'key': key}}} for key in keys]
+        return lambda_function.lambda_handler({'Records': records}, None)
+    monkeypatch.setattr(lambda_function, '_clients', {'s3': client, 'id_allocator': Ids(), 'warm_start': None,
+                                                      'file_cursor': LatestFileCursor(client, bucket, mark)})
+    return run, mark
+
+
+def test_event_mode_moves_the_mark_only_over_contiguous_files(handler):
+    run, mark = handler
+    run('10.csv', '11.csv', '1.csv')
+    assert mark.get() == 1 # 2.csv and 3.csv are still after the mark
+    run('2.csv', '3.csv')
+    assert mark.get() == 3
+
+
+def test_event_mode_does_not_move_the_mark_over_failed_files(handler):
+    run, mark = handler
+    results = run('1.csv', '4.csv', '2.csv') # 4.csv does not exist
+    assert [('error' in result) for result in results['results']] == [False, True, False]
+    assert mark.get() == 2
+
+
+def test_event_mode_ignores_other_buckets(handler, tmp_path):
+    run, mark = handler
+    os.makedirs(tmp_path / 'other')
+    (tmp_path / 'other' / '1.csv').write_text('Piezo,Time\n1000,100\n')
+    run('1.csv', bucket='other')
+    assert mark.get() == 0
+
+
+def test_a_failed_batch_is_not_a_processing_error(handler):
+    run, mark = handler
+    response = run('1.csv', '2.csv', '3.csv', publisher=Publisher(fail_add=2))
+    assert all(result['success'] and 'error' not in result for result in response['results'])
+    assert response['publish_errors'] == ['RuntimeError: batch failed']
+    assert mark.get() == 3
+
+
+def test_a_failed_final_flush_is_reported_not_raised(handler):
+    run, mark = handler
+    response = run('1.csv', '2.csv', publisher=Publisher(fail_flush=True))
+    assert response['publish_errors'] == ['OutcomeUnknown: no answer']
+    assert mark.get() == 2
+
+
+def parse_rows_one_by_one(text: str) -> np.array:
+    # the per-row loop parse_csv_records replaced, without its empty first row
+    records_list = text.splitlines()
+    reverse = records_list[0].split(',')[0] == 'CO Concentration'
+    np_records = np.zeros((len(records_list)-1, 2))
+    for idx, element in enumerate(records_list[1:]):
+        piezo, time = element.split(',')[1::-1] if reverse else element.split(',')[:2]
+        np_records[idx] = float(piezo)//1000, float(time)*100/32
+    return np_records
+
+
+@pytest.mark.parametrize('text', [recording(), 'CO Concentration,Piezo,Other\r\n412.5,2000,7\r\n96.25,3999,7\r\n'])
+def test_vectorized_parse_matches_the_row_loop(text):
+    body = ('\ufeff' + text).encode('utf8')
+    assert np.array_equal(lambda_function.parse_csv_records(body), parse_rows_one_by_one(text))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 17, 1 << 20])
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+@pytest.mark.parametrize('last_newline', [True, False])
+def test_streamed_parse_matches_the_whole_body(chunk_size, newline, last_newline):
+    text = recording().replace('\n', newline)
+    body = ('\ufeff' + (text if last_newline else text[:-len(newline)])).encode('utf8')
+    expected = lambda_function.parse_csv_records(body)
+    for content_length in (len(body), 40, None): # exact, short (the array grows) and unknown
+        streamed = lambda_function.parse_csv_stream(io.BytesIO(body), content_length, chunk_size)
+        assert np.array_equal(streamed, expected)
+
+
+def test_streamed_parse_of_a_body_without_rows():
+    assert lambda_function.parse_csv_stream(io.BytesIO(b'Piezo,Time\r\n'), chunk_size=3).shape == (0, 2)
+
+
+def test_clients_and_scipy_are_loaded_on_first_use():
+    script = '''
+import sys
+import lambda_function, ProcessBMDL
+assert 'scipy' not in sys.modules and 'boto3' not in sys.modules and not lambda_function._clients
+graphql = lambda_function.get_client('graphql')
+assert lambda_function.get_client('publisher').gq_client is graphql is lambda_function.get_client('graphql')
+assert list(lambda_function.init_report['clients_ms']) == ['graphql', 'publisher']
+assert 'scipy' not in sys.modules
+ProcessBMDL.Calc_Volume_1(ProcessBMDL.np.array([[0, 0, 20], [13, 0, 21], [0, 13, 22], [13, 13, 80]]), method='minimize')
+assert 'scipy.optimize' in sys.modules
+'''
+    subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                   env=dict(os.environ, BUCKET_NAME='device'))
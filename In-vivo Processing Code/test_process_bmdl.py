@@ -0,0 +1,93 @@
+import importlib.util, os
+import numpy as np
+import pytest
+
+
+def load(name):
+    # the folders share module names, so the module next to this file is loaded by path
+    spec = importlib.util.spec_from_file_location(f"invivo_{name}", os.path.join(os.path.dirname(__file__), f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+ProcessBMDL = load("ProcessBMDL")
+TransducerLayout = ProcessBMDL.TransducerLayout
+
+
+def recording(layout, center, r, rng=None, shifted={}):
+    # (N,2) records of one monitoring session sorted by time, piezo number and time [us] columns:
+    # two echoes 0.3 us apart on each wall the transducer sees and a lone noise timestamp before it.
+    # rng adds 0.3 us of jitter per wall, shifted moves a wall: {(piezo number, 0 or 1): us}
+    rows = []
+    for number, (x, y) in zip(layout.numbers, layout.xy):
+        depth = r**2 - (x-center[0])**2 - (y-center[1])**2
+        if depth <= 0:
+            continue
+        for wall, z in enumerate((center[2]-np.sqrt(depth), center[2]+np.sqrt(depth))):
+            t = 2*z/(1420*1E-3) + (0 if rng is None else rng.normal(0, 0.3)) + shifted.get((number, wall), 0)
+            rows += [(number, t), (number, t+0.3), (number, t-3)]
+    rows = np.array(rows)
+    return rows[np.argsort(rows[:,1], kind='stable')]
+
+
+def process(records, layout, method="algebraic"):
+    # ProcessData without its printout: (success, volume, r, center, coordinates)
+    return ProcessBMDL.ProcessData("session.csv", records, layout, method)[:5]
+
+
+@pytest.mark.parametrize("columns, rows", [(2, 2), (3, 2), (3, 3)])
+def test_algebraic_matches_minimize(columns, rows):
+    layout = TransducerLayout.grid(columns, rows, 13)
+    middle = layout.xy.mean(axis=0)
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        center = (*(middle + rng.uniform(-3, 3, 2)), rng.uniform(47, 50))
+        records = recording(layout, center, rng.uniform(33, 35), rng)
+        success, volume, r, C, coordinates = process(records, layout)
+        assert success and coordinates.shape[0] >= 4
+        reference = process(records, layout, "minimize")
+        assert r == pytest.approx(reference[2], rel=1e-4)
+        assert abs(volume - reference[1]) <= 1 # volumes are rounded to mL
+
+
+def test_two_transducers_fall_back_to_minimize():
+    layout = TransducerLayout({1: (0, 0), 4: (13, 13)}) # the walls of a diagonal pair are coplanar
+    success, volume, r, C, coordinates = process(recording(layout, (6, 7, 50), 32), layout)
+    assert success and coordinates.shape == (4, 3)
+    info = {}
+    assert ProcessBMDL.Calc_Volume_1(coordinates, info=info)[1] == pytest.approx(r)
+    assert info['fallback']
+    assert r == pytest.approx(process(recording(layout, (6, 7, 50), 32), layout, "minimize")[2])
+
+
+def test_center_outside_the_bounds_falls_back_to_minimize():
+    # an array off to the side of the bladder, the exact center x = 30 is outside the (-20, 20) bound
+    layout = TransducerLayout({1 + i + 3*j: (12 + 8*i, 8*j) for i in range(3) for j in range(2)})
+    records = recording(layout, (30, 4, 50), 32)
+    coordinates = process(records, layout)[4]
+    info = {}
+    r = ProcessBMDL.Calc_Volume_1(coordinates, info=info)[1]
+    assert info['fallback']
+    assert r == pytest.approx(process(records, layout, "minimize")[2])
+
+
+def test_ransac_rejects_a_reverberation():
+    layout = TransducerLayout.grid(3, 3, 13)
+    center, r = (13, 13, 48), 35
+    records = recording(layout, center, r, shifted={(5, 1): -6}) # an early posterior echo of the middle transducer
+    coordinates = process(records, layout)[4]
+    assert coordinates.shape == (18, 3)
+    info = {}
+    fitted = ProcessBMDL.Calc_Volume_1(coordinates, "ransac", info=info)[1]
+    assert info['rejected'].tolist() == [9] # transducer 5, posterior
+    assert process(records, layout, "ransac")[2] == pytest.approx(fitted)
+    assert abs(fitted - r) < abs(process(records, layout)[2] - r)/5 # the plain fit is pulled by the early echo
+
+
+def test_ransac_small_and_coplanar_sets_get_the_minimize_result():
+    diagonal = TransducerLayout({1: (0, 0), 4: (13, 13)})
+    row = TransducerLayout.grid(2, 1, 13)
+    for layout, shifted in ((diagonal, {}), (row, {(1, 0): 20})): # an outlier the 3 others cannot outvote
+        records = recording(layout, (6, 7, 50), 32, shifted=shifted)
+        assert process(records, layout, "ransac")[2] == pytest.approx(process(records, layout, "minimize")[2], rel=1e-4)
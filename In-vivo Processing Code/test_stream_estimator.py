@@ -0,0 +1,84 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+import stream_estimator
+from stream_estimator import VolumeStream, StreamPool
+from ProcessBMDL import DEFAULT_LAYOUT, TransducerLayout
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+
+def recording(center=(6.5, 6.5, 50), r=30):
+    # two close timestamps per wall of a sphere under the default array,
+    # piezo number and time [us] columns
+    rows = []
+    for number, (x, y) in zip(DEFAULT_LAYOUT.numbers, DEFAULT_LAYOUT.xy):
+        half = np.sqrt(r**2 - (x-center[0])**2 - (y-center[1])**2)
+        for z in (center[2]-half, center[2]+half):
+            t = 2*z/(1420*1E-3)
+            rows += [(number, t), (number, t+0.3)]
+    return np.array(rows)
+
+
+def test_ring_buffer_keeps_the_last_records_oldest_first():
+    layout = TransducerLayout.grid(2, 1, 13)
+    stream = VolumeStream(layout, capacity=4, emit_records=1000)
+    first, second = layout.numbers
+    stream.add([first]*3, [1, 2, 3])
+    stream.add([first]*3 + [second], [4, 5, 6, 100]) # wraps around
+    stream.add([first]*6, [7, 8, 9, 10, 11, 12]) # more than the capacity in one call
+    grouped, offsets = stream.window()
+    assert offsets.tolist() == [0, 4, 5]
+    assert grouped.tolist() == [9, 10, 11, 12, 100]
+
+
+def test_an_estimate_is_emitted_every_emit_records_records():
+    data = recording()
+    stream = VolumeStream(emit_records=len(data))
+    emitted = [i for i, (number, t) in enumerate(np.vstack((data, data))) if stream.add(number, t) is not None]
+    assert emitted == [len(data)-1, 2*len(data)-1]
+    assert stream.pending == 0
+
+
+def test_an_estimate_is_emitted_after_emit_seconds():
+    clock = Clock()
+    data = recording()
+    stream = VolumeStream(emit_records=1000, emit_seconds=5, clock=clock)
+    assert stream.add(data[:-1,0], data[:-1,1]) is None
+    clock.now = 5
+    estimate = stream.add(data[-1,0], data[-1,1])
+    assert estimate is not None and estimate['coordinates'] == 8
+    assert np.isclose(estimate['radius'], 30, atol=0.5)
+    assert stream.last_emit == 5
+
+
+def test_the_fit_starts_from_the_previous_estimate(monkeypatch):
+    seeds = []
+    fit = stream_estimator.Calc_Volume_1
+    def spy(coordinates, initial=None):
+        seeds.append(initial)
+        return fit(coordinates, initial=initial)
+    monkeypatch.setattr(stream_estimator, 'Calc_Volume_1', spy)
+    data = recording()
+    stream = VolumeStream(emit_records=len(data))
+    first = stream.add(data[:,0], data[:,1])
+    stream.add(data[:,0], data[:,1])
+    assert seeds[0] is None
+    assert np.allclose(seeds[1], [*first['center'], first['radius']])
+
+
+def test_pool_drops_idle_devices():
+    clock = Clock()
+    pool = StreamPool(idle_seconds=60, clock=clock, emit_records=1000)
+    pool.add('a', 1, 30)
+    clock.now = 50
+    pool.add('b', 1, 30)
+    clock.now = 100
+    assert pool.prune() == 1
+    assert list(pool.streams) == ['b']
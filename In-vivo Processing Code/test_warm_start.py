@@ -0,0 +1,83 @@
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+from warm_start import WarmStartCache, FileWarmStartCache
+from ProcessBMDL import ProcessData, TransducerLayout, Calc_Volume_1
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+
+def recording(layout, center=(6.5, 6.5, 50), r=30):
+    # two close timestamps per wall of a sphere, piezo number and time [us] columns
+    rows = []
+    for number, (x, y) in zip(layout.numbers, layout.xy):
+        half = np.sqrt(r**2 - (x-center[0])**2 - (y-center[1])**2)
+        for z in (center[2]-half, center[2]+half):
+            t = 2*z/(1420*1E-3)
+            rows += [(number, t), (number, t+0.3)]
+    return np.array(rows)
+
+
+def test_least_recently_used_device_is_evicted():
+    cache = WarmStartCache(capacity=2)
+    cache.put('a', (0, 0, 50, 30))
+    cache.put('b', (0, 0, 60, 30))
+    assert cache.get('a') == [0, 0, 50, 30]
+    cache.put('c', (0, 0, 70, 30))
+    assert cache.get('b') is None
+    assert len(cache) == 2 and cache.get('a') is not None
+    assert cache.stats['evictions'] == 1 and cache.stats['hits'] == 2 and cache.stats['misses'] == 1
+
+
+def test_entries_expire_after_the_ttl():
+    clock = Clock()
+    cache = WarmStartCache(ttl=60, clock=clock)
+    cache.put('a', (0, 0, 50, 30))
+    clock.now = 61
+    assert cache.get('a') is None
+    assert cache.stats['expired'] == 1 and len(cache) == 0
+
+
+def test_file_cache_outlives_the_process(tmp_path):
+    path = str(tmp_path / 'warm_start.json')
+    FileWarmStartCache(path).put('a', (1, 2, 50, 30), iterations=7)
+    assert FileWarmStartCache(path).get('a') == [1, 2, 50, 30]
+
+
+def test_the_seed_does_not_change_the_closed_form_result():
+    layout = TransducerLayout.grid(2, 2, 13)
+    data = recording(layout)
+    cold = ProcessData('1.csv', data, layout)
+    cache = WarmStartCache()
+    cache.put('device', (-15, 15, 100, 20)) # far from the sphere
+    warm = ProcessData('1.csv', data, layout, warm_start=cache, device='device')
+    assert warm[1] == cold[1] and np.allclose(warm[3], cold[3])
+    assert cache.stats['hits'] == 1 and cache.stats['warm_fits'] == cache.stats['cold_fits'] == 0
+
+
+def test_the_minimize_fallback_starts_from_the_device_sphere():
+    layout = TransducerLayout.grid(2, 1, 13) # one row of transducers is coplanar, the closed form falls back
+    data = recording(layout, center=(6.5, 0, 50))
+    cache = WarmStartCache()
+    ProcessData('1.csv', data, layout, warm_start=cache, device='device')
+    assert cache.stats['misses'] == 1 and cache.stats['cold_fits'] == 1
+    ProcessData('2.csv', data, layout, warm_start=cache, device='device')
+    assert cache.stats['hits'] == 1 and cache.stats['warm_fits'] == 1
+    assert cache.mean_iterations()['warm'] <= cache.mean_iterations()['cold']
+
+
+def test_only_the_minimize_fits_take_the_seed():
+    coordinates = np.array([[0,0,20.3], [0,0,83.9], [13,13,19.8], [13,13,78.8]]) # coplanar
+    info = {}
+    Calc_Volume_1(coordinates, initial=[6.5, 6.5, 50, 32], info=info)
+    assert info['fallback'] and info['seeded']
+    info = {}
+    Calc_Volume_1(coordinates, "ransac", info=info)
+    assert not info['seeded']
@@ -0,0 +1,91 @@
+"""Keeps the last fitted sphere of every device to start its next fit from. """
+
+
+import os, json, time, threading
+from collections import OrderedDict
+
+
+
+class WarmStartCache:
+    # LRU cache of (x0, y0, z0, r) keyed by device or session. Entries older
+    # than ttl seconds are not used. Holds at most `capacity` devices, the
+    # least recently used is dropped first. `stats` counts the lookups and the
+    # optimizer iterations of the minimize fits, warm (started from a cached
+    # sphere) or cold. Only the minimize fits take the seed, the closed-form
+    # fit does not depend on it, so neither do the results of the sets it fits.
+
+    def __init__(self, capacity: int = 1024, ttl: float = 6*3600, clock=time.time):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0,
+                      'warm_fits': 0, 'warm_iterations': 0, 'cold_fits': 0, 'cold_iterations': 0}
+        self.entries = OrderedDict(self.load()) # key: (parameters, time stored)
+
+    def get(self, key):
+        # parameters of the device, or None
+        key = str(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.clock() - entry[1] > self.ttl:
+                del self.entries[key]
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return list(entry[0])
+
+    def put(self, key, parameters, iterations: int = None, warm: bool = False):
+        # stores the fitted parameters; iterations (of a minimize fit, None
+        # otherwise) and warm (the fit was seeded by get()) only go into the stats
+        key = str(key)
+        with self.lock:
+            self.entries[key] = ([float(p) for p in parameters], self.clock())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+            if iterations is not None:
+                fit = 'warm' if warm else 'cold'
+                self.stats[f'{fit}_fits'] += 1
+                self.stats[f'{fit}_iterations'] += iterations
+            self.save(self.entries)
+
+    def mean_iterations(self) -> dict:
+        # mean optimizer iterations of the warm and the cold fits
+        return {fit: self.stats[f'{fit}_iterations'] / self.stats[f'{fit}_fits'] if self.stats[f'{fit}_fits'] else None
+                for fit in ('warm', 'cold')}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        return {}
+
+    def save(self, entries):
+        pass
+
+
+
+class FileWarmStartCache(WarmStartCache):
+    # WarmStartCache persisted in a JSON file, so the parameters outlive the
+    # process (offline runs, a lambda container's /tmp). Writes are atomic.
+
+    def __init__(self, path: str, capacity: int = 1024, ttl: float = 6*3600, clock=time.time):
+        self.path = path
+        super().__init__(capacity, ttl, clock)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'r') as file:
+            return {key: (parameters, stored) for key, (parameters, stored) in json.load(file).items()}
+
+    def save(self, entries):
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(entries, file)
+        os.replace(self.path + '.tmp', self.path)
@@ -4,7 +4,10 @@ import matplotlib as mpl
 from scipy.interpolate import interp1d
 from scipy.integrate import simpson, cumulative_trapezoid
 import matplotlib as mpl
-import os
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Effect of Number of Piezoceramics on Algorithm Performance',
+                'In-vitro processing to get n_10 estimation results')) # scan_cube.py is kept once, with the n_10 code
+from scan_cube import open_cube, convert_profile_scan
 
 class Data1D():
     """
@@ -20,13 +23,15 @@ class Data1D():
                  center_frequency_Hz:float,
                  pulse_repetition_frequency_Hz:float,
                  scanned_axis_letter:str,
-                 export_folder:str = ""):
+                 export_folder:str = "",
+                 cube_file:str = None):
         """
         PA_map_output_name: the path to the UMSmap file of the scan
         PA_raw_output_prefix_name: the path to the individual volt vs time data files, excluding the "Y000X000.txt" part
         center_frequency_Hz: center frequency used in the test, in Herz
         pulse_repetition_frequency_Hz: pulse repetition frequency used in the test, in Herz 
-        export_folder: the path that the figures and exported data files will be saved"""
+        export_folder: the path that the figures and exported data files will be saved
+        cube_file: packed scan read instead of the raw files, created from them on the first run (None to read the raw files)"""
         
         print("Data class is initialized.\n")
         self.PA_map_output_name = PA_map_output_name
@@ -47,6 +52,7 @@ class Data1D():
             print("The scanned axis letter is not recognized. Try using 'x' or 'y'.\n")
             exit()    
 
+        self.cube_file = cube_file
         self.read_PA_map_output_file()
         self.x = self.x + self.initial_distance
         
@@ -60,8 +66,14 @@ class Data1D():
     def read_PA_map_output_file(self):
         """Reads the UMSmap file of the scan."""
         print("Reading the PA map file output.")
-        data = np.genfromtxt(self.PA_map_output_name, delimiter=None, skip_header=81)
-        self.x = np.asarray(data[:,0])       
+        if self.cube_file:
+            self.cube = open_cube(self.cube_file, lambda: convert_profile_scan(self.PA_map_output_name, self.PA_raw_output_prefix_name,
+                                                                               self.scanned_axis_letter, self.cube_file))
+            self.x = self.cube.x.copy()
+        else:
+            self.cube = None
+            data = np.genfromtxt(self.PA_map_output_name, delimiter=None, skip_header=81)
+            self.x = np.asarray(data[:,0])       
         self.x_count = self.x.shape[0]   
         print("Done...\n")
 
@@ -71,10 +83,13 @@ class Data1D():
 
     def plot_for_starting_distance_calculation(self):
 
-        full_filename = f"{self.PA_raw_output_prefix_name}X{0:0>3}.txt"
-        data = np.genfromtxt(full_filename, delimiter=None, skip_header=81)
-        time = np.asarray(data[:,0])
-        volt = np.asarray(data[:,1])
+        if self.cube is not None:
+            time, volt = self.cube.waveform(0, 0)
+        else:
+            full_filename = f"{self.PA_raw_output_prefix_name}X{0:0>3}.txt"
+            data = np.genfromtxt(full_filename, delimiter=None, skip_header=81)
+            time = np.asarray(data[:,0])
+            volt = np.asarray(data[:,1])
 
         fig1, ax1 = plt.subplots()
         ax1.set_title("Signal when distance is minimum")
@@ -136,14 +151,17 @@ class Data1D():
         self.pr = self.mapped_I_spta_Wcm2.copy()
 
         for x_index in range(self.x_count):
-            full_filename = f"{self.PA_raw_output_prefix_name}{self.scanned_axis_letter}{x_index:0>3}.txt"
             if x_index % 20 == 0:
                 print(f"__ file {x_index}/{self.x_count} processed.")
             
-            data = np.genfromtxt(full_filename, delimiter=None, skip_header=81)
-            time = np.asarray(data[:,0])
-            volt = np.asarray(data[:,1])
-            volt -= np.mean(volt)
+            if self.cube is not None:
+                time, volt = self.cube.waveform(0, x_index)
+            else:
+                full_filename = f"{self.PA_raw_output_prefix_name}{self.scanned_axis_letter}{x_index:0>3}.txt"
+                data = np.genfromtxt(full_filename, delimiter=None, skip_header=81)
+                time = np.asarray(data[:,0])
+                volt = np.asarray(data[:,1])
+            volt = volt - np.mean(volt)
             
             I_spta_Wcm2, I_sppa_Wcm2, PII_Wscm2, pr_derated_MPa = self.calculate_intensities_and_MI(time, volt, x_index)
             
@@ -10,6 +10,7 @@ if __name__ == "__main__":
     mapfile_path = "Axial Scan\\alignment_UMSProfile.txt" # UMSmap file path in the data folder
     raw_file_prefix = "Axial Scan\\alignment" # raw file path, exclude the X and Y index parts and file format
     export_folder = "00_python_output_axial_scan" # the FOLDER you want to export into
+    cube_file = None # e.g. "Axial Scan\\alignment.cube", a packed copy of the raw files made on the first run and read afterwards
 
 
     pulse_period_Seconds = 2.5 # the period of the pulses in seconds
@@ -21,7 +22,7 @@ if __name__ == "__main__":
     data = Data1D(mapfile_path, raw_file_prefix, 
                   initial_distance, center_frequency_Hz, 
                   pulse_repetition_frequency_Hz, 
-                  scanned_axis_letter, export_folder)
+                  scanned_axis_letter, export_folder, cube_file)
 
     
 